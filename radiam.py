@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 Usage:
-  radiam.py [--projectname=<pro>] [--mtime=<mt>] [--minsize=<ms>] [--hostname=<host>] [--username=<user>] [--password=<pass>] [--rootdir=<DIR>] [--quitafter] [--logout] [--loglevel=<loglevel>] ...
+  radiam.py [--projectname=<pro>] [--mtime=<mt>] [--minsize=<ms>] [--hostname=<host>] [--username=<user>] [--password=<pass>] [--rootdir=<DIR>] [--quitafter] [--incremental] [--profile] [--stats] [--logout] [--loglevel=<loglevel>] ...
 
 Options:
   -d --rootdir=<DIR>  Directory to start crawling from
@@ -13,6 +13,9 @@ Options:
   -p --password Specify password if connecting without a token
   -n --projectname=<pro> Project name
   -q --quitafter  Quit after initial crawl
+  -i --incremental  Upload only what changed since the last incremental crawl, for instance when run from cron
+  --profile  Time each stage of the crawl and write a report to the agent's data directory
+  --stats  Show the progress of the running agent's crawl
   -o --logout  Remove old tokens
   -l --loglevel The logging level(debug, error, warning or info)
 """
@@ -22,32 +25,46 @@ from scandir import scandir
 import os
 import sys
 import socket
-import persistqueue
-from persistqueue import Queue
 from configobj import ConfigObj
 import logging
 import time
 from datetime import datetime
 import platform
-from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
 from appdirs import AppDirs
 import json
 import pickle
 import signal
-import yaml
+import functools
+import collections
+import concurrent.futures
+import threading
 import uuid
-from radiam_api import RadiamAPI
+from radiam_api import RadiamAPI, encode_document
+from radiam_batch import BatchController
+import radiam_metrics
+import radiam_profile
+from radiam_enrich import MetadataEnricher, record_extractor_stats
+from radiam_sandbox import Quarantine
+from radiam_tika import TikaPool, TikaSettings, tika_metadata
+from radiam_cache import StatCache, stat_key
+from radiam_hash import Checksummer
+from radiam_payload import PayloadPolicy
+from radiam_scheduler import Cancelled, FairScheduler, LIVE
+from radiam_checkpoint import CrawlCheckpoint
+from radiam_state import CrawlState
+from radiam_shard import ShardCoordinator, shard_owner
+from radiam_throttle import AdaptiveThrottle, TokenBucket
 import radiam_extract
+import radiam_stats
 from requests import exceptions
 import re
 
 dirs = AppDirs("radiam-agent", "Compute Canada")
 os.makedirs(dirs.user_data_dir, exist_ok=True)
 tokenfile = os.path.join(dirs.user_data_dir, "token")
+statsfile = os.path.join(dirs.user_data_dir, "stats.json")
 os.environ['TIKA_LOG_PATH'] = dirs.user_data_dir
-from tika import parser as tikaParser
 post_data_limit = 1000000
 
 # only available on non-Windows, and optional
@@ -65,10 +82,15 @@ version = '1.3.1'
 __version__ = version
 
 default_location_type = "location.type.server"
+metrics_started = False
+extraction_cache = None
+checksummer = None
+enricher = None
+stat_throttle = None
 
 
 class FileSystemMonitor(FileSystemEventHandler):
-    def __init__(self, API, config, project_key, logger, list_last_crawl):
+    def __init__(self, API, config, project_key, logger, list_last_crawl, scheduler=None):
         self.API = API
         self.c_set = set()
         self.d_set = set()
@@ -77,8 +99,50 @@ class FileSystemMonitor(FileSystemEventHandler):
         self.project_config = config[project_key]
         self.logger = logger
         self.set_last_crawl = set(list_last_crawl)
+        self.initial_last_crawl = set(self.set_last_crawl)
+        self.latency_target = float(config['agent'].get('event_latency_target', 5))
+        self.received = None
+        self.stats = radiam_stats.stats.project(self.project_config['name'])
+        # with a scheduler, each event is handled in one of the crawl workers, ahead of any crawl work
+        self.scheduler = scheduler
+        self.job = "monitor " + project_key
+        if scheduler is not None:
+            scheduler.add(self.job, priority=LIVE)
+
+    def dispatch(self, event):
+        self.received = time.time()
+        if self.scheduler is None:
+            super(FileSystemMonitor, self).dispatch(event)
+            return
+        try:
+            self.scheduler.acquire(self.job)
+        except Cancelled:
+            # the agent is shutting down; the event is picked up by the next crawl
+            return
+        try:
+            super(FileSystemMonitor, self).dispatch(event)
+        except Cancelled:
+            # cancelled while waiting to retry the API
+            pass
+        finally:
+            self.scheduler.release(self.job)
+
+    def rebase(self, list_last_crawl):
+        """Start from the file list of a crawl that finished while events were coming in, keeping their changes"""
+        if self.scheduler is not None:
+            # holding a slot as the monitor keeps events from changing the list meanwhile
+            self.scheduler.acquire(self.job)
+        try:
+            added = self.set_last_crawl - self.initial_last_crawl
+            removed = self.initial_last_crawl - self.set_last_crawl
+            self.initial_last_crawl = set(list_last_crawl)
+            self.set_last_crawl = (self.initial_last_crawl | added) - removed
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(self.job, 0)
 
     def on_deleted(self, event):
+        start = time.time()
         res = self.API.search_endpoint_by_path(self.project_config['endpoint'], event.src_path)
         what = "unknown"
         if res:
@@ -96,14 +160,29 @@ class FileSystemMonitor(FileSystemEventHandler):
                     self.logger.warning("The type is unknown.")
         while len(self.d_set)!=0:
             path_de = os.path.abspath(self.d_set.pop())
-            try_connection_in_worker(self.API, self.project_config, path_de, self.logger)
+            try_connection_in_worker(self.API, self.project_config, path_de, self.logger,
+                                     scheduler=self.scheduler)
             self.set_last_crawl.discard(os.path.abspath(path_de))
             self.logger.info("Deleted %s: %s", what, event.src_path)
             meta_status, parent_path = update_path(event.src_path, self.config, self.project_key, self.API,
-                                                   self.project_config, self.logger)
+                                                   self.project_config, self.logger, self.scheduler)
             if meta_status:
                 self.set_last_crawl.add(os.path.abspath(parent_path))
                 self.logger.info("Update the information for directory %s", parent_path)
+        self.record_event("deleted", start)
+
+    def record_event(self, action, start):
+        # count the time the event waited for a worker too
+        if self.received is not None:
+            start = min(start, self.received)
+        latency = time.time() - start
+        radiam_metrics.monitor_events.inc(self.project_config['name'], action)
+        self.stats.events += 1
+        radiam_metrics.event_latency.observe(latency, self.project_config['name'])
+        if self.latency_target and latency > self.latency_target:
+            radiam_metrics.event_late.inc(self.project_config['name'])
+            self.logger.debug("Indexing a %s event on Project %s took %.1fs, over its %ss target", action,
+                              self.project_config['name'], latency, self.latency_target)
 
     def on_created(self, event):
         self.on_create_modify(event, "Created", self.logger)
@@ -112,6 +191,7 @@ class FileSystemMonitor(FileSystemEventHandler):
         self.on_create_modify(event, "Modified", self.logger)
 
     def on_moved(self, event):
+        start = time.time()
         what = 'directory' if event.is_directory else 'file'
         if what == 'file' and not file_excluded(event.src_path, self.project_config) and not file_excluded(event.dest_path, self.project_config) and not yml_file(event.src_path) and not yml_file(event.dest_path):
             self.d_set.add(event.src_path)
@@ -126,25 +206,29 @@ class FileSystemMonitor(FileSystemEventHandler):
             else:
                 metadata = get_file_meta(path_in, self.config, self.project_key)
             if metadata is not None:
-                try_connection_in_worker(self.API, self.project_config, path_in, self.logger, metadata)
+                try_connection_in_worker(self.API, self.project_config, path_in, self.logger, metadata,
+                                         self.scheduler)
                 self.set_last_crawl.add(os.path.abspath(path_in))
         while len(self.d_set)!=0:
             path_de = self.d_set.pop()
-            try_connection_in_worker(self.API, self.project_config, path_de, self.logger)
+            try_connection_in_worker(self.API, self.project_config, path_de, self.logger,
+                                     scheduler=self.scheduler)
             self.set_last_crawl.discard(os.path.abspath(path_de))
             self.logger.info("Moved %s: from %s to %s", what, event.src_path, event.dest_path)
         meta_status_src, parent_path_src = update_path(event.src_path, self.config, self.project_key, self.API,
-                                                       self.project_config, self.logger)
+                                                       self.project_config, self.logger, self.scheduler)
         meta_status_dest, parent_path_dest = update_path(event.dest_path, self.config, self.project_key, self.API,
-                                                         self.project_config, self.logger)
+                                                         self.project_config, self.logger, self.scheduler)
         if meta_status_src:
             self.set_last_crawl.add(os.path.abspath(parent_path_src))
             self.logger.info("Update the information for directory %s", parent_path_src)
         if meta_status_dest:
             self.set_last_crawl.add(os.path.abspath(parent_path_dest))
             self.logger.info("Update the information for directory %s", parent_path_dest)
+        self.record_event("moved", start)
 
     def on_create_modify(self, event, action, logger):
+        start = time.time()
         what = 'directory' if event.is_directory else 'file'
         if what == 'file' and not file_excluded(event.src_path, self.project_config) and not yml_file(event.src_path):
             self.c_set.add(event.src_path)
@@ -157,53 +241,92 @@ class FileSystemMonitor(FileSystemEventHandler):
             else:
                 metadata = get_file_meta(path_in, self.config, self.project_key)
             if metadata is not None:
-                try_connection_in_worker(self.API, self.project_config, path_in, self.logger, metadata)
+                try_connection_in_worker(self.API, self.project_config, path_in, self.logger, metadata,
+                                         self.scheduler)
                 self.set_last_crawl.add(os.path.abspath(path_in))
                 self.logger.info("%s %s: %s", action, what, event.src_path)
             meta_status, parent_path = update_path(event.src_path, self.config, self.project_key, self.API,
-                                                   self.project_config, logger)
+                                                   self.project_config, logger, self.scheduler)
             if meta_status:
                 self.set_last_crawl.add(os.path.abspath(parent_path))
                 self.logger.info("Update the information for directory %s", parent_path)
+        self.record_event(action.lower(), start)
 
 
-def update_path(path, config, project_key, API, project_config, logger):
+def update_path(path, config, project_key, API, project_config, logger, scheduler=None):
     parent_path = os.path.abspath(os.path.join(path, os.pardir))
     metadata = get_dir_meta(parent_path, config, project_key)
     if metadata is not None:
-        try_connection_in_worker(API, project_config, parent_path, logger, metadata)
+        try_connection_in_worker(API, project_config, parent_path, logger, metadata, scheduler)
         return True, parent_path
     else:
         return False, parent_path
 
 
-def try_connection_in_worker(API, project_config, path, logger, metadata=None):
+def apply_payload_policy(metadata, project_config):
+    """Trim extended_metadata to the project's payload policy before the document is serialized"""
+    if metadata and metadata.get("extended_metadata"):
+        metadata["extended_metadata"] = PayloadPolicy.from_config(project_config).apply(metadata["extended_metadata"])
+    return metadata
+
+
+def retry_wait(scheduler, seconds=10):
+    """Wait before retrying a request the API did not answer, raising Cancelled if scheduler is cancelled meanwhile"""
+    if scheduler is None:
+        time.sleep(seconds)
+    elif scheduler.wait(seconds):
+        raise Cancelled("retry")
+
+
+def try_connection_in_worker(API, project_config, path, logger, metadata=None, scheduler=None):
+    """Post metadata for path, or delete the documents of path without it, returning whether the API took it"""
+    apply_payload_policy(metadata, project_config)
     while True:
         try:
-            res = API.search_endpoint_by_path(project_config['endpoint'], path)
-            if res:
-                if metadata:
-                    if res['count'] == 0:
-                        API.create_document(project_config['endpoint'], metadata)
-                        logger.debug("POSTing to API: {}".format(json.dumps(metadata)))
+            with radiam_profile.stage("http"):
+                res = API.search_endpoint_by_path(project_config['endpoint'], path)
+                done = bool(res)
+                if res:
+                    if metadata:
+                        if res['count'] == 0:
+                            API.create_document(project_config['endpoint'], metadata)
+                            logger.debug("POSTing to API: {}".format(json.dumps(metadata)))
+                        else:
+                            API.create_document(project_config['endpoint'], metadata)
+                            logger.debug("POSTing to API: " + json.dumps(metadata))
                     else:
-                        API.create_document(project_config['endpoint'], metadata)
-                        logger.debug("POSTing to API: " + json.dumps(metadata))
-                else:
-                    for doc in res['results']:
-                        API.delete_document(project_config['endpoint'], doc['id'])
-                        logger.debug("DELETEing document {} from API".format(doc['id']))
-            return
+                        for doc in res['results']:
+                            if API.delete_document(project_config['endpoint'], doc['id']):
+                                logger.debug("DELETEing document {} from API".format(doc['id']))
+                            else:
+                                done = False
+            return done
         except exceptions.ConnectionError:
-            time.sleep(10)
-            pass
+            retry_wait(scheduler)
 
 
-def try_connection_in_worker_bulk(API, project_config, logger, metadata):
+def try_connection_in_worker_bulk(API, project_config, logger, metadata, batcher=None, scheduler=None):
     while True:
         try:
-            logger.debug("POSTing to API: {}".format(json.dumps(metadata)))
-            resp_text, status = API.create_document_bulk(project_config['endpoint'], metadata)
+            logger.debug("POSTing {} documents to API".format(len(metadata)))
+            nbytes = sum(len(encode_document(d)) for d in metadata)
+            radiam_metrics.bulk_documents.observe(len(metadata))
+            radiam_metrics.bulk_bytes.observe(nbytes)
+            start = time.time()
+            with radiam_profile.stage("http"):
+                resp_text, status = API.create_document_bulk(project_config['endpoint'], metadata)
+            if batcher is not None:
+                batcher.record(time.time() - start, API.last_status_code, nbytes, len(metadata))
+            if API.last_status_code == 413 and len(metadata) > 1:
+                # The batch is larger than the server accepts; send it in halves
+                logger.warning("Bulk request of {} documents was too large for the API; splitting it".format(len(metadata)))
+                half = len(metadata) // 2
+                resp_text, status = try_connection_in_worker_bulk(API, project_config, logger, metadata[:half], batcher,
+                                                                  scheduler)
+                if status:
+                    resp_text, status = try_connection_in_worker_bulk(API, project_config, logger, metadata[half:], batcher,
+                                                                      scheduler)
+                return resp_text, status
             if resp_text:
                 if isinstance(resp_text, list):
                     for s in resp_text:
@@ -215,8 +338,9 @@ def try_connection_in_worker_bulk(API, project_config, logger, metadata):
                     logger.error("Radiam API error with index '{}': {}\n".format(project_config['endpoint'], resp_text))
             return resp_text, status
         except exceptions.ConnectionError:
-            time.sleep(10)
-            pass
+            if batcher is not None:
+                batcher.record(None, None, 0, len(metadata))
+            retry_wait(scheduler)
 
 
 def replace_config(configfile, logger, tray_options):
@@ -242,14 +366,76 @@ def write_new_config(configfile, tray_options):
         else:
             new_config.write("host =\n")
         new_config.write("# Port number does not usually need to be changed\n")
-        new_config.write("#port = 8100\n\n")
+        new_config.write("#port = 8100\n")
+        new_config.write("# Compress bulk uploads; set to gzip if the Radiam server accepts gzip request bodies\n")
+        new_config.write("#compression = disabled\n\n")
         new_config.write("[agent]\n")
         new_config.write("# This ID is randomly generated and does not need to be changed.\n")
         new_config.write("id = {}\n".format(agent_id))
         new_config.write("# Minimum days ago for modified time (default: 0)\n")
         new_config.write("#mtime = 0\n")
         new_config.write("# Minimum file size in Bytes for indexing (default: 0 Bytes)\n")
-        new_config.write("#minsize = 0\n\n")
+        new_config.write("#minsize = 0\n")
+        new_config.write("# Bulk upload batches are tuned between these limits from the observed API response times\n")
+        new_config.write("#batch_bytes_min = 100000\n")
+        new_config.write("#batch_bytes_max = 10000000\n")
+        new_config.write("#batch_docs_min = 10\n")
+        new_config.write("#batch_docs_max = 10000\n")
+        new_config.write("# Target response time in seconds for one bulk upload\n")
+        new_config.write("#batch_target_latency = 2\n")
+        new_config.write("# Serve agent metrics in Prometheus format on this localhost port (default: disabled)\n")
+        new_config.write("#metrics_port =\n")
+        new_config.write("# Write a summary of the agent metrics to the log every this many seconds (default: disabled)\n")
+        new_config.write("#metrics_log_interval =\n")
+        new_config.write("# Write the crawl progress shown by --stats every this many seconds (0 to disable), estimating\n")
+        new_config.write("# the size of each tree for the ETA from this many random walks down it\n")
+        new_config.write("#stats_interval = 5\n")
+        new_config.write("#stats_samples = 20\n")
+        new_config.write("# Worker processes for rich metadata extraction (default: one per CPU)\n")
+        new_config.write("#extract_workers =\n")
+        new_config.write("# Cache extended metadata by file identity so unchanged files are never parsed twice\n")
+        new_config.write("#extract_cache = enabled\n")
+        new_config.write("# Maximum size in Bytes of the extended metadata cache (default: 256 MB)\n")
+        new_config.write("#extract_cache_size = 268435456\n")
+        new_config.write("# Seconds an extraction worker may spend on one file before it is killed, and its memory limit in Bytes\n")
+        new_config.write("#extract_deadline = 60\n")
+        new_config.write("#extract_memory_limit = 2147483648\n")
+        new_config.write("# Extraction workers are replaced after this many files, and files that hang or crash\n")
+        new_config.write("# a worker this many times are skipped until they change\n")
+        new_config.write("#extract_worker_max_files = 1000\n")
+        new_config.write("#extract_quarantine_after = 2\n")
+        new_config.write("# Threads computing checksums for projects that enable them, and their read limit in Bytes per second (0 for none)\n")
+        new_config.write("#checksum_workers =\n")
+        new_config.write("#checksum_rate = 0\n")
+        new_config.write("# Files larger than this many Bytes are hashed in parallel chunks, as a tree hash\n")
+        new_config.write("#checksum_chunk_size = 67108864\n")
+        new_config.write("# Projects are crawled at the same time, sharing this many crawl workers\n")
+        new_config.write("#crawl_workers = 4\n")
+        new_config.write("# Entries a project scans before its worker may be handed to another project\n")
+        new_config.write("#crawl_slice = 1000\n")
+        new_config.write("# Keep track of indexed directories and documents so an interrupted crawl resumes where it stopped\n")
+        new_config.write("#crawl_checkpoint = enabled\n")
+        new_config.write("# Seconds within which a file system event should be indexed, even while a crawl is running\n")
+        new_config.write("#event_latency_target = 5\n")
+        new_config.write("# Rescan every project for changes every this many seconds, instead of watching the file\n")
+        new_config.write("# system, where it cannot be watched (default: disabled). Rescans are incremental, as with --incremental\n")
+        new_config.write("#rescan_interval =\n")
+        new_config.write("# Incremental rescans trust directory modification times for this many days between full checks\n")
+        new_config.write("#rescan_verify_days = 7\n")
+        new_config.write("# Time each stage of the crawl and write a report to the agent's data directory, as --profile does,\n")
+        new_config.write("# capturing a cprofile or tracemalloc profile of the first profile_window seconds if asked\n")
+        new_config.write("#profile = disabled\n")
+        new_config.write("#profile_capture = none\n")
+        new_config.write("#profile_window = 60\n")
+        new_config.write("# Limits on the shared storage: file system operations per second for the crawl, and Bytes\n")
+        new_config.write("# per second read by extraction workers altogether (0 for none)\n")
+        new_config.write("#io_stat_rate = 0\n")
+        new_config.write("#extract_read_rate = 0\n")
+        new_config.write("# Slow down crawling, extraction and checksums while the storage answers slowly, and the seconds\n")
+        new_config.write("# a file system operation and one read may take (default: judged from the fastest seen)\n")
+        new_config.write("#io_adaptive = enabled\n")
+        new_config.write("#io_stat_latency =\n")
+        new_config.write("#io_read_latency =\n\n")
         new_config.write("[location]\n")
         new_config.write("# A nickname for the computer on which this is running.\n")
         new_config.write("#name = \n\n")
@@ -276,7 +462,41 @@ def write_new_config(configfile, tray_options):
         new_config.write("excluded_files = .*,Thumbs.db,.DS_Store,._.DS_Store,.localized,desktop.ini,*.pyc,*.swx,*.swp,*~,~$*,NULLEXT\n")
         new_config.write("# URL to a Tika instance for optional metadata parsing in this project.\n")
         new_config.write("#tika_host =\n")
-        new_config.write("#rich_metadata = disabled\n\n")
+        new_config.write("# Concurrent Tika requests, and seconds before a request is abandoned and retried later\n")
+        new_config.write("#tika_workers = 4\n")
+        new_config.write("#tika_timeout = 30\n")
+        new_config.write("# How many times, and after how many seconds, slow or failed files are retried\n")
+        new_config.write("#tika_retries = 2\n")
+        new_config.write("#tika_retry_delay = 30\n")
+        new_config.write("# Largest file in Bytes sent to Tika, by mimetype pattern, as a comma separated list of type:bytes\n")
+        new_config.write("#tika_size_limits = application/pdf:20000000, *:500000\n")
+        new_config.write("# Mimetypes whose metadata is in the file header; only this many leading Bytes are sent\n")
+        new_config.write("#tika_header_limits = image/*:262144, audio/*:262144, video/*:1048576\n")
+        new_config.write("#rich_metadata = disabled\n")
+        new_config.write("# Comma separated list of rich metadata extractors to leave out: pdf, cdf, hdf5, fits, exif, ole, word, excel\n")
+        new_config.write("#extract_disabled =\n")
+        new_config.write("# Most expensive class of extractor to run: cheap, moderate or expensive\n")
+        new_config.write("#extract_max_cost = expensive\n")
+        new_config.write("# Largest file in Bytes given to an extractor, as a comma separated list of extractor:bytes\n")
+        new_config.write("#extract_max_bytes =\n")
+        new_config.write("# Comma separated lists of extended metadata fields to upload or leave out; patterns like\n")
+        new_config.write("# Exif* or GPSInfo.* match field names, with dots separating nested fields\n")
+        new_config.write("#extended_include =\n")
+        new_config.write("#extended_exclude =\n")
+        new_config.write("# Longest string (in characters) and list (in items) kept in extended metadata, and the most\n")
+        new_config.write("# Bytes of extended metadata per document; larger fields are dropped to fit (0 for no limit)\n")
+        new_config.write("#extended_value_limit = 1024\n")
+        new_config.write("#extended_list_limit = 100\n")
+        new_config.write("#extended_max_bytes = 32768\n")
+        new_config.write("# Add a content checksum to each file, using a hashlib algorithm such as sha256, blake2b or md5\n")
+        new_config.write("#checksum = disabled\n")
+        new_config.write("# Share of the crawl workers this project gets while other projects are crawled too\n")
+        new_config.write("#crawl_weight = 1\n")
+        new_config.write("# To share the crawl of this project with agents on other nodes, give all of them the same rootdir\n")
+        new_config.write("# and a coordination database on a file system they all mount, and how many seconds an agent may be\n")
+        new_config.write("# silent before its part of the tree is handed to another agent\n")
+        new_config.write("#shard_db =\n")
+        new_config.write("#shard_lease = 300\n\n")
 
 
 def config_list_check(config, project_key, input_field):
@@ -287,6 +507,16 @@ def config_list_check(config, project_key, input_field):
             config[project_key][input_field] = [config[project_key][input_field]]
 
 
+def config_cost_check(config, project_key, logger):
+    # checked once here, as every file the project's extractors are chosen for would fail on it otherwise
+    max_cost = config[project_key].get("extract_max_cost")
+    if max_cost and max_cost not in radiam_extract.cost_classes:
+        logger.error("extract_max_cost for project {} is {}, which is not one of {}".format(
+            config[project_key].get('name'), max_cost, ", ".join(radiam_extract.cost_classes)))
+        return False
+    return True
+
+
 def load_config(user_data_dir, arguments, logger, tray_options):
     """Load the configuration for this agent from the config file"""
     config = None
@@ -331,6 +561,10 @@ def load_config(user_data_dir, arguments, logger, tray_options):
         else:
             return config, False
 
+    for project_key in config['projects']['project_list']:
+        if not config_cost_check(config, project_key, logger):
+            return config, False
+
     if "api" in config:
         if config['api'].get('host') is None:
             config['api']['host'] = "http://localhost:8100"
@@ -351,6 +585,8 @@ def load_config(user_data_dir, arguments, logger, tray_options):
             config['agent']['minsize'] = arguments['--minsize']
         if config['agent'].get('minsize') is None:
             config['agent']['minsize'] = "0"
+        if arguments.get('--profile'):
+            config['agent']['profile'] = "enabled"
         if config['agent'].get('loglevel') == "debug":
             logger.setLevel(logging.DEBUG)
             logger.info("Log level changed to debug based on agent configuration setting")
@@ -504,38 +740,139 @@ def log_setup(logLevel):
     return radiam_logger
 
 
-def get_extended_metadata(dir, project_config):
-    if not project_config.get("tika_host") and not project_config.get("rich_metadata"):
+def open_extraction_cache(config):
+    global extraction_cache
+    if extraction_cache is None and config['agent'].get('extract_cache', 'enabled') != 'disabled':
+        extraction_cache = StatCache(os.path.join(dirs.user_data_dir, "extract_cache.db"),
+                                     int(config['agent'].get('extract_cache_size', 268435456)))
+    return extraction_cache
+
+
+def checksum_algorithm(project_config):
+    algorithm = project_config.get("checksum", "disabled")
+    if not algorithm or algorithm == "disabled":
         return None
+    return algorithm
+
+
+def io_latency(config, key):
+    value = config['agent'].get(key)
+    return float(value) if value else None
+
+
+def io_adaptive(config):
+    return config['agent'].get('io_adaptive', 'enabled') != 'disabled'
+
+
+def open_stat_throttle(config, logger):
+    global stat_throttle
+    rate = int(config['agent'].get('io_stat_rate', 0))
+    if stat_throttle is None and io_adaptive(config):
+        stat_throttle = AdaptiveThrottle(rate, target=io_latency(config, 'io_stat_latency'), min_rate=10,
+                                         name="file system operations", logger=logger)
+    elif stat_throttle is None and rate:
+        stat_throttle = TokenBucket(rate)
+    return stat_throttle
+
+
+def throttled(fn, *args):
+    """Run one file system operation under the stat throttle, if there is one"""
+    if isinstance(stat_throttle, AdaptiveThrottle):
+        return stat_throttle.call(fn, *args)
+    if stat_throttle is not None:
+        stat_throttle.take(1)
+    return fn(*args)
+
+
+def open_checksummer(config, logger=None):
+    global checksummer
+    if checksummer is None and any(checksum_algorithm(config[p]) for p in config['projects']['project_list']):
+        cache = None
+        if config['agent'].get('extract_cache', 'enabled') != 'disabled':
+            cache = StatCache(os.path.join(dirs.user_data_dir, "checksum_cache.db"),
+                              int(config['agent'].get('extract_cache_size', 268435456)))
+        workers = config['agent'].get('checksum_workers')
+        checksummer = Checksummer(int(workers) if workers else None, int(config['agent'].get('checksum_rate', 0)), cache,
+                                  int(config['agent'].get('checksum_chunk_size', 67108864)), logger=logger,
+                                  read_latency=io_latency(config, 'io_read_latency'), adaptive=io_adaptive(config))
+    return checksummer
+
+
+def open_enricher(config, logger):
+    global enricher
+    if enricher is None and any(config[p].get("rich_metadata") == "enabled" for p in config['projects']['project_list']):
+        workers = config['agent'].get('extract_workers')
+        memory_limit = int(config['agent'].get('extract_memory_limit', 2147483648))
+        enricher = MetadataEnricher(int(workers) if workers else None, logger=logger, cache=extraction_cache,
+                                    deadline=float(config['agent'].get('extract_deadline', 60)),
+                                    memory_limit=memory_limit or None,
+                                    max_tasks=int(config['agent'].get('extract_worker_max_files', 1000)),
+                                    quarantine=Quarantine(os.path.join(dirs.user_data_dir, "quarantine.db"),
+                                                          int(config['agent'].get('extract_quarantine_after', 2))),
+                                    read_rate=int(config['agent'].get('extract_read_rate', 0)),
+                                    read_latency=io_latency(config, 'io_read_latency'), adaptive=io_adaptive(config))
+    return enricher
+
+
+def close_services():
+    """Close the shared extraction, checksum and throttling services, so the next crawl opens them from its config"""
+    global extraction_cache, checksummer, enricher, stat_throttle
+    if extraction_cache is not None:
+        extraction_cache.close()
+        extraction_cache = None
+    if checksummer is not None:
+        checksummer.close()
+        if checksummer.cache is not None:
+            checksummer.cache.close()
+        checksummer = None
+    stat_throttle = None
+    if enricher is not None:
+        enricher.close()
+        enricher.quarantine.close()
+        enricher = None
+
+
+def extraction_version(project_config):
     if project_config.get("rich_metadata") == "enabled":
-        return radiam_extract.route_metadata_parser(dir)
-    if os.path.getsize(dir) > 500000:
-        return None
-    try:
-        parsed = tikaParser.from_file(dir, project_config.get("tika_host"))
-        if parsed["status"] == 200:
-            return parsed['metadata']
-        else:
-            return None
-    except:
-        return None
+        return "rich-" + radiam_extract.options_version(radiam_extract.extractor_options(project_config))
+    return "tika-" + str(project_config.get("tika_host"))
 
 
-def get_dir_meta(path, config, project_key):
-    try:
-        if dir_excluded(path, config[project_key]):
-            return None
-        # get directory meta using lstat
-        mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime = os.lstat(path)
+def cached_extended_metadata(project_config, key):
+    if extraction_cache is None or key is None:
+        return False, None
+    return extraction_cache.get(key, extraction_version(project_config))
 
-        # convert times to utc for es
-        mtime_utc = datetime.utcfromtimestamp(mtime).isoformat()
-        atime_utc = datetime.utcfromtimestamp(atime).isoformat()
-        ctime_utc = datetime.utcfromtimestamp(ctime).isoformat()
 
-        # get time now in utc
-        indextime_utc = datetime.utcnow().isoformat()
+def get_extended_metadata(dir, project_config, key=None):
+    if not project_config.get("tika_host") and project_config.get("rich_metadata") != "enabled":
+        return None
+    # key identifies the file content (see radiam_cache.stat_key); a cache hit
+    # skips both MIME detection and parsing
+    hit, cached = cached_extended_metadata(project_config, key)
+    if hit:
+        return cached
+    if project_config.get("rich_metadata") == "enabled":
+        options = radiam_extract.extractor_options(project_config)
+        if enricher is not None:
+            # run in the sandbox so a pathological file cannot hang the monitor
+            metadata = enricher.extract(dir, options)
+        else:
+            metadata = radiam_extract.route_metadata_parser(dir, key[2] if key else None, options)
+            record_extractor_stats(radiam_extract.registry.take_stats())
+    else:
+        try:
+            metadata = tika_metadata(dir, TikaSettings(project_config))
+        except Exception:
+            return None
+    # a failed extraction is tried again next time rather than cached
+    if extraction_cache is not None and key is not None and metadata is not None:
+        extraction_cache.put(key, extraction_version(project_config), metadata)
+    return metadata
+
 
+def owner_and_group(path, uid, gid):
+    with radiam_profile.stage("owner"):
         # try to get owner user name
         if platform.system() == 'Windows':
             sd = win32security.GetFileSecurity(path, win32security.OWNER_SECURITY_INFORMATION)
@@ -557,6 +894,28 @@ def get_dir_meta(path, config, project_key):
             # if we can't find the group name, use the gid number
             except KeyError:
                 group = platform.system()
+    return owner, group
+
+
+def get_dir_meta(path, config, project_key):
+    try:
+        with radiam_profile.stage("exclude"):
+            excluded = dir_excluded(path, config[project_key])
+        if excluded:
+            return None
+        # get directory meta using lstat
+        with radiam_profile.stage("lstat"):
+            mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime = throttled(os.lstat, path)
+
+        # convert times to utc for es
+        mtime_utc = datetime.utcfromtimestamp(mtime).isoformat()
+        atime_utc = datetime.utcfromtimestamp(atime).isoformat()
+        ctime_utc = datetime.utcfromtimestamp(ctime).isoformat()
+
+        # get time now in utc
+        indextime_utc = datetime.utcnow().isoformat()
+
+        owner, group = owner_and_group(path, uid, gid)
 
         parentdir = os.path.abspath(os.path.join(path, os.pardir))
 
@@ -578,13 +937,16 @@ def get_dir_meta(path, config, project_key):
             "agent": config['agent']['id']
         }
         yaml_path = os.path.join(path, (os.path.basename(path) + ".yml"))
-        if os.path.isfile(yaml_path):
-            try:
-                with open(yaml_path, 'r') as stream:
-                    yaml_data = yaml.safe_load(stream)
-                filemeta_dict["extended_metadata"] = yaml_data
-            except:
-                pass
+        with radiam_profile.stage("yaml"):
+            if os.path.isfile(yaml_path):
+                try:
+                    # only loaded for the first folder with a sidecar
+                    import yaml
+                    with open(yaml_path, 'r') as stream:
+                        yaml_data = yaml.safe_load(stream)
+                    filemeta_dict["extended_metadata"] = yaml_data
+                except:
+                    pass
 
     except (IOError, OSError) as e:
         return False
@@ -594,15 +956,22 @@ def get_dir_meta(path, config, project_key):
     return dirmeta_dict
 
 
-def get_file_meta(path, config, project_key):
+def get_file_meta(path, config, project_key, extended=True, checksum=True):
     """Scrapes file meta and ignores files smaller than minsize Bytes,
-    newer than mtime and in excluded_files. Returns file meta dict."""
+    newer than mtime and in excluded_files. Returns file meta dict.
+    With extended=False, extended_metadata is only filled in from the
+    extraction cache and is otherwise left out for the caller to extract;
+    checksum=False does the same for the checksum of projects that ask for one."""
 
     try:
-        if file_excluded(path, config[project_key]) or yml_file(path):
+        with radiam_profile.stage("exclude"):
+            excluded = file_excluded(path, config[project_key]) or yml_file(path)
+        if excluded:
             return None
 
-        mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime = os.lstat(path)
+        with radiam_profile.stage("lstat"):
+            st = throttled(os.lstat, path)
+        mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime = st
 
         # Skip files smaller than minsize cli flag
         if size < int(config['agent'].get('minsize',0)):
@@ -620,27 +989,7 @@ def get_file_meta(path, config, project_key):
         atime_utc = datetime.utcfromtimestamp(atime).isoformat()
         ctime_utc = datetime.utcfromtimestamp(ctime).isoformat()
 
-        # try to get owner user name
-        if platform.system() == 'Windows':
-            sd = win32security.GetFileSecurity(path, win32security.OWNER_SECURITY_INFORMATION)
-            owner_sid = sd.GetSecurityDescriptorOwner()
-            owner, domain, owner_type = win32security.LookupAccountSid (None, owner_sid)
-        else:
-            owner = pwd.getpwuid(uid).pw_name
-
-        if platform.system() == 'Windows':
-            group = "Windows"
-        else:
-            try:
-                group = grp.getgrgid(gid).gr_name.split('\\')
-                # remove domain before group
-                if len(group) == 2:
-                    group = group[1]
-                else:
-                    group = group[0]
-            # if we can't find the group name, use the gid number
-            except KeyError:
-                group = platform.system()
+        owner, group = owner_and_group(path, uid, gid)
 
         # get time
         indextime_utc = datetime.utcnow().isoformat()
@@ -666,8 +1015,22 @@ def get_file_meta(path, config, project_key):
             "location": config['location']['id'],
             "agent": config['agent']['id']
         }
-        extended_metadata = get_extended_metadata(path, config[project_key])
-        filemeta_dict["extended_metadata"] = extended_metadata
+        if extended:
+            with radiam_profile.stage("extract"):
+                filemeta_dict["extended_metadata"] = get_extended_metadata(path, config[project_key], stat_key(st))
+        else:
+            # leave extended_metadata out unless it is cached, so the caller knows to extract it
+            hit, cached = cached_extended_metadata(config[project_key], stat_key(st))
+            if hit:
+                filemeta_dict["extended_metadata"] = cached
+        algorithm = checksum_algorithm(config[project_key])
+        if algorithm and checksummer is not None:
+            if checksum:
+                filemeta_dict["checksum"] = checksummer.checksum(path, algorithm, stat_key(st))
+            else:
+                hit, cached = checksummer.cached(stat_key(st), algorithm)
+                if hit:
+                    filemeta_dict["checksum"] = cached
     except (IOError, OSError) as e:
         return False
 
@@ -761,77 +1124,526 @@ def dir_excluded(path, project_config):
     return False
 
 
-def full_run(API, q_dir, config, logger):
-
-    def post_data(metadata, files, entry, bulksize, bulkdata):
-        resp_text, status = None, False
-        if metadata is None or type(metadata) is list and len(metadata) == 0:
-            pass
+class CrawlJob(object):
+    """Crawl one project's rootdir and upload its documents in bulk.
+
+    Directories are scanned in slices of at least slice_entries entries,
+    each one run in a worker slot granted by scheduler, a
+    radiam_scheduler.FairScheduler, so projects crawled at the same time
+    share the crawl workers in proportion to their crawl_weight. File
+    records go through the shared checksum and metadata extraction stages,
+    each job with a lane of its own, before they are posted. Progress is
+    kept in checkpoint, a radiam_checkpoint.CrawlCheckpoint, so a crawl
+    that is interrupted picks up where it stopped the next time it runs.
+    With a shards coordinator, a radiam_shard.ShardCoordinator, the job
+    crawls only the units of the tree it claims from other agents. With a
+    state, a radiam_state.CrawlState, the crawl is incremental: it lists
+    only the directories that changed since the state was recorded,
+    uploads only new and changed entries, and deletes the documents of
+    entries that are gone.
+    """
+
+    def __init__(self, API, config, project_key, logger, scheduler, batcher, checkpoint, cache=None, enricher=None,
+                 checksums=None, slice_entries=1000, shards=None, state=None):
+        self.API = API
+        self.config = config
+        self.project_key = project_key
+        self.project_config = config[project_key]
+        self.logger = logger
+        self.scheduler = scheduler
+        self.batcher = batcher
+        self.checkpoint = checkpoint
+        self.slice_entries = slice_entries
+        self.shards = shards
+        self.state = state
+        self.rootdir = os.path.abspath(self.project_config['rootdir'])
+        # what scanned directories held, recorded in the state once their documents are acknowledged
+        self.listings = {}
+        self.deleted = []
+        # deletions of entries that are gone, sent from their own thread
+        self.deleter = None
+        self.deletes = []
+        # subtrees left to other agents, units crawled but not yet acknowledged, and files never indexed
+        self.units = set()
+        self.finished_units = []
+        self.ignored = set()
+        if shards is not None:
+            # the coordination database may well live in the tree being crawled
+            shard_db = os.path.abspath(self.project_config['shard_db'])
+            self.ignored = set(shard_db + suffix for suffix in ("", "-journal", "-wal", "-shm"))
+        self.directories = collections.deque()
+        # directories left over from an interrupted crawl, whose entries may already be indexed
+        self.resumed = set()
+        # documents not yet acknowledged, by directory, and the directories that have been scanned
+        self.outstanding = {}
+        self.scanned = set()
+        self.completed = []
+        self.bulkdata = []
+        self.bulkpaths = []
+        self.bulksize = 1
+        self.resp_text, self.status = None, False
+        # rich metadata is parsed off the crawl thread and merged in as it completes;
+        # Tika requests go through a per-project pool with its own deadlines and budgets
+        self.tika_pool = None
+        if enricher is not None and self.project_config.get("rich_metadata") == "enabled":
+            self.enricher = enricher.lane()
+            self.submit = functools.partial(self.enricher.submit,
+                                            options=radiam_extract.extractor_options(self.project_config),
+                                            version=extraction_version(self.project_config))
+        elif self.project_config.get("tika_host") and self.project_config.get("rich_metadata") != "enabled":
+            self.tika_pool = TikaPool(TikaSettings(self.project_config), logger, cache,
+                                      extraction_version(self.project_config))
+            self.enricher = self.tika_pool
+            self.submit = self.tika_pool.submit
         else:
-            files.append(os.path.abspath(os.path.join(path, entry.name)))
-            metasize = len(json.dumps(metadata))
-            if metasize + bulksize > post_data_limit:
-                resp_text, status = try_connection_in_worker_bulk(API, config[project_key], logger, bulkdata)
-                bulkdata = []
-                bulkdata.append(metadata)
-                bulksize = len(json.dumps(bulkdata))
-            else:
-                bulkdata.append(metadata)
-                bulksize = len(json.dumps(bulkdata))
-        return bulkdata, bulksize, resp_text, status
+            self.enricher = None
+        # checksums are computed on their own thread pool ahead of extraction
+        self.algorithm = checksum_algorithm(self.project_config) if checksums is not None else None
+        self.checksums = checksums.lane() if self.algorithm else None
+        self.stats = radiam_stats.stats.project(self.project_config['name'])
+        self.estimate_samples = int(config['agent'].get('stats_samples', 20))
+        scheduler.add(project_key, float(self.project_config.get("crawl_weight", 1)))
+
+    def flush(self):
+        """Send the current batch and checkpoint the documents the API acknowledged"""
+        self.resp_text, self.status = try_connection_in_worker_bulk(self.API, self.project_config, self.logger,
+                                                                    self.bulkdata, self.batcher, self.scheduler)
+        if self.status:
+            failed = set()
+            if isinstance(self.resp_text, list):
+                failed = set(s.get('docname') for s in self.resp_text if isinstance(s, dict) and not s.get('result'))
+            acknowledged = []
+            for path, parent in self.bulkpaths:
+                if path in failed:
+                    continue
+                acknowledged.append(path)
+                self.outstanding[parent] -= 1
+                if not self.outstanding[parent] and parent in self.scanned:
+                    self.completed.append(parent)
+            self.checkpoint.acknowledge(acknowledged, self.completed)
+            self.stats.acknowledged += len(acknowledged)
+            self.record(self.completed)
+            self.completed = []
+            self.complete_units()
+        else:
+            self.stats.error(self.resp_text)
+        self.bulkdata = []
+        self.bulkpaths = []
+        self.bulksize = 1
 
-    while True:
+    def post(self, metadata):
+        if not metadata:
+            return
+        radiam_metrics.crawl_entries.inc(self.project_config['name'], metadata.get("type"))
+        if metadata.get("type") == "file":
+            self.stats.files += 1
+            self.stats.bytes += metadata.get("filesize") or 0
+        else:
+            self.stats.directories += 1
+        apply_payload_policy(metadata, self.project_config)
+        # documents are encoded once and kept as bytes until streamed out
+        with radiam_profile.stage("encode"):
+            encoded = encode_document(metadata)
+        metasize = len(encoded) + 1
+        if self.bulkdata and self.batcher.full(metasize + self.bulksize, len(self.bulkdata) + 1):
+            self.flush()
+        self.bulkdata.append(encoded)
+        self.bulkpaths.append((metadata['path'], metadata['path_parent']))
+        self.bulksize += metasize
+
+    def stage(self, metadata):
+        # a checksummed file record goes on to extraction if it still needs it, otherwise it is posted
+        if metadata and self.enricher is not None and "extended_metadata" not in metadata:
+            # submitting waits while the extraction pipeline is full
+            with radiam_profile.stage("pipeline wait"):
+                self.submit(metadata)
+        else:
+            self.post(metadata)
+
+    def emit(self, path, metadata):
+        if metadata:
+            self.outstanding[path] = self.outstanding.get(path, 0) + 1
+        return metadata
+
+    def scan(self, path):
+        """Index the entries of one directory, queueing its subdirectories, and return how many there were"""
+        entries = 0
+        resumed = path in self.resumed
+        # in an incremental crawl, what the directory held last time and what it holds now, by name
+        recorded = listing = None
+        if self.state is not None:
+            try:
+                with radiam_profile.stage("lstat"):
+                    mtime_ns = throttled(os.lstat, path).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            known, recorded_mtime = self.state.directory(path)
+            if known and mtime_ns is not None and recorded_mtime == mtime_ns and not self.state.verifying:
+                return self.walk_unchanged(path)
+            if known and recorded_mtime != mtime_ns and path != self.rootdir:
+                self.post(self.emit(os.path.dirname(path), get_dir_meta(path, self.config, self.project_key)))
+            recorded = self.state.entries(path)
+            listing = {}
         try:
-            # start at the base directory
-            file_list_all = []
-            for project_key in config['projects']['project_list']:
-                q_dir.put(config[project_key]['rootdir'])
-                files = []
-                # file_list, resp_text, status = worker(API, q_dir, files, config, project_key, logger)
-                bulkdata = []
-                bulksize = 0
-
-                while True:
-                    try:
-                        path = q_dir.get_nowait()
-                        try:
-                            for entry in scandir(path):
-                                if entry.is_dir(follow_symlinks=False):
-                                    if not dir_excluded(os.path.join(path, entry.name), config[project_key]):
-                                        q_dir.put(os.path.join(path, entry.name))
-                                        metadata = get_dir_meta(os.path.join(path, entry.name), config, project_key)
-                                        bulkdata, bulksiz, eresp_text, status = post_data(metadata, files, entry,
-                                                                                          bulksize, bulkdata)
-                                elif entry.is_file(follow_symlinks=False):
-                                    metadata = get_file_meta(os.path.join(path, entry.name), config, project_key)
-                                    bulkdata, bulksize, resp_text, status = post_data(metadata, files, entry, bulksize,
-                                                                                      bulkdata)
-
-                        except (PermissionError, OSError) as e:
-                            logger.warning(e)
-                            pass
-                        q_dir.task_done()
-                    except persistqueue.exceptions.Empty:
+            with radiam_profile.stage("scandir"):
+                listed = throttled(list, scandir(path))
+            for entry in listed:
+                entries += 1
+                entry_path = os.path.join(path, entry.name)
+                if listing is not None and entry.name in recorded:
+                    # names seen but not indexed keep their old record, so they are not taken for deleted
+                    listing[entry.name] = recorded[entry.name]
+                if resumed and self.checkpoint.is_sent(entry_path):
+                    if entry.is_dir(follow_symlinks=False) and not self.checkpoint.is_done(entry_path) \
+                            and self.checkpoint.queue(entry_path):
+                        self.directories.append(entry_path)
+                        radiam_metrics.queue_depth.inc("directories")
+                    if listing is not None:
+                        listing[entry.name] = None if entry.is_dir(follow_symlinks=False) \
+                            else stat_key(entry.stat(follow_symlinks=False))
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    with radiam_profile.stage("exclude"):
+                        excluded = dir_excluded(entry_path, self.project_config)
+                    if not excluded:
+                        if entry_path not in self.units and self.checkpoint.queue(entry_path):
+                            self.directories.append(entry_path)
+                            radiam_metrics.queue_depth.inc("directories")
+                        if recorded is None or entry.name not in recorded:
+                            self.post(self.emit(path, get_dir_meta(entry_path, self.config, self.project_key)))
+                        if listing is not None:
+                            listing[entry.name] = None
+                elif entry.is_file(follow_symlinks=False) and entry_path not in self.ignored:
+                    if listing is not None:
+                        with radiam_profile.stage("lstat"):
+                            key = stat_key(entry.stat(follow_symlinks=False))
+                        if recorded.get(entry.name) == key:
+                            continue
+                    metadata = self.emit(path, get_file_meta(entry_path, self.config, self.project_key,
+                                                             extended=self.enricher is None,
+                                                             checksum=self.algorithm is None))
+                    # a file skipped for its age or size is looked at again, as it may qualify without changing
+                    if listing is not None and (metadata or metadata is None and
+                                                (file_excluded(entry_path, self.project_config) or yml_file(entry_path))):
+                        listing[entry.name] = key
+                    if metadata and self.algorithm and "checksum" not in metadata:
+                        with radiam_profile.stage("pipeline wait"):
+                            self.checksums.submit(metadata, self.algorithm)
+                    else:
+                        self.stage(metadata)
+        except (PermissionError, OSError) as e:
+            self.logger.warning(e)
+            # a directory that could not be listed in full is listed again next time
+            listing = None
+        if listing is not None:
+            for name in set(recorded) - set(listing):
+                self.remove(os.path.join(path, name), recorded[name] is None)
+            self.listings[path] = (mtime_ns, listing)
+        self.scanned.add(path)
+        if not self.outstanding.get(path):
+            self.completed.append(path)
+        return entries
+
+    def walk_unchanged(self, path):
+        # nothing was added to or removed from the directory, so its subdirectories are the recorded ones
+        for subdir in self.state.subdirectories(path):
+            if not dir_excluded(subdir, self.project_config) and subdir not in self.units \
+                    and self.checkpoint.queue(subdir):
+                self.directories.append(subdir)
+                radiam_metrics.queue_depth.inc("directories")
+        self.scanned.add(path)
+        if not self.outstanding.get(path):
+            self.completed.append(path)
+        return 1
+
+    def remove(self, path, directory):
+        """Queue the deletion of the documents of an entry that is gone, and of everything recorded below it"""
+        parent = os.path.dirname(path)
+        gone = [path] + (self.state.below(path) if directory else [])
+        if self.deleter is None:
+            self.deleter = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # the directory is not recorded until its deletions are through, like its documents
+        self.outstanding[parent] = self.outstanding.get(parent, 0) + 1
+        self.deletes.append((self.deleter.submit(self.delete, gone), parent, path, directory, gone))
+
+    def delete(self, gone):
+        return all(try_connection_in_worker(self.API, self.project_config, gone_path, self.logger, scheduler=self.scheduler)
+                   for gone_path in gone)
+
+    def collect_deletes(self, wait=False):
+        pending = []
+        for future, parent, path, directory, gone in self.deletes:
+            if not wait and not future.done():
+                pending.append((future, parent, path, directory, gone))
+                continue
+            try:
+                deleted = future.result()
+            except Exception as e:
+                self.logger.debug("Deleting %s failed: %s", path, e)
+                deleted = False
+            if deleted:
+                if directory:
+                    self.state.forget(path)
+                self.deleted.extend(gone)
+                if directory:
+                    self.logger.info("Deleted %s and %s entries below it from Project %s", path, len(gone) - 1,
+                                     self.project_config['name'])
+                else:
+                    self.logger.info("Deleted %s from Project %s", path, self.project_config['name'])
+            else:
+                # leaving the directory unrecorded has the next crawl find the entry gone again
+                self.listings.pop(parent, None)
+                self.logger.warning("Unable to delete %s from Project %s; it is retried on the next crawl", path,
+                                    self.project_config['name'])
+            self.outstanding[parent] -= 1
+            if not self.outstanding[parent] and parent in self.scanned:
+                self.completed.append(parent)
+        self.deletes = pending
+
+    def record(self, paths):
+        """Record the listings of directories whose documents have all been acknowledged in the state"""
+        if self.state is None:
+            return
+        for path in paths:
+            listing = self.listings.pop(path, None)
+            if listing is not None:
+                self.state.record(path, *listing)
+        self.state.commit()
+
+    def collect(self, wait=False):
+        """Post the records the checksum and extraction stages have finished with, and settle the deletions"""
+        if self.deletes:
+            self.collect_deletes(wait)
+        if self.checksums is not None:
+            with radiam_profile.stage("pipeline wait"):
+                done = self.checksums.drain() if wait else self.checksums.completed()
+            for metadata in done:
+                self.stage(metadata)
+        if self.enricher is not None:
+            with radiam_profile.stage("pipeline wait"):
+                done = self.enricher.drain() if wait else self.enricher.completed()
+            for metadata in done:
+                self.post(metadata)
+
+    def crawl_directories(self):
+        while self.directories:
+            with radiam_profile.stage("worker wait"):
+                self.scheduler.acquire(self.project_key)
+            entries = 0
+            try:
+                while self.directories and entries < self.slice_entries:
+                    radiam_metrics.queue_depth.inc("directories", amount=-1)
+                    entries += 1 + self.scan(self.directories.popleft())
+                    self.collect()
+                    self.stats.dirs_done += 1
+                    self.stats.dirs_queued = len(self.directories)
+                    self.stats.pending = len(self.bulkdata)
+                    if self.shards is not None and len(self.directories) > 1 and self.shards.wanted():
+                        self.share()
+                    if self.scheduler.urgent(self.project_key) or self.scheduler.paused or self.scheduler.cancelled:
+                        # a file system event is waiting for a worker, or the crawl is to stop
                         break
-                if bulkdata is None or type(bulkdata) is list and len(bulkdata) == 0:
-                    logger.info("No files to index on Project %s", config[project_key]['name'])
-                    log_full_run_filelist(dirs, files, config[project_key]['name'])
-                    logger.info("Agent has added %s files to Project %s", len(files), config[project_key]['name'])
-                    return None, 200
+            finally:
+                self.scheduler.release(self.project_key, entries)
+
+    def share(self):
+        # the most recently found directories go, as the oldest ones are already being worked through
+        donated = [self.directories.pop() for i in range(len(self.directories) // 2)]
+        radiam_metrics.queue_depth.inc("directories", amount=-len(donated))
+        self.shards.split(donated)
+        self.units.update(donated)
+        # they are the other agents' to finish now
+        self.checkpoint.acknowledge([], donated)
+        self.logger.debug("Gave %s directories of Project %s to other agents", len(donated), self.project_config['name'])
+
+    def crawl_shards(self):
+        rootdir = os.path.abspath(self.project_config['rootdir'])
+        try:
+            top = [os.path.join(rootdir, entry.name) for entry in scandir(rootdir)
+                   if entry.is_dir(follow_symlinks=False) and not dir_excluded(os.path.join(rootdir, entry.name),
+                                                                               self.project_config)]
+        except OSError as e:
+            self.logger.warning(e)
+            top = []
+        if self.shards.seed(rootdir, top):
+            self.logger.info("Started a sharded crawl of Project %s", self.project_config['name'])
+        while True:
+            unit = self.shards.claim(wait=False)
+            if unit is False:
+                # the units waiting on this batch must be done before this agent waits on the others
+                if self.bulkdata:
+                    self.flush()
+                unit = self.shards.claim()
+            if unit is None:
+                break
+            self.units = self.shards.units()
+            self.units.discard(unit)
+            self.checkpoint.queue(unit)
+            self.directories.append(unit)
+            radiam_metrics.queue_depth.inc("directories")
+            self.crawl_directories()
+            # the unit is done once all its documents are in a batch the API acknowledges
+            self.collect(wait=True)
+            self.finished_units.append(unit)
+            if not self.bulkdata:
+                self.complete_units()
+
+    def complete_units(self):
+        if self.shards is not None and self.finished_units:
+            self.shards.complete(self.finished_units)
+            self.finished_units = []
+
+    def crawl(self):
+        self.stats.start(self.state is not None)
+        if self.shards is not None:
+            self.crawl_shards()
+            return
+        resumed = self.checkpoint.resume()
+        if resumed:
+            self.logger.info("Resuming the crawl of Project %s with %s directories left",
+                             self.project_config['name'], len(resumed))
+            self.resumed = set(resumed)
+            self.directories.extend(resumed)
+        else:
+            rootdir = os.path.abspath(self.project_config['rootdir'])
+            self.checkpoint.queue(rootdir)
+            self.directories.append(rootdir)
+            if self.estimate_samples > 0:
+                # a resumed crawl would be compared with the whole tree, so only a fresh one gets an ETA
+                radiam_stats.start_estimate(self.stats, rootdir, self.estimate_samples,
+                                            lambda path: throttled(list, scandir(path)),
+                                            lambda path: dir_excluded(path, self.project_config))
+        radiam_metrics.queue_depth.inc("directories", amount=len(self.directories))
+        self.crawl_directories()
+        self.collect(wait=True)
+
+    def run(self):
+        """Crawl the project and return the (resp_text, status) of its last bulk upload"""
+        name = self.project_config['name']
+        try:
+            self.crawl()
+            if not self.bulkdata:
+                self.logger.info("No %s to index on Project %s", "files" if self.state is None else "changes", name)
+                self.checkpoint.acknowledge([], self.completed)
+                self.record(self.completed)
+                self.complete_units()
+                self.resp_text, self.status = None, True
+            else:
+                self.flush()
+                if self.status:
+                    self.logger.info("Finished indexing files to Project %s", name)
+            if self.status:
+                files = self.checkpoint.acknowledged()
+                if self.state is not None:
+                    self.logger.info("Agent has updated %s and deleted %s entries in Project %s", len(files),
+                                     len(self.deleted), name)
+                    # the unchanged entries were left out of the crawl, but not out of the index
+                    files = list((set(saved_list_last_crawl(self.config, self.project_key)) | set(files)) -
+                                 set(self.deleted))
                 else:
-                    resp_text, status = try_connection_in_worker_bulk(API, config[project_key], logger, bulkdata)
-
-                if status:
-                    # file_list_all += files
-                    logger.info("Finished indexing files to Project %s", config[project_key]['name'])
-                    log_full_run_filelist(dirs, files, config[project_key]['name'])
-                    logger.info("Agent has added %s files to Project %s", len(files), config[project_key]['name'])
+                    self.logger.info("Agent has added %s files to Project %s", len(files), name)
+                log_full_run_filelist(dirs, files, name)
+                left = self.checkpoint.resume()
+                if left:
+                    # documents the API turned down are sent again from these directories next time
+                    self.logger.warning("%s directories of Project %s were not fully indexed", len(left), name)
                 else:
-                    return resp_text, status
-            return resp_text, status
-        except exceptions.ConnectionError:
-            time.sleep(10)
-            pass
+                    self.checkpoint.finish()
+                    if self.state is not None:
+                        self.state.finish()
+            return self.resp_text, self.status
+        finally:
+            self.stats.finish(self.status, self.scheduler.cancelled)
+            if self.state is not None:
+                self.state.close()
+            if self.tika_pool is not None:
+                self.tika_pool.close()
+            if self.deleter is not None:
+                self.deleter.shutdown()
+            if self.shards is not None:
+                self.shards.close()
+            self.checkpoint.close()
+            self.scheduler.remove(self.project_key)
+
+
+def open_checkpoint(config, project_key):
+    rootdir = os.path.abspath(config[project_key]['rootdir'])
+    # a sharded crawl keeps its progress in the shared shard database instead
+    if config['agent'].get('crawl_checkpoint', 'enabled') == 'disabled' or config[project_key].get('shard_db'):
+        return CrawlCheckpoint(":memory:", rootdir)
+    return CrawlCheckpoint(os.path.join(dirs.user_data_dir, "checkpoint_%s.db" % config[project_key]['name']), rootdir)
+
+
+def open_state(config, project_key, logger):
+    if config[project_key].get('shard_db'):
+        logger.warning("Project %s is crawled in shards, which is never incremental", config[project_key]['name'])
+        return None
+    return CrawlState(os.path.join(dirs.user_data_dir, "state_%s.db" % config[project_key]['name']),
+                      os.path.abspath(config[project_key]['rootdir']),
+                      float(config['agent'].get('rescan_verify_days', 7)) * 86400)
+
+
+def open_shards(config, project_key):
+    if not config[project_key].get('shard_db'):
+        return None
+    return ShardCoordinator(config[project_key]['shard_db'], shard_owner(config['agent']['id']),
+                            float(config[project_key].get('shard_lease', 300)))
+
+
+def open_scheduler(config):
+    return FairScheduler(int(config['agent'].get('crawl_workers', 4)))
+
+
+def full_run(API, config, logger, scheduler=None, incremental=False):
+    """Crawl every project at once, as one CrawlJob each, and return the (resp_text, status) of the first
+    project whose upload failed, or of the last one if none did. The crawl workers come from scheduler,
+    if given, so that the monitor can share them. An incremental crawl uploads only what changed since
+    the last incremental crawl of each project, and is a full crawl the first time."""
+    batcher = BatchController.from_config(config['agent'], logger, post_data_limit)
+    cache = open_extraction_cache(config)
+    enricher = open_enricher(config, logger)
+    checksums = open_checksummer(config, logger)
+    open_stat_throttle(config, logger)
+    project_list = config['projects']['project_list']
+    scheduler = scheduler or open_scheduler(config)
+    slice_entries = int(config['agent'].get('crawl_slice', 1000))
+    profiling = config['agent'].get('profile', 'disabled') == 'enabled'
+    if profiling:
+        capture = config['agent'].get('profile_capture', 'none')
+        radiam_profile.start(capture if capture != 'none' else None, float(config['agent'].get('profile_window', 60)))
+
+    def run_job(project_key):
+        # thread_name_prefix is new in Python 3.6
+        threading.current_thread().name = "radiam-crawl-" + config[project_key]['name']
+        while True:
+            try:
+                with radiam_profile.thread():
+                    return CrawlJob(API, config, project_key, logger, scheduler, batcher, open_checkpoint(config, project_key),
+                                    cache, enricher, checksums, slice_entries, open_shards(config, project_key),
+                                    open_state(config, project_key, logger) if incremental else None).run()
+            except exceptions.ConnectionError:
+                retry_wait(scheduler)
+
+    try:
+        # the scheduler limits how many jobs scan at once; each job only needs a thread to wait on
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(project_list))) as jobs:
+            results = [jobs.submit(run_job, project_key) for project_key in project_list]
+            results = [result.result() for result in results]
+        for resp_text, status in results:
+            if not status:
+                return resp_text, status
+        return results[-1] if results else (None, True)
+    finally:
+        if cache is not None:
+            cache.flush()
+        if checksums is not None and checksums.cache is not None:
+            checksums.cache.flush()
+        if profiling:
+            radiam_profile.finish(dirs.user_data_dir, logger)
+        try:
+            radiam_stats.stats.write()
+        except OSError as e:
+            logger.debug("Unable to write crawl stats: %s", e)
 
 
 def diff_list(first, second):
@@ -856,7 +1668,7 @@ def log_full_run_filelist(dirs, file_list, project_name):
         pickle.dump(file_list, last_crawl)
 
 
-def check_last_crawl_list(API, dirs, config, logger):
+def check_last_crawl_list(API, dirs, config, logger, scheduler=None):
     try:
         for project_key in config['projects']['project_list']:
             curlist = get_list_of_files(config[project_key]['rootdir'], config[project_key])
@@ -867,47 +1679,135 @@ def check_last_crawl_list(API, dirs, config, logger):
                     for d_path in deletes:
                         # for X in delete, post deletes for files that are missing
                         try:
-                            try_connection_in_worker(API, config[project_key], d_path, logger)
+                            try_connection_in_worker(API, config[project_key], d_path, logger, scheduler=scheduler)
                             logger.info("%s is deleted" % d_path)
+                        except Cancelled:
+                            raise
                         except:
                             pass
                     return False
         return True
+    except Cancelled:
+        raise
     except:
         return False
 
 
+def crawl_interrupted(config):
+    """Return True if a crawl of any project stopped with directories still pending in its checkpoint"""
+    for project_key in config['projects']['project_list']:
+        checkpoint = open_checkpoint(config, project_key)
+        try:
+            if checkpoint.resume():
+                return True
+        finally:
+            checkpoint.close()
+    return False
+
+
 def load_list_last_crawl(config, project_key):
     with open(os.path.join(dirs.user_data_dir, "last_crawl_%s.data" % config[project_key]['name']), "rb") as last_crawl:
         lastcrawl_list = pickle.load(last_crawl)
     return lastcrawl_list
 
 
-def backend_monitor(API, config, logger):
-    logger.info("Start backend monitor")
+def saved_list_last_crawl(config, project_key):
+    try:
+        return load_list_last_crawl(config, project_key)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        # no crawl of the project has finished yet
+        return []
+
+
+def start_monitor(API, config, logger, scheduler=None):
+    """Start watching every project's rootdir, and return the observer and the event handler of each project"""
+    open_extraction_cache(config)
+    open_enricher(config, logger)
+    open_checksummer(config, logger)
+    open_stat_throttle(config, logger)
+    # the observers load the platform's file system notification machinery, so they wait until they are needed
     if platform.system() == 'Windows':
+        from watchdog.observers.polling import PollingObserver
         observer = PollingObserver()
     else:
+        from watchdog.observers import Observer
         observer = Observer()
+    handlers = {}
     for project_key in config['projects']['project_list']:
-        event_handler = FileSystemMonitor(API, config, project_key, logger, load_list_last_crawl(config, project_key))
-        list_last_crawl = load_list_last_crawl(config, project_key)
-        observer.schedule(event_handler, config[project_key]['rootdir'], recursive=True)
+        handlers[project_key] = FileSystemMonitor(API, config, project_key, logger,
+                                                  saved_list_last_crawl(config, project_key), scheduler)
+        observer.schedule(handlers[project_key], config[project_key]['rootdir'], recursive=True)
     observer.start()
+    return observer, handlers
+
+
+def backend_monitor(API, config, logger, observer=None, handlers=None, scheduler=None):
+    """Index file system events until scheduler is cancelled"""
+    logger.info("Start backend monitor")
+    scheduler = scheduler or open_scheduler(config)
+    if observer is None:
+        observer, handlers = start_monitor(API, config, logger, scheduler)
+    list_last_crawl = dict((project_key, set(saved_list_last_crawl(config, project_key))) for project_key in handlers)
+    for handler in handlers.values():
+        handler.stats.state = "monitoring"
     try:
-        while True:
-            # check the consistency between list_last_crawl and the current list in event_handler every 30s
-            time.sleep(30)
-            for project_key in config['projects']['project_list']:
-                if set(list_last_crawl) != event_handler.set_last_crawl:
-                    log_full_run_filelist(dirs, list(event_handler.set_last_crawl), config[project_key]['name'])
-                    list_last_crawl = load_list_last_crawl(config, project_key)
+        # check the consistency between list_last_crawl and the current list in each event handler every 30s
+        while not scheduler.wait(30):
+            for project_key, handler in handlers.items():
+                if list_last_crawl[project_key] != handler.set_last_crawl:
+                    list_last_crawl[project_key] = set(handler.set_last_crawl)
+                    log_full_run_filelist(dirs, list(list_last_crawl[project_key]), config[project_key]['name'])
     except KeyboardInterrupt:
-        observer.stop()
+        pass
+    observer.stop()
     observer.join()
+    for handler in handlers.values():
+        handler.stats.state = "stopped"
     return
 
 
+def rescan_loop(API, config, logger, scheduler, interval, started):
+    """Rescan every project for changes every interval seconds from started, for good"""
+    logger.info("Rescanning for changes every %s seconds", interval)
+    while True:
+        started += interval
+        if scheduler.wait(max(0, started - time.time())):
+            return
+        if time.time() - started > interval:
+            # the last rescan overran; start the schedule again from now
+            started = time.time()
+        logger.info('Start incremental rescan...')
+        resp_text, status = full_run(API, config, logger, scheduler, incremental=True)
+        if not status:
+            logger.warning("Incremental rescan failed: %s", resp_text)
+
+
+def start_metrics(config, logger):
+    global metrics_started
+    if metrics_started:
+        return
+    metrics_started = True
+    if config['agent'].get('metrics_port'):
+        try:
+            radiam_metrics.start_http_server(int(config['agent']['metrics_port']))
+            logger.info("Serving agent metrics on http://127.0.0.1:%s/metrics", config['agent']['metrics_port'])
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to serve agent metrics: %s", e)
+    if config['agent'].get('metrics_log_interval'):
+        radiam_metrics.start_log_dump(float(config['agent']['metrics_log_interval']), logger)
+    radiam_stats.watch(logger)
+    stats_interval = float(config['agent'].get('stats_interval', 5))
+    if stats_interval > 0:
+        radiam_stats.stats.start_writer(statsfile, stats_interval, logger)
+
+
+def current_stats():
+    """Return the progress of this process's crawl, or failing that the last one written by an agent process"""
+    if radiam_stats.stats.projects:
+        return radiam_stats.stats.snapshot()
+    return radiam_stats.read(statsfile)
+
+
 def check_api_status(API, project_config):
     if API.api_get_statusCode(project_config['endpoint'] + "docs/") == 200:
         return True
@@ -915,7 +1815,29 @@ def check_api_status(API, project_config):
         return False
 
 
-def crawl(dirs, arguments, logger, config, API, tray_options):
+def save_last_crawl_lists(config, logger):
+    for project_key in config['projects']['project_list']:
+        cur_list = get_list_of_files(config[project_key]["rootdir"], config[project_key])
+        log_full_run_filelist(dirs, cur_list, config[project_key]['name'])
+        logger.info("Save last_crawl_%s.data" % config[project_key]['name'])
+
+
+def install_exit_handlers(config, logger):
+    """Save the file lists and exit on SIGTERM and SIGINT; only for the command line, which owns the process"""
+    def handle_exit(*args):
+        save_last_crawl_lists(config, logger)
+        return sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_exit)
+    signal.signal(signal.SIGINT, handle_exit)
+
+
+def crawl(dirs, arguments, logger, config, API, tray_options, scheduler=None):
+    """Crawl every project and then monitor them, unless --quitafter is given, and return an error message or None.
+
+    The crawl and monitor run until scheduler, if given, is cancelled, and
+    stop where they are while it is paused.
+    """
     if arguments['--username'] is None or arguments['--password'] is None:
         if API.load_auth_from_file():
             logger.info('Loaded tokens from file')
@@ -934,44 +1856,59 @@ def crawl(dirs, arguments, logger, config, API, tray_options):
 
     if not checkin_status:
         logger.error(err_message)
-        if not tray_options:
-            sys.exit()
         return err_message
 
-    queue_on_disk = os.path.join(dirs.user_data_dir, "radiam_queue")
-    q_dir = Queue(queue_on_disk)
+    start_metrics(config, logger)
+    scheduler = scheduler or open_scheduler(config)
 
-    def handle_exit(*args):
-        for project_key in config['projects']['project_list']:
-            cur_list = get_list_of_files(config[project_key]["rootdir"], config[project_key])
-            log_full_run_filelist(dirs, cur_list, config[project_key]['name'])
-            logger.info("Save last_crawl_%s.data" % config[project_key]['name'])
-        return sys.exit(0)
+    # rescanning for changes on a schedule stands in for the monitor where it cannot watch the storage
+    rescan_interval = float(config['agent'].get('rescan_interval') or 0)
+    incremental = arguments.get('--incremental') or rescan_interval > 0
 
     def start_process():
+        observer = None
+        if not arguments['--quitafter'] and not rescan_interval:
+            # files changed during the crawl are indexed as they change, ahead of the crawl
+            observer, handlers = start_monitor(API, config, logger, scheduler)
         logger.info('Start crawling...')
-        resp_text, status = full_run(API, q_dir, config, logger)
-        if not arguments['--quitafter']:
+        started = time.time()
+        try:
+            resp_text, status = full_run(API, config, logger, scheduler, incremental)
+        except Cancelled:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            raise
+        if rescan_interval and not arguments['--quitafter']:
+            if not status:
+                return resp_text
+            rescan_loop(API, config, logger, scheduler, rescan_interval, started)
+        if observer is not None:
             if status:
-                backend_monitor(API, config, logger)
+                for project_key, handler in handlers.items():
+                    handler.rebase(saved_list_last_crawl(config, project_key))
+                backend_monitor(API, config, logger, observer, handlers, scheduler)
             else:
+                observer.stop()
+                observer.join()
                 return resp_text
 
-    signal.signal(signal.SIGTERM, handle_exit)
-    signal.signal(signal.SIGINT, handle_exit)
-
     project_endpoints_ok = True
     for pro_key in config['projects']['project_list']:
         project_endpoints_ok *= check_api_status(API, config[pro_key])
 
-    if project_endpoints_ok:
-        if check_last_crawl_list(API, dirs, config, logger):
-            if not arguments['--quitafter']:
-                backend_monitor(API, config, logger)
-        else:
-            start_process()
-    else:
-        start_process()
+    try:
+        # the exit handlers save the file list of a crawl that was stopped, so its checkpoint is what tells
+        if project_endpoints_ok and not incremental and not crawl_interrupted(config):
+            if check_last_crawl_list(API, dirs, config, logger, scheduler):
+                if not arguments['--quitafter']:
+                    backend_monitor(API, config, logger, scheduler=scheduler)
+                return None
+        return start_process()
+    except Cancelled:
+        # what was acknowledged is checkpointed, so the next crawl carries on from there
+        logger.info("Crawl cancelled")
+        return None
 
 
 if __name__ == "__main__":
@@ -982,6 +1919,9 @@ if __name__ == "__main__":
         os.remove(tokenfile)
         print("Removed old auth tokens. Exiting.")
         sys.exit()
+    if arguments['--stats']:
+        print(radiam_stats.format_snapshot(radiam_stats.read(statsfile)))
+        sys.exit()
     if arguments['--rootdir'] and isinstance(arguments['--rootdir'], (list,)):
         arguments['--rootdir'] = arguments['--rootdir'][0]
     logLevel = "info"
@@ -1005,11 +1945,13 @@ if __name__ == "__main__":
     agent_config = {
         "tokenfile": tokenfile,
         "baseurl": config['api']['host'],
+        "compression": config['api'].get('compression'),
         "logger": logger
     }
     logger.debug("Agent will use Radiam API at: " + config['api']['host'])
     API = RadiamAPI(**agent_config)
     logger.debug("Starting file system crawl")
+    install_exit_handlers(config, logger)
     crawlout = crawl(dirs, arguments, logger, config, API, tray_options)
     if crawlout is not None:
         print(crawlout)
@@ -3,7 +3,49 @@ import platform
 import json
 import time
 import os
+import threading
 import urllib
+import zlib
+import radiam_metrics
+
+
+def encode_document(document):
+    """Serialize a bulk document once so batches can hold compact bytes"""
+    if isinstance(document, bytes):
+        return document
+    return json.dumps(document).encode('utf-8')
+
+
+def iter_bulk_body(documents, chunk_size=65536):
+    """Yield a JSON array of pre-encoded documents in chunks of about chunk_size bytes"""
+    buf = bytearray(b"[")
+    first = True
+    for document in documents:
+        if not first:
+            buf += b","
+        buf += encode_document(document)
+        first = False
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf = bytearray()
+    buf += b"]"
+    yield bytes(buf)
+
+
+def count_stream(chunks, endpoint):
+    for chunk in chunks:
+        radiam_metrics.api_bytes_sent.inc(endpoint, amount=len(chunk))
+        yield chunk
+
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
 
 class RadiamAPI(object):
     def __init__(self, **kwargs):
@@ -15,6 +57,11 @@ class RadiamAPI(object):
             "Accept": "application/json"
         }
         self.authtokens = {}
+        self.compression = None
+        self.stream_chunk_size = 65536
+        # crawl jobs post from several threads, so each keeps its own last status
+        self.local = threading.local()
+        self.last_status_code = None
         for key, value in kwargs.items():
             setattr(self, key, value)
         if self.baseurl:
@@ -31,6 +78,34 @@ class RadiamAPI(object):
                 "useragents": self.baseurl + "/api/useragents/"
             }
 
+    @property
+    def last_status_code(self):
+        """The status code of the last bulk request made by the calling thread"""
+        return getattr(self.local, "last_status_code", None)
+
+    @last_status_code.setter
+    def last_status_code(self, value):
+        self.local.last_status_code = value
+
+    def send(self, method, url, **kwargs):
+        """Make an HTTP request to the API, recording it in the agent metrics"""
+        endpoint = radiam_metrics.endpoint_label(url)
+        data = kwargs.get("data")
+        if isinstance(data, (str, bytes)):
+            radiam_metrics.api_bytes_sent.inc(endpoint, amount=len(data))
+        elif data is not None:
+            kwargs["data"] = count_stream(data, endpoint)
+        start = time.time()
+        try:
+            resp = requests.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            radiam_metrics.api_requests.inc(endpoint, method, "error")
+            raise
+        radiam_metrics.api_latency.observe(time.time() - start, endpoint, method)
+        # label values are strings, like the "error" of a request that got no response
+        radiam_metrics.api_requests.inc(endpoint, method, str(resp.status_code))
+        return resp
+
     def setLogger(self, logger):
         self.logger = logger
 
@@ -56,7 +131,7 @@ class RadiamAPI(object):
     def login(self, username, password):
         body = {"username":username, "password":password}
         try:
-            resp = requests.post(self.endpoints.get("login"),
+            resp = self.send("POST", self.endpoints.get("login"),
                 data=json.dumps(body), headers=self.headers
                 )
         except:
@@ -76,7 +151,7 @@ class RadiamAPI(object):
 
     def refresh_token(self):
         body = { "refresh" : self.authtokens.get("refresh") }
-        resp = requests.post(self.endpoints.get("refresh"),
+        resp = self.send("POST", self.endpoints.get("refresh"),
                 data=json.dumps(body), headers=self.headers
                 )
         if resp.status_code != 200:
@@ -93,10 +168,11 @@ class RadiamAPI(object):
             return None
         get_headers = self.headers
         get_headers["Authorization"] = "Bearer " + self.authtokens.get("access")
-        resp = requests.get(url, headers=get_headers)
+        resp = self.send("GET", url, headers=get_headers)
         if resp.status_code == 403:
             response_json = json.loads(resp.text)
             if response_json["code"] == "token_not_valid":
+                radiam_metrics.api_retries.inc("token_refresh")
                 self.refresh_token()
                 self.write_auth_to_file()
                 return self.api_get(url=url, retries=retries - 1)
@@ -106,9 +182,10 @@ class RadiamAPI(object):
             return json.loads(resp.text)
         elif resp.status_code == 429:
             # untested until ADM-562 is resolved
+            radiam_metrics.api_retries.inc("rate_limited")
             response_json = json.loads(resp.text)
             time.sleep(int(response_json.get("retry-after", "3")) + 1)
-            self.api_get(url, retries=1)
+            return self.api_get(url, retries=1)
         else:
             self.log("Radiam API error while getting from: {} with code {} and error {} \n".format(url, resp.status_code, resp.text))
             return None
@@ -119,10 +196,11 @@ class RadiamAPI(object):
             return None
         post_headers = self.headers
         post_headers["Authorization"] = "Bearer " + self.authtokens.get("access")
-        resp = requests.post(url, headers=post_headers, data=body)
+        resp = self.send("POST", url, headers=post_headers, data=body)
         if resp.status_code == 403:
             response_json = json.loads(resp.text)
             if "code" in response_json and response_json["code"] == "token_not_valid":
+                radiam_metrics.api_retries.inc("token_refresh")
                 self.refresh_token()
                 self.write_auth_to_file()
                 return self.api_post(url=url, body=body, retries=retries - 1)
@@ -133,31 +211,47 @@ class RadiamAPI(object):
             return json.loads(resp.text)
         elif resp.status_code == 429:
             # untested until ADM-562 is resolved
+            radiam_metrics.api_retries.inc("rate_limited")
             response_json = json.loads(resp.text)
             time.sleep(int(response_json.get("retry-after", "3")) + 1)
-            self.api_post(url, body, retries=1)
+            return self.api_post(url, body, retries=1)
         else:
             self.log("Radiam API error {}:\n{}\n".format(resp.status_code, resp.text))
             return None
 
     def api_post_bulk(self, url, body, retries=1):
+        # body is a list of documents (dicts or pre-encoded bytes); it is
+        # streamed with chunked transfer encoding so only a small buffer of
+        # the serialized request is held in memory at any time
         if retries <= 0:
             self.log("Ran out of retries to connect to Radiam API")
             return None, False
-        post_headers = self.headers
+        post_headers = dict(self.headers)
         post_headers["Authorization"] = "Bearer " + self.authtokens.get("access")
-        resp = requests.post(url, headers=post_headers, json=body)
+        data = iter_bulk_body(body, self.stream_chunk_size)
+        if self.compression == "gzip":
+            post_headers["Content-Encoding"] = "gzip"
+            data = gzip_stream(data)
+        resp = self.send("POST", url, headers=post_headers, data=data)
+        self.last_status_code = resp.status_code
         if resp.status_code == 403:
             response_json = json.loads(resp.text)
             if response_json["code"] == "token_not_valid":
+                radiam_metrics.api_retries.inc("token_refresh")
                 self.refresh_token()
                 self.write_auth_to_file()
                 return self.api_post_bulk(url=url, body=body, retries=retries - 1)
             else:
                 self.log("Unauthorized request {}:\n{}\n".format(resp.status_code, resp.text))
+                return resp.text, False
         elif resp.status_code == 200 or resp.status_code == 201:
             # Indicates the post was successful and there is content to return
             return json.loads(resp.text), True
+        elif resp.status_code == 429:
+            radiam_metrics.api_retries.inc("rate_limited")
+            response_json = json.loads(resp.text)
+            time.sleep(int(response_json.get("retry-after", "3")) + 1)
+            return self.api_post_bulk(url, body, retries=1)
         else:
             self.log("Radiam API error {}:\n{}\n".format(resp.status_code, resp.text))
             return resp.text, False
@@ -168,10 +262,11 @@ class RadiamAPI(object):
             return None
         delete_headers = self.headers
         delete_headers["Authorization"] = "Bearer " + self.authtokens.get("access")
-        resp = requests.delete(url, headers=delete_headers)
+        resp = self.send("DELETE", url, headers=delete_headers)
         if resp.status_code == 403:
             response_json = json.loads(resp.text)
             if response_json["code"] == "token_not_valid":
+                radiam_metrics.api_retries.inc("token_refresh")
                 self.refresh_token()
                 self.write_auth_to_file()
                 return self.api_delete(url=url, retries=retries - 1)
@@ -239,7 +334,7 @@ class RadiamAPI(object):
         if type(body) is list and len(body) == 0:
             return None, False
         if isinstance(body, dict):
-            body = json.dumps(body)
+            body = [body]
         index_url += "docs/"
         return self.api_post_bulk(index_url, body)
 
@@ -296,10 +391,11 @@ class RadiamAPI(object):
             return None
         get_headers = self.headers
         get_headers["Authorization"] = "Bearer " + self.authtokens.get("access")
-        resp = requests.get(url, headers=get_headers)
+        resp = self.send("GET", url, headers=get_headers)
         if resp.status_code == 403:
             response_json = json.loads(resp.text)
             if response_json["code"] == "token_not_valid":
+                radiam_metrics.api_retries.inc("token_refresh")
                 self.refresh_token()
                 self.write_auth_to_file()
                 return self.api_get(url=url, retries=retries - 1)
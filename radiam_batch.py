@@ -0,0 +1,70 @@
+import threading
+
+
+class BatchController(object):
+    """Tune the bulk upload byte and document limits from observed API responses.
+
+    Limits grow while the API answers quickly and batches are filling up, and
+    shrink multiplicatively on slow responses, errors and 413 responses, always
+    staying between the configured floor and ceiling values.
+    """
+
+    def __init__(self, byte_limit=1000000, doc_limit=1000, min_bytes=100000, max_bytes=10000000,
+                 min_docs=10, max_docs=10000, target_latency=2.0, logger=None):
+        self.min_bytes = min_bytes
+        self.max_bytes = max(max_bytes, min_bytes)
+        self.min_docs = min_docs
+        self.max_docs = max(max_docs, min_docs)
+        self.byte_limit = self._clamp(byte_limit, self.min_bytes, self.max_bytes)
+        self.doc_limit = self._clamp(doc_limit, self.min_docs, self.max_docs)
+        self.target_latency = target_latency
+        self.error_rate = 0.0
+        self.logger = logger
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _clamp(value, low, high):
+        return int(max(low, min(high, value)))
+
+    @classmethod
+    def from_config(cls, agent_config, logger=None, byte_limit=1000000):
+        return cls(byte_limit=int(agent_config.get('batch_bytes', byte_limit)),
+                   doc_limit=int(agent_config.get('batch_docs', 1000)),
+                   min_bytes=int(agent_config.get('batch_bytes_min', 100000)),
+                   max_bytes=int(agent_config.get('batch_bytes_max', 10000000)),
+                   min_docs=int(agent_config.get('batch_docs_min', 10)),
+                   max_docs=int(agent_config.get('batch_docs_max', 10000)),
+                   target_latency=float(agent_config.get('batch_target_latency', 2.0)),
+                   logger=logger)
+
+    def full(self, nbytes, ndocs):
+        """Return True if a batch of this size would exceed the current limits"""
+        return nbytes > self.byte_limit or ndocs > self.doc_limit
+
+    def _scale(self, factor):
+        self.byte_limit = self._clamp(self.byte_limit * factor, self.min_bytes, self.max_bytes)
+        self.doc_limit = self._clamp(self.doc_limit * factor, self.min_docs, self.max_docs)
+
+    def record(self, latency, status_code, nbytes, ndocs):
+        """Record the outcome of one bulk request and adjust the limits.
+
+        latency is None and status_code is None when the request never got a
+        response (e.g. a connection error).
+        """
+        with self.lock:
+            failed = status_code is None or status_code == 429 or status_code >= 500
+            self.error_rate = 0.8 * self.error_rate + (0.2 if failed or status_code == 413 else 0.0)
+            old_bytes, old_docs = self.byte_limit, self.doc_limit
+            if status_code == 413:
+                # The server told us how big is too big; never go back above it
+                self.max_bytes = max(self.min_bytes, min(self.max_bytes, nbytes - 1))
+                self.byte_limit = self._clamp(nbytes // 2, self.min_bytes, self.max_bytes)
+            elif failed:
+                self._scale(0.5)
+            elif latency > self.target_latency:
+                self._scale(max(0.5, self.target_latency / latency))
+            elif latency < self.target_latency / 2 and self.error_rate < 0.1 and \
+                    (nbytes >= 0.8 * self.byte_limit or ndocs >= 0.8 * self.doc_limit):
+                self._scale(1.25)
+            if self.logger and (old_bytes, old_docs) != (self.byte_limit, self.doc_limit):
+                self.logger.debug("Bulk batch limits changed to {} bytes and {} documents".format(self.byte_limit, self.doc_limit))
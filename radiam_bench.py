@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmarks for the Radiam agent, run against the fake
+Radiam API in radiam_fakeapi so that no live server is needed.
+
+The micro suite times the crawler building blocks individually on a
+synthetic tree and can compare the results with a stored JSON baseline,
+exiting with status 1 if any of them regressed by more than the threshold.
+
+Usage:
+  radiam_bench.py crawl [--files=<n>] [--shape=<shape>] [--depth=<n>] [--fanout=<n>] [--latency=<s>] [--jitter=<s>] [--error-rate=<r>] [--rate-limit=<r>] [--output=<file>]
+  radiam_bench.py monitor [--events=<n>] [--crawl-files=<n>] [--latency=<s>] [--jitter=<s>] [--timeout=<s>] [--output=<file>]
+  radiam_bench.py micro [--files=<n>] [--shape=<shape>] [--depth=<n>] [--fanout=<n>] [--name-length=<n>] [--dot-dirs=<n>] [--mixed] [--seed=<n>] [--repeat=<n>] [--sample=<n>] [--baseline=<file>] [--threshold=<r>] [--save-baseline=<file>] [--output=<file>]
+  radiam_bench.py generate <dir> [--files=<n>] [--shape=<shape>] [--depth=<n>] [--fanout=<n>] [--name-length=<n>] [--dot-dirs=<n>] [--mixed] [--seed=<n>]
+
+Options:
+  --files=<n>  Number of files in the generated tree [default: 2000]
+  --shape=<shape>  Tree shape: balanced, deep or flat [default: balanced]
+  --depth=<n>  Directory levels below the root [default: 3]
+  --fanout=<n>  Subdirectories per directory in a balanced tree [default: 4]
+  --name-length=<n>  Length of generated file names [default: 12]
+  --dot-dirs=<n>  Number of excluded dot directories scattered through the tree [default: 0]
+  --mixed  Generate PDF, PNG, Office and NetCDF files for the metadata extractors
+  --seed=<n>  Random seed, so that trees are reproducible [default: 1]
+  --repeat=<n>  Runs of each micro-benchmark; the fastest is reported [default: 3]
+  --sample=<n>  Maximum number of paths fed to the per-path micro-benchmarks [default: 10000]
+  --baseline=<file>  Compare the micro-benchmarks with this baseline file
+  --threshold=<r>  Allowed slowdown against the baseline before failing (0.25 is 25%) [default: 0.25]
+  --save-baseline=<file>  Write the micro-benchmark results to this baseline file
+  --events=<n>  Number of files created while the monitor is running [default: 200]
+  --crawl-files=<n>  Files in a tree crawled, with a single crawl worker, while the events come in [default: 0]
+  --latency=<s>  Seconds added to every fake API response [default: 0]
+  --jitter=<s>  Maximum random seconds added on top of the latency [default: 0]
+  --error-rate=<r>  Fraction of fake API requests answered with a 500 error [default: 0]
+  --rate-limit=<r>  Fraction of fake API requests answered with a 429 response [default: 0]
+  --timeout=<s>  Seconds to wait for monitor events to be indexed [default: 120]
+  --output=<file>  Also write the results as JSON to this file
+"""
+
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from docopt import docopt
+import radiam
+import radiam_extract
+import radiam_metrics
+from radiam_api import RadiamAPI
+from radiam_fakeapi import FakeRadiamServer
+
+bench_project = "radiam-benchmark"
+
+
+class BenchDirs(object):
+    """Stands in for AppDirs so benchmark runs keep their state in a scratch directory"""
+
+    def __init__(self, user_data_dir):
+        self.user_data_dir = user_data_dir
+
+
+def sample_pdf(title):
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 10 10] >>",
+               b"<< /Title (" + title.encode('ascii') + b") /Author (radiam) >>"]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R /Info 4 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+def sample_png():
+    header = struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", header) + png_chunk(b"IDAT", zlib.compress(b"\x00\x00\x00\x00")) + png_chunk(b"IEND", b"")
+
+
+core_xml = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            '<dc:title>{title}</dc:title><dc:creator>radiam</dc:creator><cp:keywords>synthetic</cp:keywords>'
+            '<cp:revision>1</cp:revision></cp:coreProperties>')
+ooxml_parts = {
+    "docx": ("word/document.xml", "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml",
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body><w:p/></w:body></w:document>', None),
+    "xlsx": ("xl/workbook.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml",
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+             ("xl/worksheets/sheet1.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml",
+              '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData/></worksheet>'))
+}
+
+
+def sample_ooxml(kind, title):
+    main_name, main_type, main_xml, extra = ooxml_parts[kind]
+    overrides = [(main_name, main_type), ("docProps/core.xml", "application/vnd.openxmlformats-package.core-properties+xml")]
+    if extra:
+        overrides.append(extra[:2])
+    content_types = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                     '<Default Extension="xml" ContentType="application/xml"/>' +
+                     "".join('<Override PartName="/{}" ContentType="{}"/>'.format(n, t) for n, t in overrides) + '</Types>')
+    rels = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="{}"/>'
+            '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" Target="docProps/core.xml"/>'
+            '</Relationships>').format(main_name)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as package:
+        package.writestr("[Content_Types].xml", content_types)
+        package.writestr("_rels/.rels", rels)
+        package.writestr("docProps/core.xml", core_xml.format(title=title))
+        package.writestr(main_name, main_xml)
+        if extra:
+            package.writestr(main_name.rsplit("/", 1)[0] + "/_rels/" + main_name.rsplit("/", 1)[1] + ".rels",
+                             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                             '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                             '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+                             '</Relationships>')
+            package.writestr(extra[0], extra[2])
+    return buf.getvalue()
+
+
+def cdf_name(name):
+    data = name.encode('utf-8')
+    return struct.pack(">i", len(data)) + data + b"\x00" * (-len(data) % 4)
+
+
+def sample_netcdf(title, length=4):
+    """A NetCDF classic (CDF-1) file with one dimension, one float variable and a title attribute"""
+    title_bytes = title.encode('utf-8')
+    header = b"CDF\x01" + struct.pack(">i", 0)
+    header += struct.pack(">ii", 0x0A, 1) + cdf_name("x") + struct.pack(">i", length)
+    header += struct.pack(">ii", 0x0C, 1) + cdf_name("title") + struct.pack(">ii", 2, len(title_bytes)) + title_bytes + b"\x00" * (-len(title_bytes) % 4)
+    var = cdf_name("values") + struct.pack(">ii", 1, 0) + struct.pack(">ii", 0, 0) + struct.pack(">ii", 5, 4 * length)
+    begin = len(header) + 8 + len(var) + 4
+    header += struct.pack(">ii", 0x0B, 1) + var + struct.pack(">i", begin)
+    return header + struct.pack(">%df" % length, *range(length))
+
+
+def sample_content(extension, index):
+    title = "Synthetic {}".format(index)
+    if extension == "pdf":
+        return sample_pdf(title)
+    if extension == "png":
+        return sample_png()
+    if extension in ("docx", "xlsx"):
+        return sample_ooxml(extension, title)
+    if extension == "nc":
+        return sample_netcdf(title)
+    if extension == "csv":
+        return "index,value\n{},{}\n".format(index, index * 2).encode('utf-8')
+    return "synthetic file {}\n".format(index).encode('utf-8')
+
+
+def tree_directories(root, shape, depth, fanout):
+    if shape == "flat":
+        return [root]
+    if shape == "deep":
+        dirs = [root]
+        for level in range(depth):
+            dirs.append(os.path.join(dirs[-1], "level{:03d}".format(level)))
+        return dirs
+    dirs = [root]
+    level = [root]
+    for i in range(depth):
+        level = [os.path.join(parent, "d{:03d}".format(n)) for parent in level for n in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+
+def generate_tree(root, files=2000, shape="balanced", depth=3, fanout=4, name_length=12, dot_dirs=0, mixed=False, seed=1):
+    """Create a reproducible synthetic project tree and return (directories, files)"""
+    rng = random.Random(seed)
+    dirs = tree_directories(root, shape, depth, fanout)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    extensions = ["txt", "csv", "pdf", "png", "docx", "xlsx", "nc"] if mixed else ["dat"]
+    letters = "abcdefghijklmnopqrstuvwxyz0123456789_-"
+    paths = []
+    for i in range(files):
+        extension = extensions[i % len(extensions)]
+        prefix = "f{:07d}".format(i)
+        name = prefix + "".join(rng.choice(letters) for _ in range(max(0, name_length - len(prefix)))) + "." + extension
+        path = os.path.join(dirs[i % len(dirs)], name)
+        with open(path, "wb") as data_file:
+            data_file.write(sample_content(extension, i))
+        paths.append(path)
+    for i in range(dot_dirs):
+        hidden = os.path.join(rng.choice(dirs), ".hidden{:04d}".format(i))
+        os.makedirs(hidden, exist_ok=True)
+        for n in range(10):
+            with open(os.path.join(hidden, "cache{:02d}".format(n)), "wb") as data_file:
+                data_file.write(b"x")
+    return dirs, paths
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class BenchEnvironment(object):
+    """A fake API server, a scratch agent config and a logged-in RadiamAPI"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0.0, logger=None):
+        self.workdir = tempfile.mkdtemp(prefix="radiam-bench-")
+        self.rootdir = os.path.join(self.workdir, "project")
+        os.makedirs(self.rootdir)
+        self.logger = logger or logging.getLogger('radiam')
+        self.server = FakeRadiamServer(projectname=bench_project, latency=latency, jitter=jitter,
+                                       error_rate=error_rate, rate_limit=rate_limit).start()
+        self.saved_dirs = radiam.dirs
+        radiam.dirs = BenchDirs(self.workdir)
+        radiam.extraction_cache = None
+        radiam.checksummer = None
+        radiam.enricher = None
+        arguments = {'--hostname': self.server.url, '--minsize': 0, '--mtime': 0, '--password': None,
+                     '--rootdir': None, '--username': None, '--projectname': None, '--quitafter': True}
+        tray_options = {"hostname": self.server.url, "rootdir": self.rootdir, "projectname": bench_project}
+        self.config, status = radiam.load_config(self.workdir, arguments, self.logger, tray_options)
+        self.project_key = self.config['projects']['project_list'][0]
+        for field in ("included_files", "excluded_files", "included_dirs", "excluded_dirs"):
+            radiam.config_list_check(self.config, self.project_key, field)
+        self.API = RadiamAPI(tokenfile=os.path.join(self.workdir, "token"), baseurl=self.server.url, logger=self.logger)
+        self.API.login("admin", "admin")
+        radiam.agent_checkin(self.API, self.config, self.logger)
+
+    def close(self):
+        radiam.close_services()
+        radiam.dirs = self.saved_dirs
+        self.server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def api_summary(server):
+    count, total = radiam_metrics.api_latency.summary()
+    stats = server.state.stats()
+    return {
+        "api_requests": sum(stats["requests"].values()),
+        "api_mean_latency": total / count if count else None,
+        "api_p95_latency": radiam_metrics.api_latency.quantile(0.95),
+        "server_documents": stats["documents"],
+        "server_duplicate_posts": stats["duplicate_posts"],
+        "server_bytes_received": stats["bytes_received"]
+    }
+
+
+def bench_crawl(files, shape="balanced", depth=3, fanout=4, **server_options):
+    env = BenchEnvironment(**server_options)
+    try:
+        dirs, paths = generate_tree(env.rootdir, files, shape, depth, fanout)
+        start = time.time()
+        radiam.full_run(env.API, env.config, env.logger)
+        elapsed = time.time() - start
+        entries = len(paths) + len(dirs) - 1
+        result = {"benchmark": "crawl", "entries": entries, "seconds": elapsed, "entries_per_second": entries / elapsed}
+        result.update(api_summary(env.server))
+        return result
+    finally:
+        env.close()
+
+
+def bench_monitor(events, timeout, crawl_files=0, **server_options):
+    env = BenchEnvironment(**server_options)
+    crawler = None
+    observer = None
+    try:
+        live_dir = env.rootdir
+        if crawl_files:
+            # events compete with the crawl for its only worker
+            env.config['agent']['crawl_workers'] = "1"
+            generate_tree(os.path.join(env.rootdir, "crawl"), crawl_files)
+        scheduler = radiam.open_scheduler(env.config)
+        observer, handlers = radiam.start_monitor(env.API, env.config, env.logger, scheduler)
+        if crawl_files:
+            crawler = threading.Thread(target=radiam.full_run, args=(env.API, env.config, env.logger, scheduler))
+            crawler.start()
+            # a directory made once the crawl is past the rootdir is only indexed through events
+            time.sleep(0.5)
+            live_dir = os.path.join(env.rootdir, "live")
+            os.mkdir(live_dir)
+        time.sleep(1)
+        created = {}
+        start = time.time()
+        for i in range(events):
+            path = os.path.join(live_dir, "event{:06d}.dat".format(i))
+            with open(path, "wb") as data_file:
+                data_file.write(b"x")
+            created[os.path.abspath(path)] = time.time()
+        while time.time() - start < timeout:
+            with env.server.state.lock:
+                seen = dict((p, env.server.state.first_seen[p]) for p in created if p in env.server.state.first_seen)
+            if len(seen) == len(created):
+                break
+            time.sleep(0.1)
+        latencies = [seen[p] - created[p] for p in seen]
+        elapsed = (max(seen.values()) - start) if seen else None
+        result = {"benchmark": "monitor", "events": events, "crawl_files": crawl_files, "indexed": len(seen),
+                  "seconds": elapsed,
+                  "events_per_second": len(seen) / elapsed if elapsed else None,
+                  "latency_p50": percentile(latencies, 0.5), "latency_p95": percentile(latencies, 0.95),
+                  "latency_max": max(latencies) if latencies else None}
+        result.update(api_summary(env.server))
+        return result
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if crawler is not None:
+            crawler.join()
+        env.close()
+
+
+def time_calls(name, func, args_list, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for args in args_list:
+            func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"name": name, "calls": len(args_list), "seconds": best, "per_call": best / max(1, len(args_list))}
+
+
+def bench_micro(files=2000, shape="balanced", depth=3, fanout=4, name_length=12, dot_dirs=0, mixed=False, seed=1,
+                repeat=3, sample=10000):
+    """Time the crawler building blocks individually on a synthetic tree"""
+    env = BenchEnvironment()
+    try:
+        dirs, paths = generate_tree(env.rootdir, files, shape, depth, fanout, name_length, dot_dirs, mixed, seed)
+        config, key = env.config, env.project_key
+        project_config = config[key]
+        rng = random.Random(seed)
+        file_sample = rng.sample(paths, min(sample, len(paths)))
+        dir_sample = rng.sample(dirs, min(sample, len(dirs)))
+        results = [
+            time_calls("get_list_of_files", radiam.get_list_of_files, [(env.rootdir, project_config)], repeat),
+            time_calls("file_excluded", radiam.file_excluded, [(p, project_config) for p in file_sample], repeat),
+            time_calls("dir_excluded", radiam.dir_excluded, [(d, project_config) for d in dir_sample], repeat),
+            time_calls("get_file_meta", radiam.get_file_meta, [(p, config, key) for p in file_sample], repeat),
+            time_calls("get_dir_meta", radiam.get_dir_meta, [(d, config, key) for d in dir_sample], repeat),
+            time_calls("route_metadata_parser", radiam_extract.route_metadata_parser, [(p,) for p in file_sample], repeat),
+        ]
+
+        def crawl_once():
+            radiam.full_run(env.API, config, env.logger)
+
+        results.append(time_calls("full_run", crawl_once, [()], repeat))
+        return {"benchmark": "micro", "files": len(paths), "dirs": len(dirs), "shape": shape, "results": results}
+    finally:
+        env.close()
+
+
+def compare_baseline(result, baseline, threshold):
+    """Return a list of (name, baseline per call, current per call) for every regression"""
+    previous = dict((r["name"], r) for r in baseline.get("results", []))
+    regressions = []
+    for current in result["results"]:
+        old = previous.get(current["name"])
+        if old and current["per_call"] > old["per_call"] * (1 + threshold):
+            regressions.append((current["name"], old["per_call"], current["per_call"]))
+    return regressions
+
+
+def print_micro(result):
+    print("{:<24} {:>8} {:>12} {:>14}".format("benchmark", "calls", "seconds", "us per call"))
+    for r in result["results"]:
+        print("{:<24} {:>8} {:>12.4f} {:>14.2f}".format(r["name"], r["calls"], r["seconds"], r["per_call"] * 1e6))
+
+
+def print_results(result):
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = "{:.4f}".format(value)
+        print("{:<24} {}".format(key, value))
+
+
+def tree_options(arguments):
+    return {"files": int(arguments['--files']), "shape": arguments['--shape'], "depth": int(arguments['--depth']),
+            "fanout": int(arguments['--fanout'])}
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    logging.basicConfig(level=logging.WARNING)
+    if arguments['generate'] or arguments['micro']:
+        options = tree_options(arguments)
+        options.update({"name_length": int(arguments['--name-length']), "dot_dirs": int(arguments['--dot-dirs']),
+                        "mixed": arguments['--mixed'], "seed": int(arguments['--seed'])})
+        if arguments['generate']:
+            dirs, paths = generate_tree(arguments['<dir>'], **options)
+            print("Generated {} files in {} directories under {}".format(len(paths), len(dirs), arguments['<dir>']))
+            sys.exit(0)
+        result = bench_micro(repeat=int(arguments['--repeat']), sample=int(arguments['--sample']), **options)
+        print_micro(result)
+    else:
+        server_options = {"latency": float(arguments['--latency']), "jitter": float(arguments['--jitter'])}
+        if arguments['crawl']:
+            server_options.update({"error_rate": float(arguments['--error-rate']), "rate_limit": float(arguments['--rate-limit'])})
+            server_options.update(tree_options(arguments))
+            result = bench_crawl(**server_options)
+        else:
+            result = bench_monitor(int(arguments['--events']), float(arguments['--timeout']),
+                                   int(arguments['--crawl-files']), **server_options)
+        print_results(result)
+    if arguments['--output']:
+        with open(arguments['--output'], "w") as output:
+            json.dump(result, output, indent=2)
+    if arguments['micro']:
+        if arguments['--save-baseline']:
+            with open(arguments['--save-baseline'], "w") as output:
+                json.dump(result, output, indent=2)
+        if arguments['--baseline']:
+            with open(arguments['--baseline']) as baseline_file:
+                regressions = compare_baseline(result, json.load(baseline_file), float(arguments['--threshold']))
+            for name, old, new in regressions:
+                print("REGRESSION {}: {:.2f} us per call, baseline {:.2f} us".format(name, new * 1e6, old * 1e6))
+            if regressions:
+                sys.exit(1)
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+def stat_key(st):
+    """The identity of a file's content as far as the cache is concerned"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class StatCache(object):
+    """A persistent, size-bounded LRU cache of JSON values keyed by file identity.
+
+    Entries are keyed by (device, inode) and only returned while the size,
+    mtime_ns and version they were stored with still match, so a changed
+    file or a new extractor version is simply a miss. When the stored values
+    exceed max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, commit_every=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                        "version TEXT, value TEXT, nbytes INTEGER, last_used REAL, PRIMARY KEY (dev, ino))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _written(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def get(self, key, version):
+        """Return (True, value) on a hit and (False, None) on a miss"""
+        dev, ino, size, mtime_ns = key
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, version, value FROM entries WHERE dev = ? AND ino = ?",
+                                  (dev, ino)).fetchone()
+            if row is None or tuple(row[:3]) != (size, mtime_ns, version):
+                self.misses += 1
+                return False, None
+            self.db.execute("UPDATE entries SET last_used = ? WHERE dev = ? AND ino = ?", (time.time(), dev, ino))
+            self._written()
+            self.hits += 1
+            return True, json.loads(row[3])
+
+    def put(self, key, version, value):
+        dev, ino, size, mtime_ns = key
+        encoded = json.dumps(value, default=str)
+        with self.lock:
+            old = self.db.execute("SELECT nbytes FROM entries WHERE dev = ? AND ino = ?", (dev, ino)).fetchone()
+            if old:
+                self.total_bytes -= old[0]
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (dev, ino, size, mtime_ns, version, encoded, len(encoded), time.time()))
+            self.total_bytes += len(encoded)
+            self._written()
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the bound so eviction doesn't run on every put
+        target = self.max_bytes * 0.9
+        rows = self.db.execute("SELECT dev, ino, nbytes FROM entries ORDER BY last_used")
+        evicted = []
+        for dev, ino, nbytes in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((dev, ino))
+            self.total_bytes -= nbytes
+        rows.close()
+        self.db.executemany("DELETE FROM entries WHERE dev = ? AND ino = ?", evicted)
+        self.db.commit()
+        self.uncommitted = 0
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
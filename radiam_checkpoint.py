@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+
+
+class CrawlCheckpoint(object):
+    """The durable progress of one project's crawl, so an interrupted crawl resumes where it stopped.
+
+    A directory is pending from when it is found until the API has
+    acknowledged the documents of all its entries, and done after that.
+    Acknowledged documents are recorded batch by batch, and each batch is
+    committed together with the directories found before it. A restarted
+    crawl rescans only the pending directories, skipping entries that were
+    already acknowledged and subdirectories that are already done. The
+    checkpoint is cleared when a crawl finishes, and also when the project
+    rootdir it was made for changes.
+    """
+
+    def __init__(self, path, rootdir):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pending (path TEXT PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS done (path TEXT PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sent (path TEXT PRIMARY KEY)")
+        row = self.db.execute("SELECT value FROM state WHERE key = 'rootdir'").fetchone()
+        if row is None or row[0] != rootdir:
+            self._clear()
+            self.db.execute("INSERT OR REPLACE INTO state VALUES ('rootdir', ?)", (rootdir,))
+        self.db.commit()
+
+    def _clear(self):
+        for table in ("pending", "done", "sent"):
+            self.db.execute("DELETE FROM {}".format(table))
+
+    def resume(self):
+        """Return the directories an interrupted crawl left pending, or an empty list for a fresh crawl"""
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT path FROM pending ORDER BY rowid")]
+
+    def queue(self, path):
+        """Record a directory as pending; return False if it already was"""
+        with self.lock:
+            return self.db.execute("INSERT OR IGNORE INTO pending VALUES (?)", (path,)).rowcount == 1
+
+    def is_done(self, path):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM done WHERE path = ?", (path,)).fetchone() is not None
+
+    def is_sent(self, path):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM sent WHERE path = ?", (path,)).fetchone() is not None
+
+    def acknowledge(self, paths, completed=()):
+        """Durably record documents the API acknowledged, and the directories that completes"""
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO sent VALUES (?)", ((path,) for path in paths))
+            self.db.executemany("DELETE FROM pending WHERE path = ?", ((path,) for path in completed))
+            self.db.executemany("INSERT OR IGNORE INTO done VALUES (?)", ((path,) for path in completed))
+            self.db.commit()
+
+    def acknowledged(self):
+        """Return every document path acknowledged since the crawl started, before any interruption too"""
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT path FROM sent")]
+
+    def finish(self):
+        with self.lock:
+            self._clear()
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,160 @@
+import concurrent.futures
+import copy
+import os
+import radiam_metrics
+import radiam_profile
+from radiam_cache import stat_key
+from radiam_sandbox import SandboxPool, SandboxTimeout, SandboxCrash
+
+
+def extract_rich_metadata(path, options=None, read_limit=None):
+    # Runs in a worker process; a parser failure only costs this file its rich
+    # metadata. The file is stat'ed before parsing so the result is cached
+    # against the version of the file that was actually read. The cost of the
+    # extractors used is handed back for the parent's metrics.
+    import radiam_extract
+    if read_limit is not None:
+        radiam_extract.set_read_limit(*read_limit)
+    try:
+        key = stat_key(os.lstat(path))
+    except OSError:
+        return None, None, {}
+    try:
+        metadata = radiam_extract.route_metadata_parser(path, key[2], options)
+    except Exception:
+        metadata = None
+    return key, metadata, radiam_extract.registry.take_stats()
+
+
+def record_extractor_stats(stats):
+    """Add the per-extractor cost returned by radiam_extract.registry.take_stats to the metrics"""
+    for name, cost in stats.items():
+        radiam_metrics.extract_calls.inc(name, amount=cost["calls"])
+        radiam_metrics.extract_errors.inc(name, amount=cost["errors"])
+        radiam_metrics.extract_seconds.inc(name, amount=cost["seconds"])
+        radiam_metrics.extract_bytes.inc(name, amount=cost["bytes_read"])
+        radiam_profile.add("extract workers", cost["calls"], cost["seconds"])
+
+
+class MetadataEnricher(object):
+    """Extract rich metadata in a pool of sandboxed worker processes.
+
+    File records are submitted without their extended metadata and handed
+    back, completed, by completed() and drain(), so the crawl thread can keep
+    scanning and uploading other documents while parsers run. At most
+    max_pending records are in flight; submit() waits for the oldest one
+    beyond that, so memory stays bounded on trees full of parseable files.
+    Results are stored in cache, if given, under version; failures are not,
+    so they are tried again. submit() takes a project's extractor options
+    (see radiam_extract.extractor_options) and the cache version that goes
+    with them.
+
+    Workers run under radiam_sandbox.SandboxPool, so a parser that hangs or
+    blows up costs at most deadline seconds and one worker process. Files
+    that do so, or that a parser raises on, are recorded in quarantine, a
+    radiam_sandbox.Quarantine, if given, and skipped once they have failed
+    too often.
+
+    Parsers read at most read_rate bytes per second (0 for no limit), split
+    evenly between the workers, and back off while reads take longer than
+    read_latency seconds (see radiam_extract.set_read_limit).
+    """
+
+    def __init__(self, workers=None, max_pending=None, logger=None, cache=None, version=None, deadline=60,
+                 memory_limit=None, max_tasks=1000, quarantine=None, read_rate=0, read_latency=None, adaptive=True):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 8
+        self.logger = logger
+        self.cache = cache
+        self.version = version
+        self.quarantine = quarantine
+        self.read_limit = (float(read_rate or 0) / self.workers, read_latency, adaptive)
+        self.pool = SandboxPool(self.workers, deadline, memory_limit, max_tasks, logger)
+        self.pending = []
+        self.ready = []
+
+    def lane(self):
+        """Return a view sharing this enricher's workers that hands back only the records submitted to it.
+
+        Concurrent crawl jobs each use their own lane. A lane is never closed.
+        """
+        lane = copy.copy(self)
+        lane.pending = []
+        lane.ready = []
+        return lane
+
+    def _start(self, path, options, urgent=False):
+        # The parent stats the file too, to know what to quarantine if the worker never answers
+        try:
+            key = stat_key(os.lstat(path))
+        except OSError:
+            key = None
+        if self.quarantine is not None and self.quarantine.blocked(key):
+            future = concurrent.futures.Future()
+            future.set_result((None, None, {}))
+            return future, key
+        return self.pool.submit(extract_rich_metadata, path, options, self.read_limit, urgent=urgent), key
+
+    def _result(self, future, path, key):
+        try:
+            key, metadata, stats = future.result()
+            record_extractor_stats(stats)
+            if metadata is None and key is not None and self.quarantine is not None and \
+                    self.quarantine.failed(key, path, "parser error"):
+                # a parser that raises on the file every time it is read is given up on like one that hangs
+                if self.logger:
+                    self.logger.warning("Quarantined %s after repeated extraction failures", path)
+            return key, metadata
+        except (SandboxTimeout, SandboxCrash) as e:
+            if self.quarantine is not None and key is not None and self.quarantine.failed(key, path, str(e)):
+                if self.logger:
+                    self.logger.warning("Quarantined %s after repeated extraction failures: %s", path, e)
+            elif self.logger:
+                self.logger.warning("Metadata extraction failed for %s: %s", path, e)
+        except Exception as e:
+            if self.logger:
+                self.logger.warning("Metadata extraction failed for %s: %s", path, e)
+        return None, None
+
+    def extract(self, path, options=None):
+        """Extract the metadata of one file, ahead of the records already submitted, waiting for the result"""
+        future, key = self._start(path, options, urgent=True)
+        return self._result(future, path, key)[1]
+
+    def submit(self, record, options=None, version=None):
+        future, key = self._start(record['path'], options)
+        self.pending.append((future, key, record, version or self.version))
+        if len(self.pending) > self.max_pending:
+            self.ready.append(self._finish(*self.pending.pop(0)))
+
+    def _finish(self, future, key, record, version):
+        key, record['extended_metadata'] = self._result(future, record['path'], key)
+        # a failed extraction is tried again next time rather than cached
+        if self.cache is not None and key is not None and record['extended_metadata'] is not None:
+            self.cache.put(key, version, record['extended_metadata'])
+        return record
+
+    def completed(self):
+        """Return the records whose extraction has finished, without waiting"""
+        done = self.ready
+        self.ready = []
+        still_pending = []
+        for pending in self.pending:
+            if pending[0].done():
+                done.append(self._finish(*pending))
+            else:
+                still_pending.append(pending)
+        self.pending = still_pending
+        return done
+
+    def drain(self):
+        """Wait for every submitted record and return them"""
+        done = self.ready
+        self.ready = []
+        for pending in self.pending:
+            done.append(self._finish(*pending))
+        self.pending = []
+        return done
+
+    def close(self):
+        self.pool.shutdown(wait=True)
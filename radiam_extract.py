@@ -1,46 +1,143 @@
 import os
 import platform
-from PyPDF2 import PdfFileReader
-from netCDF4 import Dataset
-from PIL import Image
-from PIL.ExifTags import TAGS
-import olefile
-from docx import Document
-import openpyxl
-import cftime
-import magic
+import contextlib
+import mimetypes
+import threading
+import time
+import radiam_formats
+from radiam_throttle import AdaptiveThrottle, TokenBucket
+import zipfile
+from xml.etree import ElementTree
+
+# Bump when parser output changes so cached extraction results are not reused
+extractor_version = "3"
+
+cdf_mimetypes = ['application/cdf', 'application/x-cdf', 'application/x-netcdf']
+hdf5_mimetypes = ['application/x-hdf5']
+fits_mimetypes = ['image/fits', 'application/fits']
+exif_mimetypes = ['image/jpeg', 'image/pjpeg', 'image/jp2', 'image/png']
+ole_mimetypes = ['application/msword', 'application/vnd.ms-excel', 'application/vnd.ms-powerpoint']
+word_mimetype = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+excel_mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# libmagic sniffs types from this much of the start of a file
+header_bytes = 65536
+# Generic types libmagic reports when the parts that identify a format lie beyond the header
+container_mimetypes = ['application/zip', 'application/octet-stream']
+cost_classes = ["cheap", "moderate", "expensive"]
+# Parser libraries are imported by the extractors that use them, the first time one runs, so
+# an agent that never extracts rich metadata never loads them
+# Limits the bytes extractors read in this process; see set_read_limit
+read_throttle = None
+read_limit = None
+
+
+@contextlib.contextmanager
+def open_handle(crawled_file):
+    # Parsers are given an open handle by the registry, or a path when called directly
+    if hasattr(crawled_file, "read"):
+        yield crawled_file
+    else:
+        with open(crawled_file, 'rb') as handle:
+            yield handle
 
 
 def parse_pdf(crawled_file):
+    from PyPDF2 import PdfFileReader
     pdf = PdfFileReader(crawled_file)
     info = pdf.getDocumentInfo()
     return info
 
 def parse_cdf(crawled_file):
-    rootgrp = Dataset(crawled_file, "r")
-    cdf_dict = {}
-    for x in rootgrp.ncattrs():
-        cdf_dict[x] = getattr(rootgrp, x)
-    return cdf_dict
+    # Classic files are decoded from a memory map; NetCDF-4 files are HDF5 underneath
+    with open_handle(crawled_file) as handle:
+        signature = handle.read(4)
+        if signature[:3] == b"CDF":
+            return radiam_formats.read_netcdf_classic(handle)
+        if signature == b"\x89HDF":
+            return radiam_formats.read_hdf5(handle.name)
+        return radiam_formats.read_netcdf4(handle.name)
+
+def parse_hdf5(crawled_file):
+    with open_handle(crawled_file) as handle:
+        return radiam_formats.read_hdf5(handle.name)
+
+def parse_fits(crawled_file):
+    with open_handle(crawled_file) as handle:
+        return radiam_formats.read_fits(handle)
+
+def exif_value(value):
+    # Rationals become floats; binary blobs such as thumbnails are left out
+    if isinstance(value, bytes):
+        return None
+    if isinstance(value, tuple):
+        return [exif_value(v) for v in value]
+    if hasattr(value, "numerator") and hasattr(value, "denominator") and not isinstance(value, int):
+        return float(value) if value.denominator else None
+    return value
 
 def parse_exif(crawled_file):
-    return Image.open(crawled_file)._getexif()
+    from PIL import Image
+    from PIL.ExifTags import TAGS, GPSTAGS
+    exif = Image.open(crawled_file)._getexif() or {}
+    exif_dict = {}
+    for tag, value in exif.items():
+        name = TAGS.get(tag, str(tag))
+        if name == "MakerNote":
+            continue
+        if name == "GPSInfo" and isinstance(value, dict):
+            value = dict((GPSTAGS.get(k, str(k)), exif_value(v)) for k, v in value.items())
+        else:
+            value = exif_value(value)
+        if value is not None:
+            exif_dict[name] = value
+    return exif_dict
 
 def parse_ole(crawled_file):
+    import olefile
     ole = olefile.OleFileIO(crawled_file)
     meta = ole.get_metadata()
     ole_dict = {"Title": meta.title, "Author": meta.author, "Template": meta.template, "Keywords": meta.keywords}
     return ole_dict
 
+core_namespaces = {"cp": "http://schemas.openxmlformats.org/package/2006/metadata/core-properties",
+                   "dc": "http://purl.org/dc/elements/1.1/"}
+core_relationship = "http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties"
+
+
+def read_core_properties(crawled_file):
+    # Read only the core properties part of an OOXML package, so the cost does not grow with the document
+    with zipfile.ZipFile(crawled_file) as package:
+        core_name = "docProps/core.xml"
+        try:
+            rels = ElementTree.fromstring(package.read("_rels/.rels"))
+            for rel in rels:
+                if rel.get("Type") == core_relationship:
+                    core_name = rel.get("Target").lstrip("/")
+        except (KeyError, ElementTree.ParseError):
+            pass
+        try:
+            core = ElementTree.fromstring(package.read(core_name))
+        except KeyError:
+            return {}
+    properties = {}
+    for prefix, name in (("dc", "title"), ("dc", "creator"), ("cp", "keywords"), ("cp", "revision")):
+        element = core.find("{}:{}".format(prefix, name), core_namespaces)
+        if element is not None:
+            properties[name] = element.text
+    return properties
+
 def parse_word(crawled_file):
-    with open(crawled_file, 'rb') as word_file:
-        document = Document(word_file)
-    word_dict = {"Title": document.core_properties.title, "Author": document.core_properties.author, "Revision": document.core_properties.revision, "Keywords": document.core_properties.keywords}
+    core = read_core_properties(crawled_file)
+    try:
+        revision = int(core.get("revision"))
+    except (TypeError, ValueError):
+        revision = 0
+    word_dict = {"Title": core.get("title") or "", "Author": core.get("creator") or "", "Revision": revision, "Keywords": core.get("keywords") or ""}
     return word_dict
 
 def parse_excel(crawled_file):
-    wb = openpyxl.load_workbook(crawled_file)
-    excel_dict = {"Title": wb.properties.title, "Creator": wb.properties.creator, "Keywords": wb.properties.keywords}
+    core = read_core_properties(crawled_file)
+    excel_dict = {"Title": core.get("title"), "Creator": core.get("creator"), "Keywords": core.get("keywords")}
     return excel_dict
 
 def object_to_utf8(obj):
@@ -51,7 +148,7 @@ def object_to_utf8(obj):
     elif isinstance(obj, list):
         retval = []
         for v in obj:
-            ret.append(object_to_utf8(v))
+            retval.append(object_to_utf8(v))
         return retval
     elif isinstance(obj, dict):
         retval = {}
@@ -61,24 +158,205 @@ def object_to_utf8(obj):
     else:
         return obj
 
-def route_metadata_parser(crawled_file):
-    cdf_mimetypes = ['application/cdf', 'application/x-cdf', 'application/x-netcdf']
-    exif_mimetypes = ['image/jpeg', 'image/pjpeg', 'image/jp2', 'image/png']
-    ole_mimetypes = ['application/msword', 'application/vnd.ms-excel', 'application/vnd.ms-powerpoint']
-
-    detected = magic.from_file(crawled_file, mime=True)
-    if detected == 'application/pdf':
-        parsed_metadata = parse_pdf(crawled_file)
-    elif detected in cdf_mimetypes:
-        parsed_metadta = parse_cdf(crawled_file)
-    elif detected in exif_mimetypes:
-        parsed_metadata = parse_exif(crawled_file)
-    elif detected in ole_mimetypes:
-        parsed_metadata = parse_ole(crawled_file)
-    elif detected == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-        parsed_metadata = parse_word(crawled_file)
-    elif detected == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
-        parsed_metadata = parse_excel(crawled_file)
+def set_read_limit(rate=0, latency=None, adaptive=True):
+    """Limit the bytes per second extractors in this process read, backing off while reads are slow"""
+    global read_throttle, read_limit
+    if read_limit == (rate, latency, adaptive):
+        return
+    read_limit = (rate, latency, adaptive)
+    if adaptive:
+        read_throttle = AdaptiveThrottle(rate, max(int(rate or 0), header_bytes), latency, floor=0.05,
+                                         min_rate=header_bytes, name="extractor reads")
+    elif rate:
+        read_throttle = TokenBucket(rate, max(int(rate), header_bytes))
     else:
-        return {}
-    return object_to_utf8(parsed_metadata)
+        read_throttle = None
+
+
+class CountingReader(object):
+    """Wrap a file object, counting the bytes parsers read through it and charging them to read_throttle"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.bytes_read = 0
+
+    def _count(self, nbytes, seconds):
+        self.bytes_read += nbytes
+        if isinstance(read_throttle, AdaptiveThrottle):
+            read_throttle.observe(seconds, nbytes)
+        if read_throttle is not None:
+            read_throttle.take(nbytes)
+
+    def read(self, size=-1):
+        start = time.monotonic()
+        data = self.handle.read(size)
+        self._count(len(data), time.monotonic() - start)
+        return data
+
+    def readinto(self, buffer):
+        start = time.monotonic()
+        count = self.handle.readinto(buffer)
+        self._count(count or 0, time.monotonic() - start)
+        return count
+
+    def readline(self, size=-1):
+        start = time.monotonic()
+        data = self.handle.readline(size)
+        self._count(len(data), time.monotonic() - start)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+class Extractor(object):
+    """A metadata parser, the files it accepts and what it has cost so far.
+
+    cost is one of cost_classes, so projects can leave out the expensive
+    ones, and files larger than max_bytes are never given to the parser.
+    """
+
+    def __init__(self, name, parse, mimetypes, extensions=(), cost="cheap", max_bytes=None):
+        self.name = name
+        self.parse = parse
+        self.mimetypes = list(mimetypes)
+        self.extensions = list(extensions)
+        self.cost = cost
+        self.max_bytes = max_bytes
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes_read = 0
+
+
+class ExtractorRegistry(object):
+    """Route files to the registered extractors and account for their cost.
+
+    The options accepted by route() (see extractor_options) let a project
+    disable extractors by name, cap the cost class it is willing to pay for
+    and lower per-extractor size limits.
+    """
+
+    def __init__(self):
+        self.extractors = []
+        self.lock = threading.Lock()
+
+    def register(self, extractor):
+        self.extractors.append(extractor)
+        return extractor
+
+    def enabled(self, options):
+        disabled = options.get("disabled", ())
+        max_cost = cost_classes.index(options.get("max_cost") or cost_classes[-1])
+        return [e for e in self.extractors if e.name not in disabled and cost_classes.index(e.cost) <= max_cost]
+
+    def for_mimetype(self, mimetype, extractors):
+        for extractor in extractors:
+            if mimetype in extractor.mimetypes:
+                return extractor
+        return None
+
+    def for_extension(self, extension, extractors):
+        for extractor in extractors:
+            if extension in extractor.extensions:
+                return extractor
+        return None
+
+    def route(self, crawled_file, size=None, options=None):
+        options = options or {}
+        extractors = self.enabled(options)
+        extension = os.path.splitext(crawled_file)[1].lower()
+        # Files whose extension names a type no extractor handles, and empty files, are never opened
+        guessed = mimetypes.guess_type(crawled_file)[0]
+        if guessed is not None and self.for_mimetype(guessed, extractors) is None and \
+                self.for_extension(extension, extractors) is None:
+            return {}
+        if size == 0:
+            return {}
+
+        # The file is opened and read once: libmagic sniffs the header, then the extractor gets the same handle
+        with open(crawled_file, 'rb') as handle:
+            header = CountingReader(handle).read(header_bytes)
+            if not header:
+                return {}
+            import magic
+            detected = magic.from_buffer(header, mime=True)
+            extractor = self.for_mimetype(detected, extractors)
+            if extractor is None and detected in container_mimetypes:
+                extractor = self.for_extension(extension, extractors)
+            if extractor is None:
+                return {}
+            max_bytes = options.get("max_bytes", {}).get(extractor.name, extractor.max_bytes)
+            if max_bytes is not None and size is not None and size > max_bytes:
+                return {}
+            handle.seek(0)
+            reader = CountingReader(handle)
+            start = time.time()
+            try:
+                return object_to_utf8(extractor.parse(reader))
+            except Exception:
+                with self.lock:
+                    extractor.errors += 1
+                raise
+            finally:
+                with self.lock:
+                    extractor.calls += 1
+                    extractor.seconds += time.time() - start
+                    extractor.bytes_read += len(header) + reader.bytes_read
+
+    def take_stats(self):
+        """Return and reset the cost of each extractor called since the last call"""
+        stats = {}
+        with self.lock:
+            for extractor in self.extractors:
+                if extractor.calls:
+                    stats[extractor.name] = {"calls": extractor.calls, "errors": extractor.errors,
+                                             "seconds": extractor.seconds, "bytes_read": extractor.bytes_read}
+                extractor.calls = extractor.errors = extractor.bytes_read = 0
+                extractor.seconds = 0.0
+        return stats
+
+
+def extractor_options(project_config):
+    """Read a project's extractor options: extract_disabled, extract_max_cost and extract_max_bytes"""
+    disabled = project_config.get("extract_disabled") or []
+    if isinstance(disabled, str):
+        disabled = disabled.split(",")
+    max_bytes = project_config.get("extract_max_bytes") or []
+    if isinstance(max_bytes, str):
+        max_bytes = max_bytes.split(",")
+    limits = {}
+    for item in max_bytes:
+        if ":" in item:
+            name, nbytes = item.rsplit(":", 1)
+            limits[name.strip()] = int(nbytes)
+    return {"disabled": sorted(d.strip() for d in disabled if d.strip()),
+            "max_cost": project_config.get("extract_max_cost"),
+            "max_bytes": limits}
+
+
+def options_version(options):
+    """The extractor version, qualified by any options that change what extraction returns"""
+    version = extractor_version
+    if options and options.get("disabled"):
+        version += "-no-" + ",".join(options["disabled"])
+    if options and options.get("max_cost"):
+        version += "-max-" + options["max_cost"]
+    if options and options.get("max_bytes"):
+        version += "-limit-" + ",".join("{}:{}".format(k, v) for k, v in sorted(options["max_bytes"].items()))
+    return version
+
+
+registry = ExtractorRegistry()
+registry.register(Extractor("pdf", parse_pdf, ['application/pdf'], ['.pdf'], "moderate"))
+registry.register(Extractor("cdf", parse_cdf, cdf_mimetypes, ['.nc', '.cdf'], "cheap"))
+registry.register(Extractor("hdf5", parse_hdf5, hdf5_mimetypes, ['.h5', '.hdf5', '.he5'], "moderate"))
+registry.register(Extractor("fits", parse_fits, fits_mimetypes, ['.fits', '.fit', '.fts'], "cheap"))
+registry.register(Extractor("exif", parse_exif, exif_mimetypes, ['.jpg', '.jpeg', '.jp2', '.png'], "cheap"))
+registry.register(Extractor("ole", parse_ole, ole_mimetypes, ['.doc', '.xls', '.ppt'], "moderate"))
+registry.register(Extractor("word", parse_word, [word_mimetype], ['.docx'], "cheap"))
+registry.register(Extractor("excel", parse_excel, [excel_mimetype], ['.xlsx'], "cheap"))
+
+
+def route_metadata_parser(crawled_file, size=None, options=None):
+    return registry.route(crawled_file, size, options)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A lightweight stand-in for the Radiam API, covering the endpoints used by the
+agent, for testing and benchmarking without a live Radiam server.
+
+Usage:
+  radiam_fakeapi.py [--port=<port>] [--username=<user>] [--password=<pass>] [--projectname=<pro>] [--latency=<s>] [--jitter=<s>] [--error-rate=<r>] [--rate-limit=<r>] [--max-body=<bytes>]
+
+Options:
+  --port=<port>  Port to listen on [default: 8100]
+  --username=<user>  Username accepted by the token endpoint [default: admin]
+  --password=<pass>  Password accepted by the token endpoint [default: admin]
+  --projectname=<pro>  Name of the project to serve [default: testproject]
+  --latency=<s>  Seconds added to every response [default: 0]
+  --jitter=<s>  Maximum random seconds added on top of the latency [default: 0]
+  --error-rate=<r>  Fraction of requests answered with a 500 error [default: 0]
+  --rate-limit=<r>  Fraction of requests answered with a 429 response [default: 0]
+  --max-body=<bytes>  Request bodies larger than this get a 413 response (0 for no limit) [default: 0]
+"""
+
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, unquote
+
+docs_pattern = re.compile(r'^/api/projects/([^/]+)/docs/(?:([^/]+)/?)?$')
+search_pattern = re.compile(r'^/api/projects/([^/]+)/search/$')
+
+
+class FakeRadiamState(object):
+    """Everything the fake server knows, shared by all request handler threads"""
+
+    def __init__(self, username="admin", password="admin", projectname="testproject", latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_limit=0.0, max_body=0, token_lifetime=None):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_body = max_body
+        self.token_lifetime = token_lifetime
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.user = {"id": str(uuid.uuid4()), "username": username}
+        self.projects = {}
+        self.locationtypes = [{"id": str(uuid.uuid4()), "label": "location.type.server"}]
+        self.locations = []
+        self.useragents = []
+        self.docs = {}
+        self.paths = {}
+        self.first_seen = {}
+        self.posts = 0
+        self.bytes_received = 0
+        self.requests = {}
+        self.add_project(projectname)
+
+    def add_project(self, name):
+        # Stable ids let agent configs that saved a project id survive a server restart
+        project = {"id": str(uuid.uuid5(uuid.NAMESPACE_URL, "radiam-project:" + name)), "name": name}
+        with self.lock:
+            self.projects[project['id']] = project
+            self.docs[project['id']] = {}
+            self.paths[project['id']] = {}
+        return project
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time()
+        return token
+
+    def token_valid(self, token):
+        with self.lock:
+            issued = self.tokens.get(token)
+        if issued is None:
+            return False
+        return self.token_lifetime is None or time.time() - issued < self.token_lifetime
+
+    def store_document(self, project_id, doc):
+        """Create or replace the document for a path, returning its id"""
+        with self.lock:
+            path = doc.get("path")
+            self.posts += 1
+            doc_id = self.paths[project_id].get(path)
+            if doc_id is None:
+                doc_id = self.paths[project_id][path] = str(uuid.uuid4())
+            stored = dict(doc)
+            stored["id"] = doc_id
+            self.docs[project_id][doc_id] = stored
+            self.first_seen.setdefault(path, time.time())
+            return doc_id
+
+    def stats(self):
+        with self.lock:
+            documents = sum(len(d) for d in self.docs.values())
+            return {
+                "documents": documents,
+                "posts": self.posts,
+                "duplicate_posts": self.posts - len(self.first_seen),
+                "bytes_received": self.bytes_received,
+                "requests": dict(self.requests)
+            }
+
+
+class FakeRadiamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, obj=None):
+        body = b"" if obj is None else json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        with self.state.lock:
+            self.state.bytes_received += len(body)
+        return body
+
+    def paginate(self, items, query):
+        for key, values in query.items():
+            items = [i for i in items if str(i.get(key)) == values[0]]
+        return {"count": len(items), "next": None, "previous": None, "results": items}
+
+    def handle_request(self, method):
+        state = self.state
+        url = urlparse(self.path)
+        path = url.path
+        while "//" in path:
+            path = path.replace("//", "/")
+        query = parse_qs(url.query)
+        body = self.read_body() if method in ("POST", "PUT") else b""
+
+        if path == "/fake/stats":
+            return self.send_json(200, state.stats())
+
+        label = docs_pattern.sub(r'/api/projects/{id}/docs/', path)
+        with state.lock:
+            state.requests[method + " " + label] = state.requests.get(method + " " + label, 0) + 1
+
+        delay = state.latency + random.uniform(0, state.jitter)
+        if delay:
+            time.sleep(delay)
+        if state.max_body and len(body) > state.max_body:
+            return self.send_json(413, {"detail": "Request body too large"})
+        if state.rate_limit and random.random() < state.rate_limit:
+            return self.send_json(429, {"detail": "Request was throttled", "retry-after": "0"})
+        if state.error_rate and random.random() < state.error_rate:
+            return self.send_json(500, {"detail": "Injected error"})
+
+        if method == "POST" and path == "/api/token/":
+            creds = json.loads(body.decode('utf-8'))
+            if creds.get("username") != state.username or creds.get("password") != state.password:
+                return self.send_json(401, {"detail": "No active account found with the given credentials"})
+            return self.send_json(200, {"refresh": state.issue_token(), "access": state.issue_token()})
+        if method == "POST" and path == "/api/token/refresh/":
+            return self.send_json(200, {"access": state.issue_token()})
+
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Bearer ") or not state.token_valid(auth[len("Bearer "):]):
+            return self.send_json(403, {"detail": "Given token not valid for any token type", "code": "token_not_valid"})
+
+        if path == "/api/users/current":
+            return self.send_json(200, state.user)
+        if path == "/api/users/":
+            return self.send_json(200, self.paginate([state.user], query))
+        if path == "/api/researchgroups/":
+            return self.send_json(200, self.paginate([], query))
+        if path == "/api/projects/" and method == "GET":
+            with state.lock:
+                projects = list(state.projects.values())
+            return self.send_json(200, self.paginate(projects, query))
+        for name in ("locations", "locationtypes", "useragents"):
+            if path == "/api/{}/".format(name):
+                items = getattr(state, name)
+                if method == "GET":
+                    with state.lock:
+                        items = list(items)
+                    return self.send_json(200, self.paginate(items, query))
+                obj = json.loads(body.decode('utf-8'))
+                obj.setdefault("id", str(uuid.uuid4()))
+                with state.lock:
+                    items.append(obj)
+                return self.send_json(201, obj)
+
+        match = docs_pattern.match(path)
+        if match and match.group(1) in state.docs:
+            project_id, doc_id = match.group(1), match.group(2)
+            if method == "GET":
+                with state.lock:
+                    docs = list(state.docs[project_id].values())
+                return self.send_json(200, self.paginate(docs, query))
+            if method == "DELETE":
+                with state.lock:
+                    removed = state.docs[project_id].pop(unquote(doc_id or ""), None)
+                    if removed:
+                        state.paths[project_id].pop(removed.get("path"), None)
+                return self.send_json(204 if removed else 404)
+            posted = json.loads(body.decode('utf-8'))
+            if isinstance(posted, list):
+                results = []
+                for doc in posted:
+                    state.store_document(project_id, doc)
+                    results.append({"docname": doc.get("path"), "result": "created"})
+                return self.send_json(201, results)
+            doc_id = state.store_document(project_id, posted)
+            return self.send_json(201, dict(posted, id=doc_id))
+
+        match = search_pattern.match(path)
+        if match and match.group(1) in state.docs and method == "POST":
+            term = json.loads(body.decode('utf-8'))["query"]["bool"]["filter"]["term"]
+            field, target = list(term.items())[0]
+            field = field.replace(".keyword", "")
+            with state.lock:
+                if field == "path":
+                    doc_id = state.paths[match.group(1)].get(target)
+                    docs = [state.docs[match.group(1)][doc_id]] if doc_id else []
+                else:
+                    docs = [d for d in state.docs[match.group(1)].values() if d.get(field) == target]
+            return self.send_json(200, {"count": len(docs), "results": docs})
+
+        return self.send_json(404, {"detail": "Not found."})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeRadiamServer(object):
+    """Run the fake Radiam API in a background thread.
+
+    Keyword arguments are passed on to FakeRadiamState; use port 0 to pick a
+    free port, and the url attribute to point RadiamAPI at it.
+    """
+
+    def __init__(self, port=0, host="127.0.0.1", **kwargs):
+        self.state = FakeRadiamState(**kwargs)
+        self.httpd = ThreadingServer((host, port), FakeRadiamHandler)
+        self.httpd.state = self.state
+        self.url = "http://{}:{}".format(host, self.httpd.server_address[1])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="radiam-fakeapi")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+    arguments = docopt(__doc__)
+    server = FakeRadiamServer(port=int(arguments['--port']),
+                              username=arguments['--username'],
+                              password=arguments['--password'],
+                              projectname=arguments['--projectname'],
+                              latency=float(arguments['--latency']),
+                              jitter=float(arguments['--jitter']),
+                              error_rate=float(arguments['--error-rate']),
+                              rate_limit=float(arguments['--rate-limit']),
+                              max_body=int(arguments['--max-body']))
+    print("Fake Radiam API listening on {}".format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,260 @@
+"""
+Header-only readers for large scientific data formats.
+
+Each reader memory-maps the file and decodes only the global attributes and
+the dimension and variable catalogue, so the cost does not depend on how
+much data the file holds: only the pages holding the header are ever read.
+"""
+
+import mmap
+import struct
+
+# Keep the catalogue of a file with a huge number of variables or HDUs bounded
+max_catalogue = 1000
+
+# Type names match the numpy dtypes netCDF4 and h5py report for the same variables
+netcdf_types = {
+    1: ("int8", "b", 1), 2: ("S1", "c", 1), 3: ("int16", "h", 2), 4: ("int32", "i", 4),
+    5: ("float32", "f", 4), 6: ("float64", "d", 8), 7: ("uint8", "B", 1), 8: ("uint16", "H", 2),
+    9: ("uint32", "I", 4), 10: ("int64", "q", 8), 11: ("uint64", "Q", 8)
+}
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+
+
+def map_file(handle):
+    return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class NetCDFHeader(object):
+    """Decode the header of a NetCDF classic file (CDF-1, CDF-2 or CDF-5) from a buffer"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 4
+        version = buffer[3]
+        if buffer[:3] != b"CDF" or version not in (1, 2, 5):
+            raise ValueError("Not a NetCDF classic file")
+        # CDF-5 widens counts and lengths to 64 bits, CDF-2 and CDF-5 widen variable offsets
+        self.count_format = ">q" if version == 5 else ">i"
+        self.offset_format = ">i" if version == 1 else ">q"
+
+    def unpack(self, fmt):
+        value = struct.unpack_from(fmt, self.buffer, self.offset)[0]
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def count(self):
+        return self.unpack(self.count_format)
+
+    def name(self):
+        length = self.count()
+        name = bytes(self.buffer[self.offset:self.offset + length]).decode('utf-8', 'replace')
+        self.offset += length + (-length % 4)
+        return name
+
+    def values(self, nc_type, nelems):
+        type_name, code, size = netcdf_types[nc_type]
+        raw = bytes(self.buffer[self.offset:self.offset + nelems * size])
+        self.offset += nelems * size + (-(nelems * size) % 4)
+        if code == "c":
+            return raw.rstrip(b"\x00").decode('utf-8', 'replace')
+        values = list(struct.unpack(">%d%s" % (nelems, code), raw))
+        return values[0] if nelems == 1 else values
+
+    def attributes(self):
+        tag, nelems = self.unpack(">i"), self.count()
+        if tag not in (0, NC_ATTRIBUTE):
+            raise ValueError("Bad attribute list in NetCDF header")
+        attributes = {}
+        for i in range(nelems):
+            name = self.name()
+            nc_type = self.unpack(">i")
+            attributes[name] = self.values(nc_type, self.count())
+        return attributes
+
+    def read(self):
+        numrecs = self.count()
+        tag, nelems = self.unpack(">i"), self.count()
+        if tag not in (0, NC_DIMENSION):
+            raise ValueError("Bad dimension list in NetCDF header")
+        dimensions = []
+        for i in range(nelems):
+            name = self.name()
+            length = self.count()
+            # A zero length marks the record (unlimited) dimension
+            dimensions.append((name, length or numrecs))
+        metadata = self.attributes()
+        tag, nelems = self.unpack(">i"), self.count()
+        if tag not in (0, NC_VARIABLE):
+            raise ValueError("Bad variable list in NetCDF header")
+        variables = {}
+        for i in range(nelems):
+            name = self.name()
+            dimids = [self.count() for d in range(self.count())]
+            attributes = self.attributes()
+            nc_type = self.unpack(">i")
+            self.count()
+            self.unpack(self.offset_format)
+            if len(variables) < max_catalogue:
+                variables[name] = {"type": netcdf_types[nc_type][0],
+                                   "dimensions": [dimensions[d][0] for d in dimids],
+                                   "attributes": attributes}
+        metadata["dimensions"] = dict(dimensions)
+        metadata["variables"] = variables
+        return metadata
+
+
+def read_netcdf_classic(handle):
+    buffer = map_file(handle)
+    try:
+        return NetCDFHeader(buffer).read()
+    finally:
+        buffer.close()
+
+
+# Bookkeeping attributes the HDF5 dimension scale API and NetCDF-4 add to every file
+hdf5_internal_attributes = ("DIMENSION_LIST", "REFERENCE_LIST", "_Netcdf4Dimid", "_Netcdf4Coordinates", "_nc3_strict")
+
+
+def plain_value(value):
+    # numpy scalars and arrays from h5py and netCDF4 become plain Python values
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, list):
+        return [plain_value(v) for v in value]
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        return str(value)
+    return value
+
+
+def hdf5_attributes(attrs):
+    return dict((name, plain_value(value)) for name, value in attrs.items() if name not in hdf5_internal_attributes)
+
+
+def load_h5py():
+    # Optional, and slow to import, so only loaded for the first HDF5 file; without it
+    # HDF5 files are read through netCDF4
+    try:
+        import h5py
+    except ImportError:
+        return None
+    return h5py
+
+
+def read_hdf5(path):
+    """Read the attributes and dataset catalogue of an HDF5 (or NetCDF-4) file without touching its data"""
+    h5py = load_h5py()
+    if h5py is None:
+        return read_netcdf4(path)
+    metadata = {}
+    variables = {}
+    with h5py.File(path, "r") as h5:
+        metadata.update(hdf5_attributes(h5.attrs))
+
+        def visit(name, item):
+            if isinstance(item, h5py.Dataset) and len(variables) < max_catalogue:
+                variables[name] = {"type": str(item.dtype), "shape": list(item.shape),
+                                   "attributes": hdf5_attributes(item.attrs)}
+        h5.visititems(visit)
+    metadata["variables"] = variables
+    return metadata
+
+
+def read_netcdf4(path):
+    from netCDF4 import Dataset
+    with Dataset(path, "r") as rootgrp:
+        metadata = dict((name, plain_value(rootgrp.getncattr(name))) for name in rootgrp.ncattrs())
+        metadata["dimensions"] = dict((name, len(dim)) for name, dim in rootgrp.dimensions.items())
+        variables = {}
+        for name, variable in rootgrp.variables.items():
+            if len(variables) >= max_catalogue:
+                break
+            variables[name] = {"type": str(variable.dtype), "dimensions": list(variable.dimensions),
+                               "attributes": dict((k, plain_value(variable.getncattr(k))) for k in variable.ncattrs())}
+        metadata["variables"] = variables
+    return metadata
+
+
+fits_block = 2880
+fits_card = 80
+
+
+def fits_value(text):
+    text = text.strip()
+    if text.startswith("'"):
+        # Quoted strings end at the first lone quote; doubled quotes are literal
+        value, i = [], 1
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1:i + 2] == "'":
+                    value.append("'")
+                    i += 2
+                    continue
+                break
+            value.append(text[i])
+            i += 1
+        return "".join(value).rstrip()
+    text = text.split("/", 1)[0].strip()
+    if text in ("T", "F"):
+        return text == "T"
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace("D", "E"))
+    except ValueError:
+        return text
+
+
+def fits_header(buffer, offset):
+    """Return the keywords of the header at offset and the offset just past it"""
+    header = {}
+    while offset + fits_block <= len(buffer):
+        block = bytes(buffer[offset:offset + fits_block]).decode('ascii', 'replace')
+        offset += fits_block
+        for start in range(0, fits_block, fits_card):
+            card = block[start:start + fits_card]
+            keyword = card[:8].strip()
+            if keyword == "END":
+                return header, offset
+            if keyword in ("COMMENT", "HISTORY"):
+                header.setdefault(keyword, []).append(card[8:].strip())
+            elif keyword and card[8:10] == "= ":
+                header[keyword] = fits_value(card[10:])
+    raise ValueError("FITS header has no END card")
+
+
+def fits_data_size(header):
+    naxis = header.get("NAXIS", 0)
+    if not naxis:
+        return 0
+    size = 1
+    for axis in range(1, naxis + 1):
+        size *= header.get("NAXIS{}".format(axis), 0)
+    size = abs(header.get("BITPIX", 8)) // 8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + size)
+    return size + (-size % fits_block)
+
+
+def read_fits(handle):
+    """Read the primary header and the headers of any extensions of a FITS file, skipping their data"""
+    buffer = map_file(handle)
+    try:
+        metadata, offset = fits_header(buffer, 0)
+        offset += fits_data_size(metadata)
+        extensions = []
+        while offset < len(buffer) and len(extensions) < max_catalogue:
+            header, offset = fits_header(buffer, offset)
+            offset += fits_data_size(header)
+            header.pop("COMMENT", None)
+            header.pop("HISTORY", None)
+            extensions.append(header)
+        if extensions:
+            metadata["extensions"] = extensions
+        return metadata
+    finally:
+        buffer.close()
@@ -0,0 +1,156 @@
+import concurrent.futures
+import copy
+import hashlib
+import mmap
+import os
+import time
+import radiam_profile
+from radiam_cache import stat_key
+from radiam_throttle import AdaptiveThrottle, TokenBucket
+
+# Files larger than one chunk are hashed as a tree: each chunk on its own thread, then the chunk digests
+default_chunk_size = 64 * 1024 * 1024
+# Reads are throttled and fed to the hash in blocks of this size
+block_size = 1024 * 1024
+
+
+def hash_range(algorithm, buffer, start, end, throttle=None):
+    digest = hashlib.new(algorithm)
+    for offset in range(start, end, block_size):
+        nbytes = min(block_size, end - offset)
+        if throttle is None:
+            digest.update(buffer[offset:offset + nbytes])
+            continue
+        throttle.take(nbytes)
+        # copying the block out of the map is when its pages are actually read
+        began = time.monotonic()
+        block = buffer[offset:offset + nbytes]
+        throttle.observe(time.monotonic() - began, nbytes)
+        digest.update(block)
+    return digest
+
+
+class Checksummer(object):
+    """Compute content checksums from memory-mapped files on a pool of threads.
+
+    A file of up to chunk_size bytes gets a plain digest, "<algorithm>:<hex>".
+    A larger file is split into chunks hashed in parallel, and the digest of
+    the chunk digests is reported as "<algorithm>-tree-<chunk_size>:<hex>".
+    hashlib releases the GIL while hashing, so threads use several cores.
+    Reads are limited to rate bytes per second (0 for no limit), and slowed
+    further while the storage is slow to answer them (see
+    radiam_throttle.AdaptiveThrottle; read_latency is the seconds a block
+    of block_size bytes may take, by default judged from experience). Results
+    are kept in cache, a radiam_cache.StatCache, so only new and changed
+    files are ever read. Records go through submit(), completed() and
+    drain() the same way as with radiam_enrich.MetadataEnricher.
+    """
+
+    def __init__(self, workers=None, rate=0, cache=None, chunk_size=default_chunk_size, max_pending=None, logger=None,
+                 read_latency=None, adaptive=True):
+        self.workers = workers or os.cpu_count() or 1
+        if adaptive:
+            self.throttle = AdaptiveThrottle(rate, max(int(rate or 0), block_size), read_latency, floor=0.05,
+                                             min_rate=block_size, name="checksum reads", logger=logger)
+        else:
+            self.throttle = TokenBucket(rate, max(int(rate or 0), block_size))
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.logger = logger
+        self.max_pending = max_pending or self.workers * 8
+        # Whole files and the chunks of large files run on separate pools so a
+        # file waiting for its chunks can never starve them of threads
+        self.files = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.chunks = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = []
+        self.ready = []
+
+    def lane(self):
+        """Return a view sharing this checksummer's threads that hands back only the records submitted to it.
+
+        Concurrent crawl jobs each use their own lane. A lane is never closed.
+        """
+        lane = copy.copy(self)
+        lane.pending = []
+        lane.ready = []
+        return lane
+
+    def version(self, algorithm):
+        return "checksum-{}-{}".format(algorithm, self.chunk_size)
+
+    def cached(self, key, algorithm):
+        if self.cache is None or key is None:
+            return False, None
+        return self.cache.get(key, self.version(algorithm))
+
+    def compute(self, path, algorithm):
+        with open(path, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            if size == 0:
+                return "{}:{}".format(algorithm, hashlib.new(algorithm).hexdigest())
+            buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if size <= self.chunk_size:
+                    return "{}:{}".format(algorithm, hash_range(algorithm, buffer, 0, size, self.throttle).hexdigest())
+                futures = [self.chunks.submit(hash_range, algorithm, buffer, start,
+                                              min(start + self.chunk_size, size), self.throttle)
+                           for start in range(0, size, self.chunk_size)]
+                tree = hashlib.new(algorithm)
+                for future in futures:
+                    tree.update(future.result().digest())
+                return "{}-tree-{}:{}".format(algorithm, self.chunk_size, tree.hexdigest())
+            finally:
+                buffer.close()
+
+    def checksum(self, path, algorithm, key=None):
+        """Return the checksum of path, from the cache when the file is unchanged"""
+        if key is None:
+            key = stat_key(os.lstat(path))
+        hit, value = self.cached(key, algorithm)
+        if hit:
+            return value
+        with radiam_profile.stage("checksum"):
+            value = self.compute(path, algorithm)
+        if self.cache is not None:
+            self.cache.put(key, self.version(algorithm), value)
+        return value
+
+    def submit(self, record, algorithm):
+        self.pending.append((self.files.submit(self.checksum, record['path'], algorithm), record))
+        if len(self.pending) > self.max_pending:
+            self.ready.append(self._finish(*self.pending.pop(0)))
+
+    def _finish(self, future, record):
+        try:
+            record['checksum'] = future.result()
+        except Exception as e:
+            if self.logger:
+                self.logger.warning("Could not checksum %s: %s", record['path'], e)
+            record['checksum'] = None
+        return record
+
+    def completed(self):
+        """Return the records whose checksum is done, without waiting"""
+        done = self.ready
+        self.ready = []
+        still_pending = []
+        for future, record in self.pending:
+            if future.done():
+                done.append(self._finish(future, record))
+            else:
+                still_pending.append((future, record))
+        self.pending = still_pending
+        return done
+
+    def drain(self):
+        """Wait for every submitted record and return them"""
+        done = self.ready
+        self.ready = []
+        for future, record in self.pending:
+            done.append(self._finish(future, record))
+        self.pending = []
+        return done
+
+    def close(self):
+        self.files.shutdown(wait=True)
+        self.chunks.shutdown(wait=True)
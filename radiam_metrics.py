@@ -0,0 +1,243 @@
+import re
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+id_pattern = re.compile(r'/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)')
+
+
+def format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+def endpoint_label(url):
+    """Reduce a request URL to a low-cardinality endpoint label"""
+    path = re.sub(r'^[A-Za-z]+://[^/]*', '', url.split('?', 1)[0])
+    path = re.sub(r'/+', '/', path)
+    path = id_pattern.sub('/{id}', path)
+    # document ids are appended to docs/ for deletes
+    return re.sub(r'/docs/[^/]+$', '/docs/{id}', path)
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labelvalues, value in items:
+            lines.append("{}{} {}".format(self.name, format_labels(self.labelnames, labelvalues), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                state = self.values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def summary(self):
+        """Return (count, sum) over all label values"""
+        with self.lock:
+            return sum(s[2] for s in self.values.values()), sum(s[1] for s in self.values.values())
+
+    def quantile(self, q):
+        """Estimate a quantile over all label values as the upper bound of its bucket"""
+        with self.lock:
+            counts = [sum(s[0][i] for s in self.values.values()) for i in range(len(self.buckets))]
+            count = sum(s[2] for s in self.values.values())
+        if not count:
+            return None
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= q * count:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            items = sorted((k, ([list(v[0]), v[1], v[2]])) for k, v in self.values.items())
+        for labelvalues, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(self.name, format_labels(self.labelnames, labelvalues, ("le", bound)), cumulative))
+            lines.append("{}_bucket{} {}".format(self.name, format_labels(self.labelnames, labelvalues, ("le", "+Inf")), count))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.labelnames, labelvalues), total))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.labelnames, labelvalues), count))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, description, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, description, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self._get(Counter, name, description, labelnames)
+
+    def gauge(self, name, description, labelnames=()):
+        return self._get(Gauge, name, description, labelnames)
+
+    def histogram(self, name, description, labelnames=(), buckets=default_buckets):
+        return self._get(Histogram, name, description, labelnames, buckets=buckets)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = [self.metrics[k] for k in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self, logger, elapsed=None, previous=None):
+        """Log one line per metric with totals, returning the counter totals for rate calculation"""
+        with self.lock:
+            metrics = [self.metrics[k] for k in sorted(self.metrics)]
+        totals = {}
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                count, total = metric.summary()
+                if count:
+                    logger.info("Metric %s: count %s, mean %.4f", metric.name, count, total / count)
+            elif isinstance(metric, Counter):
+                totals[metric.name] = metric.total()
+                if elapsed and previous is not None:
+                    rate = (totals[metric.name] - previous.get(metric.name, 0)) / elapsed
+                    logger.info("Metric %s: %s (%.2f/s)", metric.name, totals[metric.name], rate)
+                else:
+                    logger.info("Metric %s: %s", metric.name, totals[metric.name])
+            else:
+                with metric.lock:
+                    values = dict(metric.values)
+                for labelvalues, value in sorted(values.items()):
+                    logger.info("Metric %s%s: %s", metric.name, format_labels(metric.labelnames, labelvalues), value)
+        return totals
+
+
+registry = MetricsRegistry()
+
+api_requests = registry.counter("radiam_api_requests_total", "Radiam API requests by endpoint, method and status code", ("endpoint", "method", "status"))
+api_latency = registry.histogram("radiam_api_request_seconds", "Radiam API request latency by endpoint", ("endpoint", "method"))
+api_bytes_sent = registry.counter("radiam_api_bytes_sent_total", "Request body bytes sent to the Radiam API", ("endpoint",))
+api_retries = registry.counter("radiam_api_retries_total", "Radiam API requests retried, by reason", ("reason",))
+bulk_documents = registry.histogram("radiam_bulk_batch_documents", "Documents per bulk upload", buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000))
+bulk_bytes = registry.histogram("radiam_bulk_batch_bytes", "Bytes per bulk upload", buckets=(1e4, 1e5, 5e5, 1e6, 2e6, 5e6, 1e7, 5e7))
+crawl_entries = registry.counter("radiam_crawl_entries_total", "Files and directories indexed by the crawler", ("project", "type"))
+monitor_events = registry.counter("radiam_monitor_events_total", "File system events handled by the monitor", ("project", "event"))
+event_latency = registry.histogram("radiam_monitor_event_seconds", "Time from receiving a file system event until it is indexed", ("project",))
+event_late = registry.counter("radiam_monitor_events_late_total", "File system events indexed later than event_latency_target", ("project",))
+queue_depth = registry.gauge("radiam_queue_depth", "Items waiting in agent queues", ("queue",))
+extract_calls = registry.counter("radiam_extract_calls_total", "Files given to each metadata extractor", ("extractor",))
+extract_errors = registry.counter("radiam_extract_errors_total", "Files each metadata extractor failed to parse", ("extractor",))
+extract_seconds = registry.counter("radiam_extract_seconds_total", "Time spent in each metadata extractor", ("extractor",))
+extract_bytes = registry.counter("radiam_extract_bytes_read_total", "Bytes read by each metadata extractor", ("extractor",))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, metrics_registry=registry, address="127.0.0.1"):
+    """Serve the registry in Prometheus text format on a local port from a daemon thread"""
+    server = MetricsServer((address, int(port)), MetricsHandler)
+    server.registry = metrics_registry
+    thread = threading.Thread(target=server.serve_forever, name="radiam-metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_log_dump(interval, logger, metrics_registry=registry):
+    """Periodically write a summary of the registry to the log from a daemon thread"""
+    def dump():
+        previous = None
+        last = time.time()
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            previous = metrics_registry.log_summary(logger, now - last, previous)
+            last = now
+
+    thread = threading.Thread(target=dump, name="radiam-metrics-log")
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,88 @@
+import fnmatch
+import json
+
+
+def config_list(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip() for v in value if v.strip()]
+
+
+class PayloadPolicy(object):
+    """Trim the extended_metadata of a document to what a project wants uploaded.
+
+    include and exclude are lists of field name patterns. Top-level fields
+    are kept only if they match an include pattern (when there are any),
+    and a field at any depth is dropped if its dotted path, such as
+    GPSInfo.GPSLatitude, matches an exclude pattern. Strings are cut to
+    value_limit characters, lists to list_limit items and bytes dropped.
+    If the result still serializes to more than max_bytes, the largest
+    top-level fields are dropped and named in truncated_fields.
+    """
+
+    def __init__(self, include=(), exclude=(), value_limit=None, list_limit=None, max_bytes=None):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.value_limit = value_limit
+        self.list_limit = list_limit
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_config(cls, project_config):
+        return cls(config_list(project_config.get("extended_include")),
+                   config_list(project_config.get("extended_exclude")),
+                   int(project_config.get("extended_value_limit", 1024)) or None,
+                   int(project_config.get("extended_list_limit", 100)) or None,
+                   int(project_config.get("extended_max_bytes", 32768)) or None)
+
+    def excluded(self, path):
+        return any(fnmatch.fnmatchcase(path, pattern) for pattern in self.exclude)
+
+    def value(self, value, path):
+        if isinstance(value, dict):
+            return self.fields(value, path + ".")
+        if isinstance(value, (list, tuple)):
+            items = value[:self.list_limit] if self.list_limit else value
+            return [v for v in (self.value(v, path) for v in items) if v is not None]
+        if isinstance(value, bytes):
+            return None
+        if isinstance(value, str):
+            return value[:self.value_limit] if self.value_limit else value
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        # anything json can't serialize is sent as its string form
+        return self.value(str(value), path)
+
+    def fields(self, metadata, prefix=""):
+        kept = {}
+        for key, value in metadata.items():
+            path = prefix + str(key)
+            if self.excluded(path):
+                continue
+            value = self.value(value, path)
+            if value is not None:
+                kept[str(key)] = value
+        return kept
+
+    def apply(self, metadata):
+        if not isinstance(metadata, dict):
+            return metadata
+        if self.include:
+            metadata = dict((k, v) for k, v in metadata.items()
+                            if any(fnmatch.fnmatchcase(str(k), pattern) for pattern in self.include))
+        kept = self.fields(metadata)
+        if self.max_bytes:
+            sizes = dict((key, len(json.dumps(value))) for key, value in kept.items())
+            total = sum(sizes.values()) + sum(len(json.dumps(key)) + 2 for key in kept)
+            dropped = []
+            for key in sorted(sizes, key=sizes.get, reverse=True):
+                if total <= self.max_bytes:
+                    break
+                total -= sizes[key] + len(json.dumps(key)) + 2
+                del kept[key]
+                dropped.append(key)
+            if dropped:
+                kept["truncated_fields"] = dropped
+        return kept
@@ -0,0 +1,227 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# CPU time is charged to stages from the clock of the thread running them where Python has one
+# (3.7 and later), and otherwise from the clock of the whole process, counting every thread
+thread_clock = getattr(time, "thread_time", time.process_time)
+cpu_clock = "thread_time" if hasattr(time, "thread_time") else "process_time"
+
+# The profiler of the crawl in progress, if it is being profiled; see start() and stage()
+active = None
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_stage = NullStage()
+
+
+class Stage(object):
+    __slots__ = ("totals", "wall", "cpu")
+
+    def __init__(self, totals):
+        self.totals = totals
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = thread_clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.totals[0] += 1
+        self.totals[1] += time.perf_counter() - self.wall
+        self.totals[2] += thread_clock() - self.cpu
+        return False
+
+
+class ThreadProfile(object):
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        profile = self.profiler.local.profile = cProfile.Profile()
+        with self.profiler.lock:
+            self.profiler.profiles.append(profile)
+        profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        # the profile may already have been stopped at the end of the capture window
+        if getattr(self.profiler.local, "profile", None) is not None:
+            self.profiler.local.profile.disable()
+            self.profiler.local.profile = None
+        return False
+
+
+class StageProfiler(object):
+    """Attribute the wall and CPU time of a crawl to the stages of its work.
+
+    Each thread adds up the calls, wall time and CPU time of its stages in
+    a table of its own, so timing a stage takes no lock; report() merges
+    the tables. With capture set to "cprofile", the threads that run under
+    thread() are profiled as well, and with "tracemalloc" memory
+    allocations are traced; either way only for the first window seconds.
+    """
+
+    def __init__(self, capture=None, window=60):
+        self.capture = capture
+        self.window = window
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.tables = []
+        self.profiles = []
+        self.snapshot = None
+        self.timer = None
+        self.started = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.capture_until = self.wall + window
+        if capture == "tracemalloc":
+            tracemalloc.start(10)
+            self.timer = threading.Timer(window, self.take_snapshot)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def table(self):
+        table = getattr(self.local, "table", None)
+        if table is None:
+            table = self.local.table = {}
+            with self.lock:
+                self.tables.append(table)
+        return table
+
+    def stage(self, name):
+        profile = getattr(self.local, "profile", None)
+        if profile is not None and time.perf_counter() > self.capture_until:
+            profile.disable()
+            self.local.profile = None
+        table = self.table()
+        totals = table.get(name)
+        if totals is None:
+            totals = table[name] = [0, 0.0, 0.0]
+        return Stage(totals)
+
+    def add(self, name, calls, seconds):
+        """Add work timed elsewhere, such as in worker processes, to stage name"""
+        totals = self.table().setdefault(name, [0, 0.0, 0.0])
+        totals[0] += calls
+        totals[1] += seconds
+
+    def thread(self):
+        """Return a context in which the current thread is profiled, if capturing with cProfile"""
+        if self.capture != "cprofile" or time.perf_counter() > self.capture_until:
+            return null_stage
+        return ThreadProfile(self)
+
+    def take_snapshot(self):
+        if self.snapshot is None and tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def stages(self):
+        merged = {}
+        with self.lock:
+            tables = list(self.tables)
+        for table in tables:
+            for name, (calls, wall, cpu) in list(table.items()):
+                totals = merged.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += calls
+                totals[1] += wall
+                totals[2] += cpu
+        return merged
+
+    def report(self, directory, logger=None):
+        """Write the report, and any capture, to directory as profile_<time>.* files and return the report"""
+        elapsed = time.perf_counter() - self.wall
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        base = os.path.join(directory, "profile_" + stamp)
+        stages = self.stages()
+        report = {
+            "started": self.started,
+            "seconds": elapsed,
+            "cpu_seconds": time.process_time() - self.cpu,
+            "stages": dict((name, {"calls": calls, "wall_seconds": wall, "cpu_seconds": cpu})
+                           for name, (calls, wall, cpu) in stages.items()),
+            "capture": self.capture,
+            "cpu_clock": cpu_clock
+        }
+        if self.capture == "cprofile" and self.profiles:
+            for profile in self.profiles:
+                profile.disable()
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(base + ".pstats")
+            report["capture_file"] = base + ".pstats"
+            text = io.StringIO()
+            stats.stream = text
+            stats.sort_stats("cumulative").print_stats(20)
+            report["top"] = text.getvalue()
+        elif self.capture == "tracemalloc":
+            self.timer.cancel()
+            self.take_snapshot()
+            if self.snapshot is not None:
+                self.snapshot.dump(base + ".tracemalloc")
+                report["capture_file"] = base + ".tracemalloc"
+                report["top"] = "\n".join(str(stat) for stat in self.snapshot.statistics("lineno")[:20])
+        with open(base + ".json", "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        report["report_file"] = base + ".json"
+        if logger:
+            logger.info("Crawl profile, %.1fs wall and %.1fs CPU in all (stage CPU from %s):\n%s", report["seconds"],
+                        report["cpu_seconds"], cpu_clock, format_table(stages))
+            logger.info("Profile written to %s", report["report_file"])
+        return report
+
+
+def format_table(stages):
+    """Format merged stage totals as a table, most expensive stage first"""
+    total = sum(wall for calls, wall, cpu in stages.values()) or 1.0
+    lines = ["{:<16} {:>10} {:>10} {:>10} {:>7}".format("stage", "calls", "wall s", "cpu s", "share")]
+    for name, (calls, wall, cpu) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        lines.append("{:<16} {:>10} {:>10.3f} {:>10.3f} {:>6.1f}%".format(name, calls, wall, cpu, 100.0 * wall / total))
+    return "\n".join(lines)
+
+
+def stage(name):
+    """Time a block of work as stage name while a crawl is profiled: with radiam_profile.stage("lstat"): ..."""
+    if active is None:
+        return null_stage
+    return active.stage(name)
+
+
+def add(name, calls, seconds):
+    if active is not None:
+        active.add(name, calls, seconds)
+
+
+def thread():
+    if active is None:
+        return null_stage
+    return active.thread()
+
+
+def start(capture=None, window=60):
+    global active
+    active = StageProfiler(capture, window)
+    return active
+
+
+def finish(directory, logger=None):
+    """Stop profiling and write the report to directory"""
+    global active
+    profiler, active = active, None
+    if profiler is None:
+        return None
+    return profiler.report(directory, logger)
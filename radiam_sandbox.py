@@ -0,0 +1,240 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+# only available on non-Windows, and optional
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class SandboxTimeout(Exception):
+    pass
+
+
+class SandboxCrash(Exception):
+    pass
+
+
+def sandbox_worker(conn, memory_limit):
+    # RLIMIT_DATA caps the heap without counting read-only file mappings, so
+    # header readers can still map multi-GB files
+    if memory_limit and resource is not None and hasattr(resource, "RLIMIT_DATA"):
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        fn, args = task
+        try:
+            result = (True, fn(*args))
+        except BaseException as e:
+            result = (False, "{}: {}".format(type(e).__name__, e))
+        conn.send(result)
+
+
+class SandboxWorker(object):
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=sandbox_worker, args=(child_conn, memory_limit), name="radiam-sandbox")
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+        self.count = 0
+
+    def kill(self):
+        # Process.kill() is new in Python 3.7; SIGTERM is all Windows has
+        if hasattr(signal, "SIGKILL"):
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        else:
+            self.process.terminate()
+
+    def stop(self, kill=False):
+        if kill:
+            self.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                self.kill()
+        self.process.join(5)
+        self.conn.close()
+
+
+class SandboxPool(object):
+    """Run functions in worker processes that are killed when they overrun.
+
+    Works like a concurrent.futures executor: submit() returns a Future.
+    A task still running after deadline seconds has its worker killed and
+    its Future fails with SandboxTimeout; a worker that dies (for instance
+    by running out of the memory_limit bytes of heap it is allowed) fails
+    its Future with SandboxCrash. Either way a fresh worker takes its
+    place, and each worker is also replaced after max_tasks tasks so leaks
+    in parser libraries cannot build up. Exceptions raised by the function
+    itself fail the Future with a RuntimeError carrying their message.
+    Tasks submitted as urgent go ahead of every task still waiting.
+    """
+
+    def __init__(self, workers=None, deadline=60, memory_limit=None, max_tasks=1000, logger=None):
+        self.size = workers or os.cpu_count() or 1
+        self.deadline = deadline
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+        self.logger = logger
+        self.context = multiprocessing.get_context()
+        self.workers = [None] * self.size
+        self.tasks = collections.deque()
+        self.lock = threading.Condition()
+        # submit() writes to this pipe to wake the supervisor while it waits on busy workers, when one
+        # is idle; otherwise the next finished task wakes it anyway
+        self.wake_recv, self.wake_send = multiprocessing.Pipe(duplex=False)
+        self.woken = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.supervise, name="radiam-sandbox-supervisor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn, *args, urgent=False):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("SandboxPool is shut down")
+            if urgent:
+                self.tasks.appendleft((future, fn, args))
+            else:
+                self.tasks.append((future, fn, args))
+            self.lock.notify()
+            wake = not self.woken and any(w is None or w.task is None for w in self.workers)
+            if wake:
+                self.woken = True
+        if wake:
+            self.wake_send.send_bytes(b"")
+        return future
+
+    def _assign(self):
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                if not self.tasks:
+                    break
+                if worker is not None and worker.task is not None:
+                    continue
+                if worker is None:
+                    worker = self.workers[i] = SandboxWorker(self.context, self.memory_limit)
+                future, fn, args = self.tasks.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                worker.conn.send((fn, args))
+                worker.task = future
+                worker.started = time.monotonic()
+
+    def _replace(self, i, kill):
+        self.workers[i].stop(kill)
+        self.workers[i] = None
+
+    def supervise(self):
+        while True:
+            self._assign()
+            busy = [(i, w) for i, w in enumerate(self.workers) if w is not None and w.task is not None]
+            if not busy:
+                with self.lock:
+                    if self.closed and not self.tasks:
+                        break
+                    if not self.tasks:
+                        self.lock.wait(0.5)
+                continue
+            timeout = min(w.started + self.deadline for i, w in busy) - time.monotonic()
+            ready = multiprocessing.connection.wait([w.conn for i, w in busy] + [self.wake_recv], max(0, timeout))
+            with self.lock:
+                while self.wake_recv.poll():
+                    self.wake_recv.recv_bytes()
+                self.woken = False
+            for i, worker in busy:
+                if worker.conn in ready:
+                    try:
+                        ok, result = worker.conn.recv()
+                    except (EOFError, OSError):
+                        worker.task.set_exception(SandboxCrash("Extraction worker exited with code {}".format(
+                            worker.process.exitcode)))
+                        self._replace(i, True)
+                        continue
+                    if ok:
+                        worker.task.set_result(result)
+                    else:
+                        worker.task.set_exception(RuntimeError(result))
+                    worker.task = None
+                    worker.count += 1
+                    if worker.count >= self.max_tasks:
+                        self._replace(i, False)
+                elif time.monotonic() - worker.started > self.deadline:
+                    worker.task.set_exception(SandboxTimeout("Extraction ran past its {}s deadline".format(self.deadline)))
+                    self._replace(i, True)
+        for i, worker in enumerate(self.workers):
+            if worker is not None:
+                self._replace(i, False)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.wake_send.send_bytes(b"")
+        if wait:
+            self.thread.join()
+            self.wake_send.close()
+            self.wake_recv.close()
+
+
+class Quarantine(object):
+    """A persistent skip list of files that timed out or crashed an extraction worker.
+
+    Files are identified by radiam_cache.stat_key, so a file that changes is
+    given another chance; one that failed threshold times is blocked.
+    """
+
+    def __init__(self, path, threshold=2):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS quarantine (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                        "path TEXT, failures INTEGER, reason TEXT, last_failure REAL, PRIMARY KEY (dev, ino))")
+        self.db.commit()
+
+    def failures(self, key):
+        dev, ino, size, mtime_ns = key
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, failures FROM quarantine WHERE dev = ? AND ino = ?",
+                                  (dev, ino)).fetchone()
+        if row is None or tuple(row[:2]) != (size, mtime_ns):
+            return 0
+        return row[2]
+
+    def blocked(self, key):
+        return key is not None and self.failures(key) >= self.threshold
+
+    def failed(self, key, path, reason):
+        """Record a failure and return True if the file is now blocked"""
+        failures = self.failures(key) + 1
+        dev, ino, size, mtime_ns = key
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (dev, ino, size, mtime_ns, path, failures, reason, time.time()))
+            self.db.commit()
+        return failures >= self.threshold
+
+    def close(self):
+        with self.lock:
+            self.db.close()
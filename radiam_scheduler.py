@@ -0,0 +1,118 @@
+import itertools
+import threading
+
+# Priority classes, most urgent first: live file system events, then background crawling
+LIVE = 0
+CRAWL = 1
+
+
+class Cancelled(Exception):
+    """Raised in a job that asks for a worker slot after the scheduler was cancelled"""
+
+
+class FairScheduler(object):
+    """Share a fixed number of worker slots between jobs by weighted fair queuing.
+
+    A job holds a slot while it works through a slice of its work and then
+    releases it with the cost of that slice, for instance the number of
+    entries scanned. Each job accrues virtual time at cost / weight, and a
+    free slot always goes to the waiting job with the least virtual time,
+    so a job with twice the weight gets twice the throughput and a huge job
+    cannot hold small ones off for longer than one slice. A job that joins
+    late, or comes back after idling, starts at the virtual time of the
+    work granted most recently instead of catching up on credit it never
+    used.
+
+    Fair queuing only applies between jobs of the same priority: a free
+    slot goes to a job of a more urgent priority class first. Jobs of a
+    less urgent class check urgent() between units of their work and give
+    up their slot early while one is waiting, so an urgent job waits for
+    at most one unit of background work, not a whole slice.
+
+    While the scheduler is paused no slot is handed out, and jobs check
+    paused between units of their work the same way, so everything stops
+    within one unit and carries on where it was after resume(). Once it is
+    cancelled, jobs waiting for a slot or asking for one get Cancelled.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers))
+        self.running = 0
+        # virtual time of the work granted most recently, for each priority class
+        self.vtime = {}
+        self.jobs = {}
+        self.waiting = {}
+        self.order = itertools.count()
+        self.paused = False
+        self.cancelled = False
+        self.lock = threading.Condition()
+
+    def add(self, name, weight=1.0, priority=CRAWL):
+        with self.lock:
+            self.jobs[name] = {"weight": max(float(weight), 0.001), "vtime": self.vtime.get(priority, 0.0), "cost": 0.0,
+                               "priority": priority}
+
+    def remove(self, name):
+        with self.lock:
+            self.jobs.pop(name, None)
+            self.waiting.pop(name, None)
+            self.lock.notify_all()
+
+    def _next(self):
+        return min(self.waiting, key=lambda name: (self.jobs[name]["priority"], self.jobs[name]["vtime"],
+                                                   self.waiting[name]))
+
+    def acquire(self, name):
+        """Wait until job name is given a worker slot"""
+        with self.lock:
+            job = self.jobs[name]
+            job["vtime"] = max(job["vtime"], self.vtime.get(job["priority"], 0.0))
+            self.waiting[name] = next(self.order)
+            while not self.cancelled and (self.paused or self.running >= self.workers or self._next() != name):
+                self.lock.wait()
+            del self.waiting[name]
+            if self.cancelled:
+                self.lock.notify_all()
+                raise Cancelled(name)
+            self.running += 1
+            self.vtime[job["priority"]] = job["vtime"]
+
+    def release(self, name, cost=1.0):
+        """Give back the slot held by job name, charging it cost"""
+        with self.lock:
+            job = self.jobs.get(name)
+            if job is not None:
+                job["vtime"] += cost / job["weight"]
+                job["cost"] += cost
+            self.running -= 1
+            self.lock.notify_all()
+
+    def urgent(self, name):
+        """Return True if a job more urgent than job name is waiting for a slot"""
+        with self.lock:
+            priority = self.jobs[name]["priority"]
+            return any(self.jobs[waiting]["priority"] < priority for waiting in self.waiting)
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.lock.notify_all()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            self.lock.notify_all()
+
+    def wait(self, timeout):
+        """Sleep for up to timeout seconds, and return True as soon as the scheduler is cancelled"""
+        with self.lock:
+            return self.lock.wait_for(lambda: self.cancelled, timeout)
+
+    def usage(self):
+        """Return the total cost charged to each job so far"""
+        with self.lock:
+            return dict((name, job["cost"]) for name, job in self.jobs.items())
@@ -0,0 +1,174 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+class ShardCoordinator(object):
+    """Share the crawl of one project's rootdir between agents through a SQLite file they can all reach.
+
+    The tree is split into units, each a directory whose subtree one agent
+    crawls, less any subdirectories that are units of their own. The first
+    agent seeds the rootdir and its top-level subdirectories as units.
+    Agents claim open units under a lease that a daemon thread renews every
+    quarter lease while they hold any, so a unit whose agent died is claimed
+    again once its lease runs out. An
+    agent with directories queued gives half of them away as new units
+    whenever another agent is idle and no units are open, so the work
+    spreads until every agent is busy. A unit is marked done once the API
+    has acknowledged its documents. A crawl that has finished counts as the
+    current one for another lease period, so agents starting a little late
+    do not start it over.
+    """
+
+    def __init__(self, path, owner, lease=300, poll=0.5, share_interval=1.0):
+        self.owner = owner
+        self.lease = lease
+        self.poll = poll
+        self.share_interval = share_interval
+        self.last_share = 0.0
+        self.claimed = set()
+        # the renewing thread shares the connection, one transaction at a time
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.renewer = None
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS units (path TEXT PRIMARY KEY, state TEXT, owner TEXT, "
+                        "lease_until REAL, attempts INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS units_state ON units (state)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS agents (owner TEXT PRIMARY KEY, idle INTEGER, seen REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _transaction(self, fn, *args):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(*args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def _state(self, key):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _seed(self, rootdir, paths):
+        now = time.time()
+        left = self.db.execute("SELECT COUNT(*) FROM units WHERE state != 'done'").fetchone()[0]
+        finished = self._state("finished")
+        if self._state("rootdir") == rootdir and (left or (finished and now - float(finished) < self.lease)):
+            return False
+        self.db.execute("DELETE FROM units")
+        self.db.execute("DELETE FROM state")
+        self.db.execute("INSERT INTO state VALUES ('rootdir', ?)", (rootdir,))
+        self.db.executemany("INSERT OR IGNORE INTO units VALUES (?, 'open', NULL, 0, 0)", ((p,) for p in paths))
+        return True
+
+    def seed(self, rootdir, paths):
+        """Start a crawl of rootdir with paths as its units, unless one is already under way; return True if started"""
+        return self._transaction(self._seed, rootdir, [rootdir] + list(paths))
+
+    def _claim(self):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO agents VALUES (?, 0, ?)", (self.owner, now))
+        row = self.db.execute("SELECT path FROM units WHERE state = 'open' OR (state = 'leased' AND lease_until < ?) "
+                              "ORDER BY rowid LIMIT 1", (now,)).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE units SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                            "WHERE path = ?", (self.owner, now + self.lease, row[0]))
+            return row[0]
+        if self.db.execute("SELECT COUNT(*) FROM units WHERE state = 'leased'").fetchone()[0]:
+            # other agents are still busy and may give some of their work away
+            self.db.execute("UPDATE agents SET idle = 1 WHERE owner = ?", (self.owner,))
+            return False
+        if self._state("finished") is None:
+            self.db.execute("INSERT INTO state VALUES ('finished', ?)", (str(now),))
+        return None
+
+    def claim(self, wait=True):
+        """Wait for a unit to crawl and return its path, or None once every unit is done.
+
+        Without wait, return False instead of waiting for busy agents.
+        """
+        while True:
+            path = self._transaction(self._claim)
+            if path is not False:
+                if path is not None:
+                    with self.lock:
+                        self.claimed.add(path)
+                    self.start_renewing()
+                return path
+            if not wait:
+                return False
+            time.sleep(self.poll)
+
+    def units(self):
+        """Return the path of every unit, so a crawl can leave them to whoever claims them"""
+        with self.lock:
+            return set(row[0] for row in self.db.execute("SELECT path FROM units"))
+
+    def renew(self):
+        """Extend the leases of the units this agent holds"""
+        now = time.time()
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            self.db.executemany("UPDATE units SET lease_until = ? WHERE path = ? AND owner = ?",
+                                ((now + self.lease, path, self.owner) for path in self.claimed))
+            self.db.execute("UPDATE agents SET seen = ? WHERE owner = ?", (now, self.owner))
+
+    def start_renewing(self):
+        """Renew the leases every quarter lease from a daemon thread, however long a flush or a directory takes"""
+        if self.renewer is not None:
+            return
+
+        def run():
+            while not self.stopped.wait(self.lease / 4.0):
+                if self.claimed:
+                    try:
+                        self.renew()
+                    except sqlite3.Error:
+                        # the shared file may be busy or briefly unreachable; the next round tries again
+                        pass
+
+        self.renewer = threading.Thread(target=run, name="radiam-shard-lease")
+        self.renewer.daemon = True
+        self.renewer.start()
+
+    def wanted(self):
+        """Return True if an idle agent is waiting for work, checking at most every share_interval seconds"""
+        now = time.time()
+        if now - self.last_share < self.share_interval:
+            return False
+        self.last_share = now
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM units WHERE state = 'open' LIMIT 1").fetchone():
+                return False
+            return self.db.execute("SELECT 1 FROM agents WHERE idle = 1 AND seen > ? LIMIT 1",
+                                   (now - self.lease,)).fetchone() is not None
+
+    def split(self, paths):
+        """Give directories away as new open units"""
+        self._transaction(self.db.executemany, "INSERT OR IGNORE INTO units VALUES (?, 'open', NULL, 0, 0)",
+                          ((p,) for p in paths))
+
+    def complete(self, paths):
+        """Mark units done once their documents have been acknowledged"""
+        self._transaction(self.db.executemany, "UPDATE units SET state = 'done', lease_until = 0 WHERE path = ? AND owner = ?",
+                          ((p, self.owner) for p in paths))
+        with self.lock:
+            self.claimed.difference_update(paths)
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            self.db.execute("DELETE FROM agents WHERE owner = ?", (self.owner,))
+            self.db.close()
+
+
+def shard_owner(agent_id):
+    """Identify one agent process, as several may run with the same configuration on one node or on several"""
+    return "{}:{}:{}".format(agent_id, socket.gethostname(), os.getpid())
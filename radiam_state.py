@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class CrawlState(object):
+    """What one project's tree looked like when it was last indexed, so a rescan can upload only what changed.
+
+    For every directory indexed, the state holds its modification time
+    and its entries: each subdirectory, and each file with the
+    radiam_cache.stat_key of the version that was uploaded. Adding,
+    removing or renaming an entry changes the modification time of its
+    directory, so a rescan lists only the directories whose time changed
+    and walks the others through their recorded subdirectories. A file
+    rewritten in place does not change its directory's time, though, so
+    rescans list every directory again once the state is older than
+    verify_after seconds, still uploading only the files that changed.
+    The state is cleared when the project rootdir it was made for changes.
+    """
+
+    def __init__(self, path, rootdir, verify_after=7 * 86400):
+        self.verify_after = verify_after
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (parent TEXT, name TEXT, dev INTEGER, ino INTEGER, "
+                        "size INTEGER, mtime_ns INTEGER, PRIMARY KEY (parent, name))")
+        row = self.db.execute("SELECT value FROM state WHERE key = 'rootdir'").fetchone()
+        if row is None or row[0] != rootdir:
+            self._clear()
+            self.db.execute("INSERT OR REPLACE INTO state VALUES ('rootdir', ?)", (rootdir,))
+        self.db.commit()
+        verified = self._value("verified")
+        # an empty state is verified by the full crawl that fills it
+        self.verifying = verified is not None and time.time() - float(verified) > verify_after
+        self.started = time.time()
+
+    def _clear(self):
+        for table in ("dirs", "entries"):
+            self.db.execute("DELETE FROM {}".format(table))
+        self.db.execute("DELETE FROM state WHERE key != 'rootdir'")
+
+    def _value(self, key):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _subtree(self, column, path):
+        # every path below path sorts between path + sep and path + the character after sep
+        return ("{0} >= ? AND {0} < ?".format(column), (path + os.sep, path + chr(ord(os.sep) + 1)))
+
+    def directory(self, path):
+        """Return whether directory path is recorded, and the modification time it was recorded with"""
+        with self.lock:
+            row = self.db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (path,)).fetchone()
+        return (True, row[0]) if row is not None else (False, None)
+
+    def entries(self, path):
+        """Return the recorded entries of directory path, as a dict of name to stat_key, or None for a directory"""
+        with self.lock:
+            return dict((row[0], tuple(row[1:]) if row[1] is not None else None) for row in self.db.execute(
+                "SELECT name, dev, ino, size, mtime_ns FROM entries WHERE parent = ?", (path,)))
+
+    def subdirectories(self, path):
+        with self.lock:
+            return [os.path.join(path, row[0]) for row in self.db.execute(
+                "SELECT name FROM entries WHERE parent = ? AND dev IS NULL", (path,))]
+
+    def record(self, path, mtime_ns, entries):
+        """Replace the recorded entries of directory path, a dict of name to stat_key or None for a directory.
+
+        The directory is recorded as changed if it was modified so recently
+        that a change in the same clock tick could go unnoticed.
+        """
+        if mtime_ns is not None and self.started * 1e9 - mtime_ns < 2e9:
+            mtime_ns = None
+        with self.lock:
+            self.db.execute("DELETE FROM entries WHERE parent = ?", (path,))
+            self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                                ((path, name) + (key or (None, None, None, None)) for name, key in entries.items()))
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (path, mtime_ns))
+
+    def below(self, path):
+        """Return the paths recorded below path"""
+        where, args = self._subtree("parent", path)
+        with self.lock:
+            return [os.path.join(row[0], row[1]) for row in self.db.execute(
+                "SELECT parent, name FROM entries WHERE parent = ? OR " + where, (path,) + args)]
+
+    def forget(self, path):
+        """Drop everything recorded at or below path, returning the paths that were recorded below it"""
+        below = self.below(path)
+        where, args = self._subtree("parent", path)
+        with self.lock:
+            self.db.execute("DELETE FROM entries WHERE parent = ? OR " + where, (path,) + args)
+            where, args = self._subtree("path", path)
+            self.db.execute("DELETE FROM dirs WHERE path = ? OR " + where, (path,) + args)
+        return below
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def finish(self):
+        """Record that a rescan went through the whole tree"""
+        with self.lock:
+            if self.verifying or self._value("verified") is None:
+                self.db.execute("INSERT OR REPLACE INTO state VALUES ('verified', ?)", (str(self.started),))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,308 @@
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+import radiam_metrics
+
+# Rates are reported over the snapshots of about this many seconds
+rate_window = 60
+
+
+class ProjectStats(object):
+    """Progress of one project's crawl and monitor.
+
+    The counters are plain attributes, each written by a single thread:
+    the crawl job's thread, the monitor's or the thread sampling the tree
+    size. Updating one costs an attribute increment and takes no lock;
+    snapshot() reads them from any thread, and works out rates over the
+    snapshots of the last rate_window seconds and an ETA from the number
+    of directories the tree is estimated to hold.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.samples = collections.deque()
+        self.state = "idle"
+        self.started = None
+        self.finished = None
+        self.incremental = False
+        self.dirs_done = 0
+        self.dirs_queued = 0
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.acknowledged = 0
+        self.pending = 0
+        self.estimated_dirs = None
+        self.estimated_entries = None
+        self.events = 0
+        self.last_error = None
+
+    def start(self, incremental=False):
+        """Start counting a new crawl from zero"""
+        with self.lock:
+            self.samples.clear()
+        self.state = "crawling"
+        self.started = time.time()
+        self.finished = None
+        self.incremental = incremental
+        self.dirs_done = self.dirs_queued = 0
+        self.files = self.directories = self.bytes = self.acknowledged = self.pending = 0
+        self.estimated_dirs = self.estimated_entries = None
+
+    def finish(self, status, cancelled=False):
+        self.state = "cancelled" if cancelled else ("finished" if status else "failed")
+        self.finished = time.time()
+        self.pending = 0
+
+    def error(self, message):
+        self.last_error = {"time": time.time(), "message": str(message)}
+
+    def snapshot(self, now=None):
+        now = now or time.time()
+        sample = (now, self.dirs_done, self.files + self.directories)
+        with self.lock:
+            self.samples.append(sample)
+            while len(self.samples) > 2 and now - self.samples[1][0] >= rate_window:
+                self.samples.popleft()
+            first = self.samples[0]
+        end = self.finished or now
+        elapsed = end - self.started if self.started else 0
+        recent = now - first[0]
+        documents = self.files + self.directories
+        found = self.dirs_done + self.dirs_queued
+        total = max(self.estimated_dirs or 0, found)
+        stats = {
+            "name": self.name,
+            "state": self.state,
+            "started": self.started,
+            "finished": self.finished,
+            "elapsed": elapsed,
+            "incremental": self.incremental,
+            "dirs_done": self.dirs_done,
+            "dirs_queued": self.dirs_queued,
+            "dirs_estimated": int(total) if self.estimated_dirs is not None else None,
+            "entries_estimated": int(self.estimated_entries) if self.estimated_entries is not None else None,
+            "files": self.files,
+            "directories": self.directories,
+            "bytes": self.bytes,
+            "acknowledged": self.acknowledged,
+            "backlog": {"directories": self.dirs_queued, "documents": self.pending},
+            "files_per_second": self.files / elapsed if elapsed > 0 else 0.0,
+            "documents_per_second": documents / elapsed if elapsed > 0 else 0.0,
+            "recent_documents_per_second": None,
+            "eta": None,
+            "events": self.events,
+            "last_error": self.last_error
+        }
+        if recent >= 1:
+            stats["recent_documents_per_second"] = (documents - first[2]) / recent
+        if self.state == "crawling" and self.estimated_dirs is not None:
+            # directories are a steadier measure of progress than files, and incremental crawls pass them all
+            if recent >= 1 and sample[1] > first[1]:
+                rate = (sample[1] - first[1]) / recent
+            else:
+                rate = self.dirs_done / elapsed if elapsed > 0 else 0.0
+            if rate > 0:
+                stats["eta"] = (total - self.dirs_done) / rate
+        return stats
+
+
+class CrawlStats(object):
+    """Every project's ProjectStats, with API latency and the last error the agent logged"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.projects = {}
+        self.last_error = None
+        self.path = None
+
+    def project(self, name):
+        with self.lock:
+            stats = self.projects.get(name)
+            if stats is None:
+                stats = self.projects[name] = ProjectStats(name)
+            return stats
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            projects = list(self.projects.values())
+        count, total = radiam_metrics.api_latency.summary()
+        return {
+            "time": now,
+            "pid": os.getpid(),
+            "projects": dict((stats.name, stats.snapshot(now)) for stats in projects),
+            "api": {
+                "requests": count,
+                "mean_seconds": total / count if count else None,
+                "p95_seconds": radiam_metrics.api_latency.quantile(0.95)
+            },
+            "last_error": self.last_error
+        }
+
+    def write(self, path=None):
+        """Write a snapshot to path, or to the path given to start_writer(), for other processes to read"""
+        path = path or self.path
+        if path is None:
+            return
+        snapshot = self.snapshot()
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "w") as stats_file:
+            json.dump(snapshot, stats_file)
+        os.replace(temp, path)
+        return snapshot
+
+    def start_writer(self, path, interval, logger=None):
+        """Write a snapshot to path every interval seconds from a daemon thread"""
+        self.path = path
+
+        def run():
+            while True:
+                try:
+                    self.write()
+                except (OSError, ValueError) as e:
+                    if logger:
+                        logger.debug("Unable to write crawl stats to %s: %s", path, e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="radiam-stats")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class ErrorHandler(logging.Handler):
+    """Keep the last warning or error logged, for the stats"""
+
+    def __init__(self, stats):
+        super(ErrorHandler, self).__init__(logging.WARNING)
+        self.stats = stats
+
+    def emit(self, record):
+        try:
+            self.stats.last_error = {"time": record.created, "level": record.levelname, "message": record.getMessage()}
+        except Exception:
+            self.handleError(record)
+
+
+stats = CrawlStats()
+
+
+def watch(logger):
+    """Record the warnings and errors logged to logger as the last error"""
+    if not any(isinstance(handler, ErrorHandler) for handler in logger.handlers):
+        logger.addHandler(ErrorHandler(stats))
+
+
+def estimate_tree(rootdir, samples, listdir, excluded=None, rng=None):
+    """Estimate the directories and entries below rootdir from samples random walks down the tree.
+
+    Each walk lists one directory per level, going down into one of its
+    subdirectories at random, and takes every directory at a level to be
+    like the one it listed (Knuth's estimator). The average of the walks
+    is an unbiased estimate of the size of the tree, which improves with
+    more walks. listdir(path) returns the os.DirEntry objects in path, and
+    excluded(path) whether a subdirectory is left out of the crawl.
+    """
+    rng = rng or random.Random()
+    dirs_total = entries_total = 0.0
+    for i in range(samples):
+        path = rootdir
+        weight = 1
+        while True:
+            dirs_total += weight
+            try:
+                entries = listdir(path)
+            except OSError:
+                break
+            entries_total += weight * len(entries)
+            subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False) and
+                       not (excluded and excluded(entry.path))]
+            if not subdirs:
+                break
+            weight *= len(subdirs)
+            path = rng.choice(subdirs)
+    return dirs_total / samples, entries_total / samples
+
+
+def start_estimate(project_stats, rootdir, samples, listdir, excluded=None):
+    """Estimate the size of the tree on a daemon thread, so the crawl can start right away"""
+    def run():
+        estimated_dirs, estimated_entries = estimate_tree(rootdir, samples, listdir, excluded)
+        project_stats.estimated_entries = estimated_entries
+        project_stats.estimated_dirs = estimated_dirs
+
+    thread = threading.Thread(target=run, name="radiam-estimate")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def read(path):
+    """Return the snapshot an agent last wrote to path, or None if there is none"""
+    try:
+        with open(path) as stats_file:
+            return json.load(stats_file)
+    except (OSError, ValueError):
+        return None
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h {:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m {:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if nbytes < 1000 or unit == "TB":
+            return "{:.1f} {}".format(nbytes, unit) if unit != "B" else "{} B".format(int(nbytes))
+        nbytes /= 1000.0
+
+
+def format_error(error):
+    return "{} {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(error["time"])), error["message"])
+
+
+def format_snapshot(snapshot, now=None):
+    """Format a snapshot for the command line"""
+    if not snapshot:
+        return "No crawl stats have been written yet."
+    now = now or time.time()
+    lines = ["Stats of agent process {} as of {} ago".format(snapshot["pid"], format_duration(now - snapshot["time"]))]
+    for name, project in sorted(snapshot["projects"].items()):
+        lines.append("Project {}: {}{}, {}".format(name, project["state"], " (incremental)" if project["incremental"] else "",
+                                                   format_duration(project["elapsed"])))
+        estimated = " of about {}".format(project["dirs_estimated"]) if project["dirs_estimated"] is not None else ""
+        lines.append("  directories  {} done{}, {} queued".format(project["dirs_done"], estimated, project["dirs_queued"]))
+        lines.append("  indexed      {} files and {} directories, {}; {} acknowledged".format(
+            project["files"], project["directories"], format_bytes(project["bytes"]), project["acknowledged"]))
+        recent = project["recent_documents_per_second"]
+        lines.append("  rate         {:.1f} files/s, {:.1f} documents/s{}".format(
+            project["files_per_second"], project["documents_per_second"],
+            " ({:.1f} recently)".format(recent) if recent is not None else ""))
+        lines.append("  backlog      {} directories, {} documents".format(project["backlog"]["directories"],
+                                                                          project["backlog"]["documents"]))
+        if project["state"] == "crawling":
+            lines.append("  ETA          {}".format(format_duration(project["eta"])))
+        if project["events"]:
+            lines.append("  monitor      {} events".format(project["events"]))
+        if project["last_error"]:
+            lines.append("  last error   {}".format(format_error(project["last_error"])))
+    api = snapshot["api"]
+    if api["requests"]:
+        lines.append("API: {} requests, {:.3f}s mean, {}s 95th percentile".format(api["requests"], api["mean_seconds"],
+                                                                              api["p95_seconds"]))
+    if snapshot["last_error"]:
+        lines.append("Last error: {}".format(format_error(snapshot["last_error"])))
+    return "\n".join(lines)
@@ -0,0 +1,121 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Limit a rate, in operations or bytes per second, shared by any number of threads.
+
+    take() blocks until the tokens it asks for are available. Tokens accrue at
+    rate per second up to burst; a request larger than the balance is granted
+    on credit and the caller sleeps off the debt, so one large read cannot
+    starve. A rate of 0 or None means unlimited.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate or 0)
+        self.burst = float(burst or self.rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount=1):
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveThrottle(TokenBucket):
+    """A TokenBucket that slows down when the storage behind it does.
+
+    Callers report how long each throttled operation took with observe().
+    Every interval seconds the average latency is compared with target, or
+    if no target is given, with slowdown times the best average seen so far
+    (taken to be what the storage does when idle) but never less than
+    floor. Above it the rate is halved, down to min_rate; otherwise it is
+    raised by a quarter until it is back at rate, the ceiling. A ceiling of
+    0 means unlimited: a slow interval starts limiting at half the observed
+    throughput, and the limit is lifted again once it is well above what
+    the agent used while unlimited.
+    """
+
+    def __init__(self, rate=0, burst=None, target=None, slowdown=4.0, floor=0.01, interval=1.0, min_rate=1.0,
+                 name="io", logger=None):
+        super(AdaptiveThrottle, self).__init__(rate, burst)
+        self.ceiling = self.rate
+        self.fixed_burst = burst
+        self.target = target
+        self.slowdown = slowdown
+        self.floor = floor
+        self.interval = interval
+        self.min_rate = min_rate
+        self.name = name
+        self.logger = logger
+        self.baseline = None
+        self.peak = 0.0
+        self.window_start = time.monotonic()
+        self.window_seconds = 0.0
+        self.window_calls = 0
+        self.window_amount = 0.0
+
+    def limit(self):
+        if self.target:
+            return self.target
+        if self.baseline is None:
+            return None
+        return max(self.floor, self.baseline * self.slowdown)
+
+    def observe(self, seconds, amount=1):
+        """Record that an operation of amount took seconds"""
+        with self.lock:
+            self.window_seconds += seconds
+            self.window_calls += 1
+            self.window_amount += amount
+            now = time.monotonic()
+            elapsed = now - self.window_start
+            if elapsed < self.interval:
+                return
+            latency = self.window_seconds / self.window_calls
+            throughput = self.window_amount / elapsed
+            self.window_start = now
+            self.window_seconds = 0.0
+            self.window_calls = 0
+            self.window_amount = 0.0
+            self._adjust(latency, throughput)
+
+    def _adjust(self, latency, throughput):
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        old_rate = self.rate
+        if not self.rate:
+            self.peak = max(self.peak, throughput)
+        if latency > self.limit():
+            self.rate = max(self.min_rate, (self.rate or throughput) / 2)
+        elif self.rate:
+            self.rate *= 1.25
+            if self.ceiling and self.rate >= self.ceiling:
+                self.rate = self.ceiling
+            elif not self.ceiling and self.rate >= 2 * self.peak:
+                self.rate = 0.0
+        if self.rate != old_rate:
+            self.burst = float(self.fixed_burst or self.rate)
+            self.tokens = min(self.tokens, self.burst)
+            if self.logger:
+                self.logger.debug("Throttle {} now at {:.0f} per second ({:.4f}s average latency)".format(
+                    self.name, self.rate, latency))
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) as one throttled operation"""
+        self.take(1)
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.observe(time.monotonic() - start)
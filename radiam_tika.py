@@ -0,0 +1,170 @@
+import concurrent.futures
+import fnmatch
+import mimetypes
+import os
+import time
+
+# Formats whose metadata lives at the start of the file; only the header is sent to Tika
+default_header_limits = "image/*:262144, audio/*:262144, video/*:1048576"
+default_size_limits = "*:500000"
+
+
+def parse_limits(value):
+    """Parse a list of mimetype-pattern:bytes pairs (a string or a ConfigObj list)"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    limits = []
+    for item in value:
+        if ":" in item:
+            pattern, nbytes = item.rsplit(":", 1)
+            limits.append((pattern.strip(), int(nbytes)))
+    return limits
+
+
+def match_limit(limits, mimetype):
+    for pattern, nbytes in limits:
+        if fnmatch.fnmatch(mimetype, pattern):
+            return nbytes
+    return None
+
+
+class TikaError(Exception):
+    pass
+
+
+class TikaSettings(object):
+    """Tika options for one project, read from its config section"""
+
+    def __init__(self, project_config):
+        self.host = project_config.get("tika_host")
+        self.timeout = float(project_config.get("tika_timeout", 30))
+        self.workers = int(project_config.get("tika_workers", 4))
+        self.retries = int(project_config.get("tika_retries", 2))
+        self.retry_delay = float(project_config.get("tika_retry_delay", 30))
+        self.size_limits = parse_limits(project_config.get("tika_size_limits", default_size_limits))
+        self.header_limits = parse_limits(project_config.get("tika_header_limits", default_header_limits))
+
+    def plan(self, path, size):
+        """Return how many leading bytes of a file to send (None for the whole file, 0 to skip it)"""
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        header = match_limit(self.header_limits, mimetype)
+        if header:
+            return header
+        budget = match_limit(self.size_limits, mimetype)
+        if budget is not None and size > budget:
+            return 0
+        return None
+
+
+def tika_metadata(path, settings):
+    """Ask Tika for a file's metadata within the settings' size budgets and deadline.
+
+    Returns None for files over budget and raises TikaError or a requests
+    exception when Tika fails or is too slow, so callers can retry later.
+    """
+    # Imported here so TIKA_LOG_PATH, set by radiam at startup, is honoured
+    from tika import parser as tikaParser
+    nbytes = settings.plan(path, os.path.getsize(path))
+    if nbytes == 0:
+        return None
+    options = {"timeout": settings.timeout}
+    if nbytes:
+        with open(path, "rb") as header_file:
+            parsed = tikaParser.from_buffer(header_file.read(nbytes), settings.host, requestOptions=options)
+    else:
+        parsed = tikaParser.from_file(path, settings.host, requestOptions=options)
+    if parsed.get("status") != 200:
+        raise TikaError("Tika returned status {} for {}".format(parsed.get("status"), path))
+    return parsed.get("metadata")
+
+
+def tika_worker(path, settings):
+    from radiam_cache import stat_key
+    key = stat_key(os.lstat(path))
+    return key, tika_metadata(path, settings)
+
+
+class TikaPool(object):
+    """Send files to Tika from a bounded pool of threads.
+
+    Works like radiam_enrich.MetadataEnricher: records go in with submit()
+    and come back completed from completed() and drain(). A request that
+    fails or runs past its deadline puts the record on a deferred retry
+    queue instead of holding up the crawl; after the last retry the record
+    is released without extended metadata.
+    """
+
+    def __init__(self, settings, logger=None, cache=None, version=None):
+        self.settings = settings
+        self.logger = logger
+        self.cache = cache
+        self.version = version
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=settings.workers)
+        self.max_pending = settings.workers * 4
+        self.pending = []
+        self.deferred = []
+        self.ready = []
+
+    def submit(self, record):
+        self._submit(record, 0)
+
+    def _submit(self, record, attempt):
+        future = self.pool.submit(tika_worker, record['path'], self.settings)
+        self.pending.append((future, record, attempt))
+        if len(self.pending) > self.max_pending:
+            self._finish(*self.pending.pop(0))
+
+    def _finish(self, future, record, attempt, final=False):
+        try:
+            key, record['extended_metadata'] = future.result()
+            if self.cache is not None:
+                self.cache.put(key, self.version, record['extended_metadata'])
+        except Exception as e:
+            if attempt < self.settings.retries and not final:
+                self.deferred.append((time.time() + self.settings.retry_delay, record, attempt + 1))
+                return
+            if self.logger:
+                self.logger.warning("Tika could not extract metadata from %s: %s", record['path'], e)
+            record['extended_metadata'] = None
+        self.ready.append(record)
+
+    def _resubmit_due(self, now):
+        due = [d for d in self.deferred if d[0] <= now]
+        self.deferred = [d for d in self.deferred if d[0] > now]
+        for when, record, attempt in due:
+            self._submit(record, attempt)
+
+    def completed(self):
+        """Return the records whose extraction has finished, without waiting"""
+        self._resubmit_due(time.time())
+        still_pending = []
+        for future, record, attempt in self.pending:
+            if future.done():
+                self._finish(future, record, attempt)
+            else:
+                still_pending.append((future, record, attempt))
+        self.pending = still_pending
+        done = self.ready
+        self.ready = []
+        return done
+
+    def drain(self):
+        """Wait for every submitted record, giving deferred ones one last attempt"""
+        for future, record, attempt in self.pending:
+            self._finish(future, record, attempt)
+        self.pending = []
+        deferred = self.deferred
+        self.deferred = []
+        for when, record, attempt in deferred:
+            self.pending.append((self.pool.submit(tika_worker, record['path'], self.settings), record, attempt))
+        for future, record, attempt in self.pending:
+            self._finish(future, record, attempt, final=True)
+        self.pending = []
+        done = self.ready
+        self.ready = []
+        return done
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -8,6 +8,8 @@ from tempfile import mkstemp, gettempdir
 from shutil import move
 from radiam_api import RadiamAPI
 import json
+import threading
+import time
 
 
 dirs = AppDirs("radiam-agent", "Compute Canada")
@@ -26,7 +28,8 @@ arguments = {'--hostname': None,
              '--rootdir': None,
              '--username': None,
              '--projectname': None,
-             '--quitafter': None
+             '--quitafter': None,
+             '--incremental': None
              }
 
 def replace(file_path, pattern, subst):
@@ -46,6 +49,11 @@ class RadiamTray(object):
         self.arguments = arguments
         self.resumefile = resumefile
         self.tray_options = {}
+        # the crawl runs on a thread of its own so the RPC server stays free; see crawl() and status()
+        self.job = None
+        self.scheduler = None
+        self.job_result = None
+        self.job_started = None
         self.config, self.load_config_status = radiam.load_config(dirs.user_data_dir, arguments, logger, self.tray_options)
         with open(configjson, "w") as json_file:
             json.dump(self.config, json_file)
@@ -54,6 +62,7 @@ class RadiamTray(object):
             self.agent_config = {
                 "tokenfile": tokenfile,
                 "baseurl": self.config['api']['host'],
+                "compression": self.config['api'].get('compression'),
                 "logger": logger
             }
             self.API = RadiamAPI(**self.agent_config)
@@ -74,15 +83,78 @@ class RadiamTray(object):
         return json.dumps([i['name'] for i in data['results']])
 
     def crawl(self):
+        """Start crawling and then monitoring in the background; status() tells how it is going"""
+        if self.running():
+            return "Error: The agent is already crawling. Cancel the crawl before starting another one."
+        # pick up any settings changed since the last crawl
+        self.config, self.load_config_status = radiam.load_config(self.dirs.user_data_dir, self.arguments, self.logger, self.tray_options)
         if not self.config['api']['host']:
             self.logger.error("Remote project URL is not configured.")
             return "Error: You need to set a remote project name and URL so the app knows where to connect."
         elif self.load_config_status:
-            crawlout = radiam.crawl(self.dirs, self.arguments, self.logger, self.config, self.API, self.tray_options)
-            return crawlout
+            self.config['api']['host'] = self.config['api']['host'].strip('/')
+            self.agent_config = {
+                "tokenfile": tokenfile,
+                "baseurl": self.config['api']['host'],
+                "compression": self.config['api'].get('compression'),
+                "logger": self.logger
+            }
+            self.API = RadiamAPI(**self.agent_config)
+            # the extraction, checksum and throttling services are opened again with the new settings
+            radiam.close_services()
+            self.scheduler = radiam.open_scheduler(self.config)
+            self.job_result = None
+            self.job_started = time.time()
+            self.job = threading.Thread(target=self.run_crawl, args=(self.config, self.API, self.scheduler),
+                                        name="radiam-tray-crawl")
+            self.job.daemon = True
+            self.job.start()
         else:
             return "Error: You need to configure a project before crawling."
 
+    def run_crawl(self, config, API, scheduler):
+        try:
+            self.job_result = radiam.crawl(self.dirs, self.arguments, self.logger, config, API, self.tray_options, scheduler)
+        except Exception as e:
+            self.logger.exception("Crawl failed")
+            self.job_result = "Error: {}".format(e)
+
+    def running(self):
+        return self.job is not None and self.job.is_alive()
+
+    def pause(self):
+        if not self.running():
+            return "Error: The agent is not crawling."
+        self.scheduler.pause()
+        return "Crawl paused."
+
+    def resume(self):
+        if not self.running():
+            return "Error: The agent is not crawling."
+        self.scheduler.resume()
+        return "Crawl resumed."
+
+    def cancel(self):
+        if not self.running():
+            return "Error: The agent is not crawling."
+        self.scheduler.cancel()
+        return "Crawl cancelled."
+
+    def status(self):
+        if self.job is None:
+            state = "idle"
+        elif self.running():
+            state = "cancelling" if self.scheduler.cancelled else ("paused" if self.scheduler.paused else "running")
+        elif self.scheduler.cancelled:
+            state = "cancelled"
+        else:
+            state = "failed" if self.job_result else "finished"
+        return json.dumps({"state": state, "started": self.job_started, "result": self.job_result,
+                           "stats": radiam.current_stats()})
+
+    def stats(self):
+        return json.dumps(radiam.current_stats())
+
     def settings(self):
         configfile = os.path.join(self.dirs.user_data_dir, "radiam.txt")
         if not os.path.exists(configfile):
@@ -117,6 +189,7 @@ class RadiamTray(object):
         self.agent_config = {
             "tokenfile": tokenfile,
             "baseurl": self.config['api']['host'],
+            "compression": self.config['api'].get('compression'),
             "logger": logger
         }
         self.API = RadiamAPI(**self.agent_config)
@@ -136,6 +209,7 @@ class RadiamTray(object):
         self.agent_config = {
             "tokenfile": tokenfile,
             "baseurl": self.config['api']['host'],
+            "compression": self.config['api'].get('compression'),
             "logger": self.logger
         }
         self.API = RadiamAPI(**self.agent_config)
@@ -143,6 +217,7 @@ class RadiamTray(object):
 
 
 if __name__ == '__main__':
+    # no exit handlers: the crawl runs on a background thread, and the tray stops it with cancel()
     s = zerorpc.Server(RadiamTray(logger, dirs, arguments, tokenfile, resumefile))
     s.bind('tcp://127.0.0.1:' + str(sys.argv[1]))
     s.run()
\ No newline at end of file
@@ -4,7 +4,34 @@ import radiam
 import os
 import tempfile
 import shutil
-from radiam_api import RadiamAPI
+from radiam_api import RadiamAPI, iter_bulk_body, gzip_stream
+from radiam_batch import BatchController
+import radiam_metrics
+import radiam_profile
+import radiam_stats
+import socket
+from radiam_fakeapi import FakeRadiamServer, ThreadingServer
+import radiam_bench
+import radiam_extract
+from radiam_enrich import MetadataEnricher
+from radiam_sandbox import SandboxPool, SandboxTimeout, SandboxCrash, Quarantine
+from radiam_cache import StatCache, stat_key
+from radiam_hash import Checksummer
+from radiam_payload import PayloadPolicy
+from radiam_throttle import TokenBucket, AdaptiveThrottle
+from radiam_scheduler import Cancelled, FairScheduler, LIVE
+from radiam_shard import ShardCoordinator
+import hashlib
+from radiam_tika import TikaPool, TikaSettings, tika_metadata
+from http.server import BaseHTTPRequestHandler
+import threading
+import time
+import multiprocessing
+import sqlite3
+import json
+import gzip
+import subprocess
+import sys
 
 # copied this from radiam_tray, might not all be necessary for testing
 dirs = AppDirs("radiam-agent", "Compute Canada")
@@ -26,6 +53,23 @@ arguments = {'--hostname': "http://127.0.0.1:8100",
              '--quitafter': True
              }
 
+fake_server = None
+
+
+def setUpModule():
+    # Stand in for a live Radiam server unless one is already listening on 8100
+    global fake_server
+    with socket.socket() as sock:
+        if sock.connect_ex(("127.0.0.1", 8100)) == 0:
+            return
+    fake_server = FakeRadiamServer(port=8100, username="admin", password="admin", projectname="testproject").start()
+
+
+def tearDownModule():
+    if fake_server:
+        fake_server.stop()
+
+
 class TestRadiam(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super(TestRadiam, self).__init__(*args, **kwargs)
@@ -39,6 +83,39 @@ class TestRadiam(unittest.TestCase):
         self.config, self.load_config_status = radiam.load_config(self.dirs.user_data_dir, self.arguments, self.logger, self.tray_options)
         self.assertIsNotNone(self.config)
 
+    def test_load_config_max_cost(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            arguments = {'--hostname': env.server.url, '--minsize': 0, '--mtime': 0, '--rootdir': env.rootdir,
+                         '--projectname': radiam_bench.bench_project}
+            env.config[env.project_key]['extract_max_cost'] = "moderate"
+            env.config.write()
+            config, status = radiam.load_config(env.workdir, arguments, self.logger, {})
+            self.assertTrue(status)
+            # a setting that names no cost class is turned down once, not on every file extracted
+            env.config[env.project_key]['extract_max_cost'] = "pricey"
+            env.config.write()
+            config, status = radiam.load_config(env.workdir, arguments, self.logger, {})
+            self.assertFalse(status)
+            # the tray writes a new config each time, ending with the project's section
+            write_new_config = radiam.write_new_config
+
+            def write_priced_config(configfile, tray_options):
+                write_new_config(configfile, tray_options)
+                with open(configfile, "a") as config_file:
+                    config_file.write("extract_max_cost = pricey\n")
+
+            radiam.write_new_config = write_priced_config
+            try:
+                tray_options = {"hostname": env.server.url, "rootdir": env.rootdir, "projectname": radiam_bench.bench_project}
+                config, status = radiam.load_config(env.workdir, arguments, self.logger, tray_options)
+            finally:
+                radiam.write_new_config = write_new_config
+            self.assertEqual(config[env.project_key]['extract_max_cost'], "pricey")
+            self.assertFalse(status)
+        finally:
+            env.close()
+
     def test_index_file(self):
         self.config, self.load_config_status = radiam.load_config(self.dirs.user_data_dir, self.arguments, self.logger, self.tray_options)
         fp = tempfile.TemporaryDirectory()
@@ -101,5 +178,861 @@ class TestRadiam(unittest.TestCase):
         fp.cleanup()
 
 
+# Seconds "import radiam" may take, and modules it must leave to the projects that enable them
+import_budget = 0.6
+lazy_modules = ("PyPDF2", "PIL", "olefile", "magic", "h5py", "numpy", "netCDF4", "tika", "yaml", "watchdog.observers")
+
+
+class TestImports(unittest.TestCase):
+    def test_import_budget(self):
+        # the best of a few runs, in a fresh interpreter each, so the disk cache and the other tests do not count
+        script = "import sys, time; start = time.perf_counter(); import radiam; " \
+                 "print(time.perf_counter() - start); print(','.join(sorted(sys.modules)))"
+        runs = []
+        for i in range(3):
+            output = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().splitlines()
+            runs.append((float(output[-2]), output[-1].split(",")))
+        seconds, modules = min(runs)
+        self.assertEqual([name for name in lazy_modules if name in modules], [])
+        self.assertLess(seconds, import_budget)
+
+
+class TestRadiamAPI(unittest.TestCase):
+    def test_iter_bulk_body(self):
+        docs = [{"name": "a", "size": 1}, json.dumps({"name": "b"}).encode('utf-8'), {"name": "c" * 100}]
+        chunks = list(iter_bulk_body(docs, chunk_size=16))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(b"".join(chunks).decode('utf-8')), [{"name": "a", "size": 1}, {"name": "b"}, {"name": "c" * 100}])
+        self.assertEqual(json.loads(b"".join(iter_bulk_body([])).decode('utf-8')), [])
+
+    def test_request_metrics(self):
+        # a request that fails and one that gets a response are labelled alike, so the metrics still render
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            closed_port = sock.getsockname()[1]
+        API = RadiamAPI(tokenfile=os.path.join(tempfile.gettempdir(), "metrics_token"), baseurl="http://127.0.0.1:8100")
+        API.send("GET", "http://127.0.0.1:8100/api/metrics-test/")
+        with self.assertRaises(Exception):
+            API.send("GET", "http://127.0.0.1:{}/api/metrics-test/".format(closed_port))
+        text = radiam_metrics.registry.render()
+        self.assertIn('endpoint="/api/metrics-test/",method="GET",status="error"', text)
+        self.assertRegex(text, 'endpoint="/api/metrics-test/",method="GET",status="[0-9]+"')
+
+    def test_gzip_stream(self):
+        docs = [{"name": str(i)} for i in range(100)]
+        compressed = b"".join(gzip_stream(iter_bulk_body(docs, chunk_size=64)))
+        self.assertEqual(json.loads(gzip.decompress(compressed).decode('utf-8')), docs)
+
+
+class TestBatchController(unittest.TestCase):
+    def test_grows_when_fast_and_full(self):
+        batcher = BatchController(byte_limit=1000, doc_limit=10, min_bytes=100, max_bytes=2000, min_docs=1, max_docs=100)
+        for i in range(10):
+            batcher.record(0.1, 200, batcher.byte_limit, 5)
+        self.assertEqual(batcher.byte_limit, 2000)
+        self.assertFalse(batcher.full(2000, 5))
+        self.assertTrue(batcher.full(2001, 5))
+
+    def test_shrinks_on_errors_and_413(self):
+        batcher = BatchController(byte_limit=1000, doc_limit=10, min_bytes=100, max_bytes=2000, min_docs=1, max_docs=100)
+        batcher.record(10.0, 200, 1000, 10)
+        self.assertLess(batcher.byte_limit, 1000)
+        batcher.record(None, None, 0, 10)
+        batcher.record(0.1, 503, 200, 2)
+        self.assertEqual(batcher.byte_limit, 125)
+        batcher = BatchController(byte_limit=1000, min_bytes=100, max_bytes=2000)
+        batcher.record(0.1, 413, 800, 10)
+        self.assertEqual(batcher.byte_limit, 400)
+        self.assertEqual(batcher.max_bytes, 799)
+
+
+class TestRadiamMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = radiam_metrics.MetricsRegistry()
+        requests = registry.counter("test_requests_total", "Requests", ("endpoint", "status"))
+        latency = registry.histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0))
+        requests.inc("/api/projects/", 200)
+        requests.inc("/api/projects/", 200, amount=2)
+        latency.observe(0.05)
+        latency.observe(0.5)
+        text = registry.render()
+        self.assertIn('test_requests_total{endpoint="/api/projects/",status="200"} 3', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('test_latency_seconds_count 2', text)
+
+    def test_endpoint_label(self):
+        url = "http://localhost:8100//api/projects/0a1b2c3d-0000-1111-2222-333344445555/docs/abc"
+        self.assertEqual(radiam_metrics.endpoint_label(url), "/api/projects/{id}/docs/{id}")
+
+
+class TestFakeRadiamServer(unittest.TestCase):
+    def test_bulk_and_search(self):
+        server = FakeRadiamServer(projectname="fakeproject").start()
+        try:
+            API = RadiamAPI(baseurl=server.url, logger=logger)
+            self.assertFalse(API.login("admin", "wrong"))
+            self.assertTrue(API.login("admin", "admin"))
+            project = API.search_endpoint_by_name('projects', "fakeproject")["results"][0]
+            index_url = server.url + "/api/projects/" + project["id"] + "/"
+            docs = [{"path": "/data/{}".format(i), "type": "file"} for i in range(10)]
+            resp, status = API.create_document_bulk(index_url, docs)
+            self.assertTrue(status)
+            self.assertEqual(len(resp), 10)
+            res = API.search_endpoint_by_fieldname(index_url, "/data/3", "path.keyword")
+            self.assertEqual(res["count"], 1)
+            self.assertTrue(API.delete_document(index_url, res["results"][0]["id"]))
+            self.assertEqual(server.state.stats()["documents"], 9)
+        finally:
+            server.stop()
+
+
+class TestRadiamBench(unittest.TestCase):
+    def test_generate_tree(self):
+        fp = tempfile.TemporaryDirectory()
+        dirs, paths = radiam_bench.generate_tree(fp.name, files=50, shape="balanced", depth=2, fanout=3, dot_dirs=2, mixed=True)
+        self.assertEqual(len(dirs), 13)
+        self.assertEqual(len(paths), 50)
+        project_config = {"included_files": [], "excluded_files": [".*", "NULLEXT"], "included_dirs": [], "excluded_dirs": [".*"]}
+        file_list = radiam.get_list_of_files(fp.name, project_config)
+        self.assertEqual(len(file_list), 50 + 12)
+        again = tempfile.TemporaryDirectory()
+        dirs2, paths2 = radiam_bench.generate_tree(again.name, files=50, shape="balanced", depth=2, fanout=3, dot_dirs=2, mixed=True)
+        self.assertEqual([os.path.relpath(p, again.name) for p in paths2], [os.path.relpath(p, fp.name) for p in paths])
+        fp.cleanup()
+        again.cleanup()
+
+
+class TestMetadataEnricher(unittest.TestCase):
+    def test_enrich(self):
+        fp = tempfile.TemporaryDirectory()
+        pdf = os.path.join(fp.name, "sample.pdf")
+        with open(pdf, "wb") as pdf_file:
+            pdf_file.write(radiam_bench.sample_pdf("Enriched"))
+        broken = os.path.join(fp.name, "broken.pdf")
+        with open(broken, "wb") as pdf_file:
+            pdf_file.write(b"%PDF-1.4\nnot really")
+        cache = StatCache(os.path.join(fp.name, "cache.db"))
+        quarantine = Quarantine(os.path.join(fp.name, "quarantine.db"), threshold=2)
+        enricher = MetadataEnricher(workers=2, max_pending=1, cache=cache, version="rich-1", quarantine=quarantine)
+        try:
+            enricher.submit({"path": pdf, "type": "file"})
+            enricher.submit({"path": broken, "type": "file"})
+            records = enricher.completed() + enricher.drain()
+            by_path = dict((r["path"], r) for r in records)
+            self.assertEqual(by_path[pdf]["extended_metadata"]["/Title"], "Enriched")
+            self.assertIsNone(by_path[broken]["extended_metadata"])
+            # the failure is not cached, but counts towards quarantining the file
+            broken_key = stat_key(os.lstat(broken))
+            self.assertTrue(cache.get(stat_key(os.lstat(pdf)), "rich-1")[0])
+            self.assertFalse(cache.get(broken_key, "rich-1")[0])
+            self.assertEqual(quarantine.failures(broken_key), 1)
+            self.assertIsNone(enricher.extract(broken))
+            self.assertTrue(quarantine.blocked(broken_key))
+        finally:
+            enricher.close()
+            quarantine.close()
+            cache.close()
+        fp.cleanup()
+
+
+class TestStatCache(unittest.TestCase):
+    def test_get_put_evict(self):
+        fp = tempfile.TemporaryDirectory()
+        cache = StatCache(os.path.join(fp.name, "cache.db"), max_bytes=100)
+        cache.put((1, 1, 10, 1000), "rich-1", {"Title": "one"})
+        self.assertEqual(cache.get((1, 1, 10, 1000), "rich-1"), (True, {"Title": "one"}))
+        self.assertEqual(cache.get((1, 1, 10, 2000), "rich-1"), (False, None))
+        self.assertEqual(cache.get((1, 1, 10, 1000), "rich-2"), (False, None))
+        cache.put((1, 2, 10, 1000), "rich-1", None)
+        self.assertEqual(cache.get((1, 2, 10, 1000), "rich-1"), (True, None))
+        for ino in range(3, 20):
+            cache.put((1, ino, 10, 1000), "rich-1", {"Title": "x" * 10})
+        self.assertLessEqual(cache.total_bytes, 100)
+        self.assertFalse(cache.get((1, 1, 10, 1000), "rich-1")[0])
+        self.assertTrue(cache.get((1, 19, 10, 1000), "rich-1")[0])
+        cache.close()
+        reopened = StatCache(os.path.join(fp.name, "cache.db"), max_bytes=100)
+        self.assertTrue(reopened.get((1, 19, 10, 1000), "rich-1")[0])
+        reopened.close()
+        fp.cleanup()
+
+
+class StubTikaHandler(BaseHTTPRequestHandler):
+    # Answers /rmeta/text like Tika, reporting how many bytes it was sent; files named slow* stall
+    def log_message(self, format, *args):
+        pass
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.received.append(len(body))
+        if "slow" in self.headers.get("Content-Disposition", ""):
+            time.sleep(1)
+            self.close_connection = True
+            return
+        reply = json.dumps([{"Content-Type": "application/test", "Received": len(body)}]).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+class TestTikaPool(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadingServer(("127.0.0.1", 0), StubTikaHandler)
+        self.httpd.received = []
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.fp = tempfile.TemporaryDirectory()
+        self.settings = TikaSettings({"tika_host": "http://127.0.0.1:{}".format(self.httpd.server_address[1]),
+                                      "tika_timeout": "0.3", "tika_retries": "1", "tika_retry_delay": "0",
+                                      "tika_size_limits": "application/pdf:5000, *:100",
+                                      "tika_header_limits": "image/*:1000"})
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.fp.cleanup()
+
+    def write(self, name, size):
+        path = os.path.join(self.fp.name, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_budgets(self):
+        self.assertEqual(tika_metadata(self.write("photo.png", 50000), self.settings)["Received"], 1000)
+        self.assertEqual(tika_metadata(self.write("paper.pdf", 4000), self.settings)["Received"], 4000)
+        self.assertIsNone(tika_metadata(self.write("notes.txt", 4000), self.settings))
+        self.assertEqual(self.httpd.received, [1000, 4000])
+
+    def test_timeout_retry(self):
+        pool = TikaPool(self.settings)
+        try:
+            pool.submit({"path": self.write("slow.pdf", 10), "type": "file"})
+            pool.submit({"path": self.write("fast.pdf", 10), "type": "file"})
+            records = pool.completed() + pool.drain()
+        finally:
+            pool.close()
+        by_name = dict((os.path.basename(r["path"]), r) for r in records)
+        self.assertEqual(by_name["fast.pdf"]["extended_metadata"]["Received"], 10)
+        self.assertIsNone(by_name["slow.pdf"]["extended_metadata"])
+        self.assertEqual(len(self.httpd.received), 3)
+
+
+class TestRadiamExtract(unittest.TestCase):
+    def test_ooxml_core_properties(self):
+        fp = tempfile.TemporaryDirectory()
+        for kind in ("docx", "xlsx"):
+            with open(os.path.join(fp.name, "sample." + kind), "wb") as ooxml_file:
+                ooxml_file.write(radiam_bench.sample_ooxml(kind, "Core"))
+        self.assertEqual(radiam_extract.parse_word(os.path.join(fp.name, "sample.docx")),
+                         {"Title": "Core", "Author": "radiam", "Revision": 1, "Keywords": "synthetic"})
+        self.assertEqual(radiam_extract.parse_excel(os.path.join(fp.name, "sample.xlsx")),
+                         {"Title": "Core", "Creator": "radiam", "Keywords": "synthetic"})
+        fp.cleanup()
+
+    def test_route_metadata_parser(self):
+        fp = tempfile.TemporaryDirectory()
+        pdf = os.path.join(fp.name, "renamed.dat")
+        with open(pdf, "wb") as pdf_file:
+            pdf_file.write(radiam_bench.sample_pdf("Sniffed"))
+        self.assertEqual(radiam_extract.route_metadata_parser(pdf)["/Title"], "Sniffed")
+        # Types no parser handles are recognised by extension without opening the file
+        self.assertEqual(radiam_extract.route_metadata_parser(os.path.join(fp.name, "missing.txt")), {})
+        self.assertEqual(radiam_extract.route_metadata_parser(os.path.join(fp.name, "missing.pdf"), 0), {})
+        fp.cleanup()
+
+    def test_scientific_headers(self):
+        fp = tempfile.TemporaryDirectory()
+        netcdf = os.path.join(fp.name, "sample.nc")
+        with open(netcdf, "wb") as netcdf_file:
+            netcdf_file.write(radiam_bench.sample_netcdf("Header", 1000))
+        self.assertEqual(radiam_extract.route_metadata_parser(netcdf),
+                         {"title": "Header", "dimensions": {"x": 1000},
+                          "variables": {"values": {"type": "float32", "dimensions": ["x"], "attributes": {}}}})
+
+        def header(*cards):
+            return "".join(card.ljust(80) for card in cards + ("END",)).ljust(2880).encode('ascii')
+        fits = os.path.join(fp.name, "sample.fits")
+        with open(fits, "wb") as fits_file:
+            fits_file.write(header("SIMPLE  =                    T", "BITPIX  =                   16", "NAXIS   =                    1",
+                                   "NAXIS1  =                 2000", "OBJECT  = 'M31 O''Neil'           / target",
+                                   "HISTORY reduced"))
+            fits_file.write(b"\x00" * 5760)
+            fits_file.write(header("XTENSION= 'IMAGE   '", "BITPIX  =                  -32", "NAXIS   =                    0",
+                                   "EXTNAME = 'MASK    '"))
+        metadata = radiam_extract.route_metadata_parser(fits)
+        self.assertEqual(metadata["OBJECT"], "M31 O'Neil")
+        self.assertEqual(metadata["NAXIS1"], 2000)
+        self.assertEqual(metadata["HISTORY"], ["reduced"])
+        self.assertEqual(metadata["extensions"][0]["EXTNAME"], "MASK")
+        fp.cleanup()
+
+    def test_registry(self):
+        fp = tempfile.TemporaryDirectory()
+        pdf = os.path.join(fp.name, "sample.pdf")
+        with open(pdf, "wb") as pdf_file:
+            pdf_file.write(radiam_bench.sample_pdf("Registry"))
+        radiam_extract.registry.take_stats()
+        self.assertEqual(radiam_extract.route_metadata_parser(pdf)["/Title"], "Registry")
+        options = radiam_extract.extractor_options({"extract_disabled": "pdf"})
+        self.assertEqual(radiam_extract.route_metadata_parser(pdf, None, options), {})
+        options = radiam_extract.extractor_options({"extract_max_cost": "cheap"})
+        self.assertEqual(radiam_extract.route_metadata_parser(pdf, None, options), {})
+        options = radiam_extract.extractor_options({"extract_max_bytes": ["pdf:10"]})
+        self.assertEqual(radiam_extract.route_metadata_parser(pdf, os.path.getsize(pdf), options), {})
+        self.assertNotEqual(radiam_extract.options_version(options), radiam_extract.extractor_version)
+        stats = radiam_extract.registry.take_stats()
+        self.assertEqual(list(stats), ["pdf"])
+        self.assertEqual(stats["pdf"]["calls"], 1)
+        self.assertGreater(stats["pdf"]["bytes_read"], 0)
+        self.assertEqual(radiam_extract.registry.take_stats(), {})
+        self.assertEqual(radiam_extract.object_to_utf8([b"a\x00b", {"k": [b"c"]}]), ["ab", {"k": ["c"]}])
+        fp.cleanup()
+
+
+class TestChecksummer(unittest.TestCase):
+    def test_checksum(self):
+        fp = tempfile.TemporaryDirectory()
+        small = os.path.join(fp.name, "small")
+        large = os.path.join(fp.name, "large")
+        with open(small, "wb") as small_file:
+            small_file.write(b"radiam" * 10)
+        data = os.urandom(2500)
+        with open(large, "wb") as large_file:
+            large_file.write(data)
+        cache = StatCache(os.path.join(fp.name, "cache.db"))
+        checksummer = Checksummer(workers=2, cache=cache, chunk_size=1000)
+        try:
+            self.assertEqual(checksummer.checksum(small, "sha256"), "sha256:" + hashlib.sha256(b"radiam" * 10).hexdigest())
+            tree = hashlib.sha256(b"".join(hashlib.sha256(data[i:i + 1000]).digest() for i in (0, 1000, 2000)))
+            self.assertEqual(checksummer.checksum(large, "sha256"), "sha256-tree-1000:" + tree.hexdigest())
+            # An unchanged file (same size and mtime) is answered from the cache without being read
+            st = os.stat(small)
+            with open(small, "wb") as small_file:
+                small_file.write(b"RADIAM" * 10)
+            os.utime(small, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(checksummer.checksum(small, "sha256"), "sha256:" + hashlib.sha256(b"radiam" * 10).hexdigest())
+            checksummer.submit({"path": small}, "md5")
+            records = checksummer.completed() + checksummer.drain()
+            self.assertEqual(records[0]["checksum"], "md5:" + hashlib.md5(b"RADIAM" * 10).hexdigest())
+        finally:
+            checksummer.close()
+            cache.close()
+        fp.cleanup()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10000, 1000)
+        start = time.time()
+        for i in range(3):
+            bucket.take(1000)
+        self.assertGreaterEqual(time.time() - start, 0.15)
+        self.assertEqual(TokenBucket(0).take(10 ** 9), 0.0)
+
+    def test_adaptive_throttle(self):
+        throttle = AdaptiveThrottle(1000, target=0.1, interval=0, min_rate=10)
+        throttle.observe(0.5)
+        throttle.observe(0.5)
+        self.assertEqual(throttle.rate, 250)
+        for i in range(20):
+            throttle.observe(0.01)
+        self.assertEqual(throttle.rate, 1000)
+        # without a limit or a target, slowing down to ten times the usual latency starts limiting
+        unlimited = AdaptiveThrottle(0, interval=0)
+        unlimited.observe(0.02)
+        self.assertEqual(unlimited.rate, 0)
+        unlimited.observe(0.2)
+        self.assertGreater(unlimited.rate, 0)
+        for i in range(200):
+            unlimited.observe(0.02)
+        self.assertEqual(unlimited.rate, 0)
+        self.assertEqual(unlimited.call(sum, [1, 2]), 3)
+
+
+class TestSandboxPool(unittest.TestCase):
+    def test_deadline_crash_recycle(self):
+        pool = SandboxPool(workers=1, deadline=1, max_tasks=2)
+        try:
+            with self.assertRaises(SandboxTimeout):
+                pool.submit(time.sleep, 30).result()
+            with self.assertRaises(SandboxCrash):
+                pool.submit(os._exit, 1).result()
+            with self.assertRaises(RuntimeError):
+                pool.submit(int, "not a number").result()
+            pids = [pool.submit(os.getpid).result() for i in range(3)]
+            self.assertEqual(pids[1], pids[2])
+            self.assertNotEqual(pids[0], pids[1])
+        finally:
+            pool.shutdown()
+
+    def test_quarantine(self):
+        fp = tempfile.TemporaryDirectory()
+        quarantine = Quarantine(os.path.join(fp.name, "quarantine.db"), threshold=2)
+        self.assertFalse(quarantine.failed((1, 1, 10, 1000), "/bomb.docx", "timeout"))
+        self.assertFalse(quarantine.blocked((1, 1, 10, 1000)))
+        self.assertTrue(quarantine.failed((1, 1, 10, 1000), "/bomb.docx", "timeout"))
+        self.assertTrue(quarantine.blocked((1, 1, 10, 1000)))
+        # A changed file gets another chance
+        self.assertFalse(quarantine.blocked((1, 1, 10, 2000)))
+        quarantine.close()
+        fp.cleanup()
+
+
+class TestPayloadPolicy(unittest.TestCase):
+    def test_apply(self):
+        metadata = {"Make": "Canon", "Thumbnail": b"\xff\xd8", "Comment": "x" * 50, "Tags": list(range(20)),
+                    "GPSInfo": {"GPSLatitude": [45.0, 30.0, 0.0], "GPSAltitude": 100.0}, "Rating": 4.5 + 0j}
+        policy = PayloadPolicy(exclude=["GPSInfo.GPSLatitude"], value_limit=10, list_limit=5)
+        self.assertEqual(policy.apply(metadata), {"Make": "Canon", "Comment": "x" * 10, "Tags": [0, 1, 2, 3, 4],
+                                                  "GPSInfo": {"GPSAltitude": 100.0}, "Rating": "(4.5+0j)"})
+        self.assertEqual(PayloadPolicy(include=["Make", "GPS*"]).apply(metadata),
+                         {"Make": "Canon", "GPSInfo": {"GPSLatitude": [45.0, 30.0, 0.0], "GPSAltitude": 100.0}})
+        trimmed = PayloadPolicy(max_bytes=80).apply(metadata)
+        dropped = trimmed.pop("truncated_fields")
+        self.assertEqual(dropped[0], "Tags")
+        self.assertLessEqual(len(json.dumps(trimmed)), 80)
+        self.assertIn("Make", trimmed)
+        policy = PayloadPolicy.from_config({"extended_exclude": "Thumb*, Comment", "extended_max_bytes": "0"})
+        self.assertNotIn("Comment", policy.apply(metadata))
+        self.assertIsNone(policy.max_bytes)
+
+
+class TestCrawlJobs(unittest.TestCase):
+    def test_fair_scheduler(self):
+        scheduler = FairScheduler(1)
+        grants = []
+
+        def job(name, weight, slices):
+            for i in range(slices):
+                scheduler.acquire(name)
+                grants.append(name)
+                time.sleep(0.001)
+                scheduler.release(name, 1)
+            scheduler.remove(name)
+
+        scheduler.add("big", 1)
+        scheduler.add("small", 1)
+        scheduler.add("heavy", 2)
+        threads = [threading.Thread(target=job, args=args) for args in (("big", 1, 200), ("small", 1, 10), ("heavy", 2, 200))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the small job is done long before the big ones, and a double weight gets about twice the slots
+        self.assertLess(max(i for i, name in enumerate(grants) if name == "small"), 60)
+        first = grants[:150]
+        self.assertAlmostEqual(first.count("heavy") / first.count("big"), 2, delta=0.5)
+
+    def test_live_events_first(self):
+        scheduler = FairScheduler(1)
+        grants = []
+        for name in ("crawl", "other"):
+            scheduler.add(name)
+        scheduler.add("monitor", priority=LIVE)
+
+        def job(name):
+            scheduler.acquire(name)
+            grants.append(name)
+            scheduler.release(name)
+
+        scheduler.acquire("crawl")
+        self.assertFalse(scheduler.urgent("crawl"))
+        threads = [threading.Thread(target=job, args=(name,)) for name in ("other", "monitor")]
+        for thread in threads:
+            thread.start()
+            while len(scheduler.waiting) < threads.index(thread) + 1:
+                time.sleep(0.001)
+        # the crawl is told to give up its slot, which goes to the event although the other job asked first
+        self.assertTrue(scheduler.urgent("crawl"))
+        self.assertFalse(scheduler.urgent("monitor"))
+        scheduler.release("crawl")
+        for thread in threads:
+            thread.join()
+        self.assertEqual(grants, ["monitor", "other"])
+
+    def test_monitor_rebase(self):
+        config = {"agent": {}, "project1": {"name": "project1"}}
+        monitor = radiam.FileSystemMonitor(None, config, "project1", None, ["/old", "/gone"])
+        monitor.set_last_crawl.add("/new")
+        monitor.set_last_crawl.discard("/gone")
+        # a crawl that finished meanwhile still saw /gone, and missed /new
+        monitor.rebase(["/old", "/gone", "/crawled"])
+        self.assertEqual(monitor.set_last_crawl, {"/old", "/new", "/crawled"})
+
+    def test_concurrent_projects(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            dirs, paths = radiam_bench.generate_tree(env.rootdir, files=200, depth=2, fanout=3)
+            roots = {}
+            for key in ("empty", "second"):
+                # an empty project listed first must not stop the others from being crawled
+                roots[key] = os.path.join(env.workdir, key)
+                os.makedirs(roots[key])
+                env.config[key] = dict(env.config[env.project_key])
+                env.config[key]['rootdir'] = roots[key]
+                env.config[key]['name'] = key
+                del env.config[key]['id']
+                env.server.state.add_project(key)
+            dirs2, paths2 = radiam_bench.generate_tree(roots["second"], files=50, depth=1, fanout=2)
+            env.config['projects']['project_list'] = ["empty", env.project_key, "second"]
+            env.config['agent']['crawl_workers'] = "2"
+            env.config['agent']['crawl_slice'] = "10"
+            radiam.agent_checkin(env.API, env.config, env.logger)
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger)
+            self.assertTrue(status)
+            stats = env.server.state.stats()
+            self.assertEqual(stats["documents"], len(paths) + len(dirs) - 1 + len(paths2) + len(dirs2) - 1)
+            self.assertEqual(stats["duplicate_posts"], 0)
+        finally:
+            env.close()
+
+
+    def test_resume_after_crash(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            dirs, paths = radiam_bench.generate_tree(env.rootdir, files=300, depth=2, fanout=3)
+            env.config['agent']['batch_docs'] = "20"
+            env.config['agent']['batch_docs_min'] = "20"
+            env.config['agent']['batch_docs_max'] = "20"
+            calls = []
+
+            def crash_on_sixth_batch(index_url, body):
+                calls.append(len(body))
+                if len(calls) == 6:
+                    raise RuntimeError("agent killed")
+                return RadiamAPI.create_document_bulk(env.API, index_url, body)
+
+            env.API.create_document_bulk = crash_on_sixth_batch
+            with self.assertRaises(RuntimeError):
+                radiam.full_run(env.API, env.config, env.logger)
+            sent = env.server.state.stats()["documents"]
+            self.assertEqual(sent, 100)
+            del env.API.create_document_bulk
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger)
+            self.assertTrue(status)
+            stats = env.server.state.stats()
+            self.assertEqual(stats["documents"], len(paths) + len(dirs) - 1)
+            # nothing acknowledged before the crash was sent again
+            self.assertEqual(stats["duplicate_posts"], 0)
+            self.assertEqual(len(radiam.load_list_last_crawl(env.config, env.project_key)), len(paths) + len(dirs) - 1)
+            # a finished crawl leaves nothing to resume
+            checkpoint = radiam.open_checkpoint(env.config, env.project_key)
+            self.assertEqual(checkpoint.resume(), [])
+            checkpoint.close()
+        finally:
+            env.close()
+
+    def test_resume_after_stop(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            dirs, paths = radiam_bench.generate_tree(env.rootdir, files=100, depth=1, fanout=3)
+            env.config['agent']['batch_docs'] = "20"
+            env.config['agent']['batch_docs_max'] = "20"
+
+            def stop_on_second_batch(index_url, body):
+                if env.server.state.stats()["documents"]:
+                    raise RuntimeError("agent stopped")
+                return RadiamAPI.create_document_bulk(env.API, index_url, body)
+
+            env.API.create_document_bulk = stop_on_second_batch
+            with self.assertRaises(RuntimeError):
+                radiam.full_run(env.API, env.config, env.logger)
+            del env.API.create_document_bulk
+            # the exit handlers save the whole tree as the last crawl, which must not pass for a finished one
+            radiam.save_last_crawl_lists(env.config, env.logger)
+            arguments = {'--username': "admin", '--password': "admin", '--quitafter': True}
+            self.assertIsNone(radiam.crawl(radiam.dirs, arguments, env.logger, env.config, env.API, {}))
+            self.assertEqual(env.server.state.stats()["documents"], len(paths) + len(dirs) - 1)
+        finally:
+            env.close()
+
+    def test_incremental_rescan(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            dirs, paths = radiam_bench.generate_tree(env.rootdir, files=200, depth=2, fanout=3)
+            # the tree has to look older than the clock tick an incremental crawl cannot trust
+            past = time.time() - 3600
+            for path in paths + dirs:
+                os.utime(path, (past, past))
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertTrue(status)
+            first = env.server.state.stats()
+            self.assertEqual(first["documents"], len(paths) + len(dirs) - 1)
+            radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertEqual(env.server.state.stats()["posts"], first["posts"])
+
+            added = os.path.join(dirs[1], "added.dat")
+            with open(added, "w") as added_file:
+                added_file.write("new")
+            removed = paths[-1]
+            os.remove(removed)
+            subtree = dirs[-1]
+            below = [p for p in paths + dirs if p.startswith(subtree + os.sep)]
+            shutil.rmtree(subtree)
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertTrue(status)
+            stats = env.server.state.stats()
+            stored = env.server.state.paths[list(env.server.state.paths)[0]]
+            self.assertIn(added, stored)
+            self.assertNotIn(removed, stored)
+            self.assertNotIn(subtree, stored)
+            self.assertEqual(stats["documents"], first["documents"] + 1 - len(set([removed, subtree] + below)))
+            # only the new file and the directories it and the deletions changed were sent
+            self.assertLess(stats["posts"] - first["posts"], 5)
+            last_crawl = set(radiam.load_list_last_crawl(env.config, env.project_key))
+            self.assertIn(added, last_crawl)
+            self.assertNotIn(removed, last_crawl)
+        finally:
+            env.close()
+
+    def test_incremental_too_recent(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            recent = os.path.join(env.rootdir, "recent.dat")
+            with open(recent, "w") as recent_file:
+                recent_file.write("recent")
+            past = time.time() - 3600
+            os.utime(recent, (past, past))
+            # an hour old is too recent for an agent that only indexes files a day old
+            env.config['agent']['mtime'] = "1"
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertTrue(status)
+            stored = env.server.state.paths[list(env.server.state.paths)[0]]
+            self.assertNotIn(recent, stored)
+            # the file comes of age without changing, and is picked up once its directory is scanned again
+            env.config['agent']['mtime'] = "0"
+            added = os.path.join(env.rootdir, "added.dat")
+            with open(added, "w") as added_file:
+                added_file.write("added")
+            os.utime(added, (past, past))
+            os.utime(env.rootdir, (past + 60, past + 60))
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertTrue(status)
+            self.assertIn(added, stored)
+            self.assertIn(recent, stored)
+        finally:
+            env.close()
+
+    def test_incremental_failed_delete(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            dirs, paths = radiam_bench.generate_tree(env.rootdir, files=50, depth=1, fanout=3)
+            past = time.time() - 3600
+            for path in paths + dirs:
+                os.utime(path, (past, past))
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertTrue(status)
+            removed = paths[-1]
+            os.remove(removed)
+            # the API turns the deletion down, so the entry has to stay in the index and be tried again
+            env.API.delete_document = lambda index_url, id: None
+            try:
+                resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            finally:
+                del env.API.delete_document
+            self.assertTrue(status)
+            stored = env.server.state.paths[list(env.server.state.paths)[0]]
+            self.assertIn(removed, stored)
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger, incremental=True)
+            self.assertTrue(status)
+            self.assertNotIn(removed, stored)
+        finally:
+            env.close()
+
+    def test_profile_report(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            radiam_bench.generate_tree(env.rootdir, files=100, depth=1, fanout=3)
+            env.config['agent']['profile'] = "enabled"
+            env.config['agent']['profile_capture'] = "cprofile"
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger)
+            self.assertTrue(status)
+            self.assertIsNone(radiam_profile.active)
+            reports = [name for name in os.listdir(radiam.dirs.user_data_dir) if name.startswith("profile_")]
+            self.assertEqual(sorted(os.path.splitext(name)[1] for name in reports), [".json", ".pstats"])
+            with open(os.path.join(radiam.dirs.user_data_dir, [n for n in reports if n.endswith(".json")][0])) as report_file:
+                report = json.load(report_file)
+            for name in ("scandir", "lstat", "exclude", "owner", "encode", "http", "worker wait"):
+                self.assertGreater(report["stages"][name]["calls"], 0, name)
+            self.assertEqual(report["stages"]["lstat"]["calls"], 100 + 3)
+            self.assertIn("scan", report["top"])
+            self.assertIn(report["cpu_clock"], ("thread_time", "process_time"))
+        finally:
+            env.close()
+
+    def test_crawl_stats(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            radiam_bench.generate_tree(env.rootdir, files=100, depth=1, fanout=3)
+            self.assertEqual(radiam_stats.estimate_tree(env.rootdir, 5, lambda path: list(os.scandir(path)))[0], 4)
+            resp_text, status = radiam.full_run(env.API, env.config, env.logger)
+            self.assertTrue(status)
+            project = radiam_stats.stats.snapshot()["projects"][env.config[env.project_key]['name']]
+            self.assertEqual(project["state"], "finished")
+            self.assertEqual((project["dirs_done"], project["dirs_queued"]), (4, 0))
+            self.assertEqual((project["files"], project["directories"], project["acknowledged"]), (100, 3, 103))
+            self.assertGreater(project["bytes"], 0)
+            self.assertGreater(project["files_per_second"], 0)
+            statsfile = os.path.join(radiam.dirs.user_data_dir, "stats.json")
+            radiam_stats.stats.write(statsfile)
+            self.assertIn("100 files and 3 directories", radiam_stats.format_snapshot(radiam_stats.read(statsfile)))
+            # the ETA goes by the directories left of those the tree is estimated to hold
+            progress = radiam_stats.ProjectStats("eta")
+            progress.start()
+            progress.started -= 10
+            progress.dirs_done, progress.estimated_dirs = 10, 100
+            self.assertAlmostEqual(progress.snapshot()["eta"], 90, delta=1)
+        finally:
+            env.close()
+
+    def test_pause_resume_cancel(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            radiam_bench.generate_tree(env.rootdir, files=100, depth=1, fanout=3)
+            scheduler = radiam.open_scheduler(env.config)
+            scheduler.pause()
+            results = []
+            thread = threading.Thread(target=lambda: results.append(radiam.full_run(env.API, env.config, env.logger,
+                                                                                   scheduler)))
+            thread.start()
+            time.sleep(0.5)
+            self.assertTrue(thread.is_alive())
+            project = radiam_stats.stats.project(env.config[env.project_key]['name'])
+            self.assertEqual(project.dirs_done, 0)
+            scheduler.resume()
+            thread.join(30)
+            self.assertTrue(results[0][1])
+            self.assertEqual(project.files, 100)
+            # once cancelled, a crawl stops before its next slice and the monitor returns
+            scheduler = radiam.open_scheduler(env.config)
+            scheduler.cancel()
+            self.assertRaises(Cancelled, radiam.full_run, env.API, env.config, env.logger, scheduler)
+            self.assertEqual(project.state, "cancelled")
+            radiam.backend_monitor(env.API, env.config, env.logger, scheduler=scheduler)
+            self.assertEqual(project.state, "stopped")
+        finally:
+            env.close()
+
+    def test_cancel_while_api_down(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            radiam_bench.generate_tree(env.rootdir, files=20, depth=1, fanout=2)
+            # connections are refused from now on, so the crawl waits to retry its upload
+            env.server.stop()
+            scheduler = radiam.open_scheduler(env.config)
+            errors = []
+
+            def crawl():
+                try:
+                    radiam.full_run(env.API, env.config, env.logger, scheduler)
+                except Cancelled as e:
+                    errors.append(e)
+            thread = threading.Thread(target=crawl)
+            thread.start()
+            time.sleep(1)
+            self.assertTrue(thread.is_alive())
+            scheduler.cancel()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(len(errors), 1)
+        finally:
+            env.close()
+
+    def test_monitor_checksums(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            env.config[env.project_key]['checksum'] = "sha256"
+            # an agent restarted after a finished crawl goes straight to the monitor
+            observer, handlers = radiam.start_monitor(env.API, env.config, env.logger)
+            observer.stop()
+            observer.join()
+            path = os.path.join(env.rootdir, "new.dat")
+            with open(path, "wb") as new_file:
+                new_file.write(b"radiam")
+            metadata = radiam.get_file_meta(path, env.config, env.project_key)
+            self.assertEqual(metadata["checksum"], "sha256:" + hashlib.sha256(b"radiam").hexdigest())
+        finally:
+            env.close()
+
+    def test_close_services(self):
+        env = radiam_bench.BenchEnvironment()
+        try:
+            env.config[env.project_key]['checksum'] = "sha256"
+            first = radiam.open_checksummer(env.config)
+            self.assertIs(radiam.open_checksummer(env.config), first)
+            # a crawl started after the services are closed gets them with its own settings
+            radiam.close_services()
+            env.config['agent']['checksum_rate'] = "5000000"
+            second = radiam.open_checksummer(env.config)
+            self.assertIsNot(second, first)
+            self.assertEqual(second.throttle.rate, 5000000)
+        finally:
+            env.close()
+
+
+def sharded_crawl(env):
+    # runs in a separate agent process; the exit code says whether the crawl succeeded
+    API = RadiamAPI(tokenfile=os.path.join(env.workdir, "token"), baseurl=env.server.url, logger=env.logger)
+    API.login("admin", "admin")
+    resp_text, status = radiam.full_run(API, env.config, env.logger)
+    if not status:
+        raise RuntimeError(resp_text)
+
+
+class TestShardedCrawl(unittest.TestCase):
+    def test_lease_renewed_while_held(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            shard_db = os.path.join(workdir, "shards.db")
+            busy = ShardCoordinator(shard_db, "busy", lease=0.4, poll=0.05)
+            idle = ShardCoordinator(shard_db, "idle", lease=0.4, poll=0.05)
+            busy.seed(workdir, [])
+            self.assertEqual(busy.claim(), workdir)
+            # the busy agent does nothing with the shard database for a few leases, as in a long flush
+            time.sleep(1.5)
+            self.assertIs(idle.claim(wait=False), False)
+            busy.close()
+            # once the holder is gone its lease runs out and the unit goes to another agent
+            time.sleep(0.6)
+            self.assertEqual(idle.claim(wait=False), workdir)
+            idle.close()
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_agents_share_one_tree(self):
+        env = radiam_bench.BenchEnvironment(latency=0.02)
+        try:
+            # one top-level directory, so the other agents only get work that is given away
+            dirs, paths = radiam_bench.generate_tree(os.path.join(env.rootdir, "only"), files=400, depth=3, fanout=3)
+            shard_db = os.path.join(env.rootdir, "shards.db")
+            env.config[env.project_key]['shard_db'] = shard_db
+            env.config['agent']['batch_docs'] = "10"
+            env.config['agent']['batch_docs_max'] = "10"
+            context = multiprocessing.get_context("fork")
+            agents = [context.Process(target=sharded_crawl, args=(env,)) for i in range(3)]
+            for agent in agents:
+                agent.start()
+            for agent in agents:
+                agent.join(120)
+            self.assertEqual([agent.exitcode for agent in agents], [0, 0, 0])
+            stats = env.server.state.stats()
+            # the root directory itself is not a document, nor is the shard database
+            self.assertEqual(stats["documents"], len(paths) + len(dirs))
+            self.assertEqual(stats["duplicate_posts"], 0)
+            with sqlite3.connect(shard_db) as db:
+                self.assertEqual(db.execute("SELECT COUNT(*) FROM units WHERE state != 'done'").fetchone()[0], 0)
+                self.assertGreater(db.execute("SELECT COUNT(*) FROM units").fetchone()[0], 2)
+                self.assertGreaterEqual(db.execute("SELECT COUNT(DISTINCT owner) FROM units").fetchone()[0], 2)
+                # agents on different nodes may share an id and a pid, but not a hostname
+                prefix = "{}:{}:".format(env.config['agent']['id'], socket.gethostname())
+                for owner, in db.execute("SELECT DISTINCT owner FROM units WHERE owner IS NOT NULL"):
+                    self.assertTrue(owner.startswith(prefix), owner)
+            db.close()
+        finally:
+            env.close()
+
+
 if __name__ == '__main__':
     unittest.main(logger, dirs, arguments, tokenfile, resumefile)
\ No newline at end of file
@@ -275,53 +275,78 @@ app.on('will-quit', ev => {
   app.quit();
 })
 
+let crawlWatcher = null
+
+const crawlStopped = () => {
+  if (crawlWatcher != null) {
+    clearInterval(crawlWatcher);
+    crawlWatcher = null
+  }
+  top.tray.setContextMenu(menu);
+  top.tray.setImage(trayIcon);
+}
+
+const startCrawl = () => {
+  top.tray.setImage(runTrayIcon);
+  top.tray.setContextMenu(runningMenu);
+  client.invoke("crawl", function(error, res, more) {
+      if (res){
+        notifier.notify({"title" : "Radiam", "message" : res});
+        crawlStopped();
+      } else {
+        crawlSuccess = 1
+        // the crawl runs in the background, so check on it to report a failure
+        crawlWatcher = setInterval(() => {
+          client.invoke("status", function(error, res, more) {
+            if (res){
+              const status = JSON.parse(res);
+              if (status.state === "failed") {
+                notifier.notify({"title" : "Radiam", "message" : status.result});
+                crawlSuccess = null
+                crawlStopped();
+              } else if (status.state === "finished" || status.state === "cancelled") {
+                crawlStopped();
+              }
+            }
+          });
+        }, 10000);
+      }
+  });
+}
+
+const stopCrawl = () => {
+  client.invoke("cancel", function(error, res, more) {} );
+  crawlSuccess = null
+  crawlStopped();
+}
+
 const runningMenu = Menu.buildFromTemplate([
   {label: "Pause Crawling", click: (item, window, event) => {
-    exitRadiam();
-    sleep(2000).then(() => {
-      crawlSuccess = null
-      portfinder.getPort(function (err, port) {
-        client.connect("tcp://127.0.0.1:" + String(port));
-
-        const createRadiam = () => {
-          let script = getScriptPath()
-          if (guessPackaged()) {
-            pythonChild = require('child_process').spawn(script, [port])
-          } else {
-            pythonChild = require('child_process').spawn('python3', [script, port])
-          }
-          
-          if (pythonChild != null) {
-            console.log('Python started successfully')
-
-            pythonChild.stdout.on('data', function (data) {
-              console.log(data.toString());
-            });
-          }
-        }
-
-        createRadiam();
-        top.tray.setContextMenu(menu);
-        top.tray.setImage(trayIcon);
-      });
-    });
+      client.invoke("pause", function(error, res, more) {} );
+      top.tray.setContextMenu(pausedMenu);
+      top.tray.setImage(trayIcon);
+  }},
+  {label: "Stop Crawling", click: (item, window, event) => {
+      stopCrawl();
+  }},
+  {role: "quit"}
+]);
+
+const pausedMenu = Menu.buildFromTemplate([
+  {label: "Resume Crawling", click: (item, window, event) => {
+      client.invoke("resume", function(error, res, more) {} );
+      top.tray.setContextMenu(runningMenu);
+      top.tray.setImage(runTrayIcon);
+  }},
+  {label: "Stop Crawling", click: (item, window, event) => {
+      stopCrawl();
   }},
   {role: "quit"}
 ]);
 
 const menu = Menu.buildFromTemplate([
   {label: "Crawl", click: (item, window, event) => {
-      top.tray.setImage(runTrayIcon);
-      top.tray.setContextMenu(runningMenu);
-      client.invoke("crawl", function(error, res, more) {
-          if (res){
-            notifier.notify({"title" : "Radiam", "message" : res});
-            top.tray.setContextMenu(menu);
-            top.tray.setImage(trayIcon);
-          } else {
-            crawlSuccess = 1
-          }
-      });
+      startCrawl();
   }},
   {label: "Change Project Folder", click: (item, window, event) => {
       projectFolder = dialog.showOpenDialogSync({properties: ["openDirectory"]});
@@ -387,17 +412,7 @@ app.once("ready", ev => {
   top.tray.setToolTip("Radiam Agent");
   client.invoke("check_resume_file", function(error, res, more) {
     if (res){
-      top.tray.setImage(runTrayIcon);
-      top.tray.setContextMenu(runningMenu);
-      client.invoke("crawl", function(error, res, more) {
-          if (res){
-            notifier.notify({"title" : "Radiam", "message" : res});
-            top.tray.setContextMenu(menu);
-            top.tray.setImage(trayIcon);
-          } else {
-            crawlSuccess = 1
-          }
-      });
+      startCrawl();
     } else {
       top.tray.setContextMenu(menu);
     }